@@ -0,0 +1,525 @@
+
+__all__ = ['main']
+
+# pgo
+from pgo.setuptools.compiler import (_get_weighted_profraws, _is_llvm_profile,
+                                     _merge_gcdas)
+from pgo.setuptools.error import ProfileError
+from pgo.setuptools.profilecheck import (_add_gcda_counters,
+                                         _get_gcda_overlap,
+                                         _get_profdata_overlap,
+                                         _run_llvm_profdata)
+from pgo.setuptools.profilereport import (_format_extension_profile,
+                                          _read_gcda, _read_gcda_counters,
+                                          _read_profdata,
+                                          _summarize_extension_profile)
+# python
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+# setuptools
+from distutils.errors import DistutilsError
+
+# the merged profiles in pgo-build-lib are named after their extension
+LLVM_PROFDATA_PREFIX = '.pgo-profdata-'
+
+
+def create_argparser():
+    argparser = argparse.ArgumentParser(
+        prog='python -m pgo',
+        description=(
+            'Work with the profile data of pgo builds: the raw and merged '
+            'profiles of clang (a directory of profiles for each extension, '
+            'like --pgo-profile-data-dir, or the merged profiles in '
+            'pgo-build-lib) and the ".gcda" trees of gcc (laid out like '
+            'pgo-build-temp).'
+        )
+    )
+    subparsers = argparser.add_subparsers(dest='command', required=True)
+
+    merge = subparsers.add_parser(
+        'merge',
+        help='merge profile data, each extension is merged in parallel'
+    )
+    merge.add_argument('inputs', nargs='*', help='profile data to merge')
+    merge.add_argument(
+        '--weighted-input',
+        action='append',
+        default=[],
+        metavar='WEIGHT,PATH',
+        help='profile data to merge with its counters scaled by a weight'
+    )
+    merge.add_argument(
+        '-o', '--output',
+        required=True,
+        help='directory the merged profile data is written to, laid out '
+             'like the inputs'
+    )
+    merge.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='number of merges run at once (defaults to the number of CPUs)'
+    )
+    merge.add_argument(
+        '--sparse',
+        action='store_true',
+        help='leave out functions that were never run (clang only)'
+    )
+
+    show = subparsers.add_parser(
+        'show',
+        help='show the hottest functions and the coverage of profile data'
+    )
+    show.add_argument('input', help='profile data to show')
+    show.add_argument(
+        '-n', '--top',
+        type=int,
+        default=10,
+        help='number of hottest functions listed for each extension '
+             '(default 10)'
+    )
+    show.add_argument('--json', action='store_true', help='output json')
+
+    diff = subparsers.add_parser(
+        'diff',
+        help='show the overlap of the profile data of each extension'
+    )
+    diff.add_argument('input', help='profile data to compare')
+    diff.add_argument('other_input', help='profile data to compare with')
+    diff.add_argument(
+        '-t', '--threshold',
+        type=float,
+        help='exit with an error if the overlap of any extension is below '
+             'this (from 0 to 1)'
+    )
+    diff.add_argument('--json', action='store_true', help='output json')
+
+    prune = subparsers.add_parser(
+        'prune',
+        help='remove old profile data'
+    )
+    prune.add_argument('input', help='profile data directory to prune')
+    prune.add_argument(
+        '--older-than',
+        type=float,
+        metavar='DAYS',
+        help='remove profile data last modified more than this many days ago'
+    )
+    prune.add_argument(
+        '--keep-newest',
+        type=int,
+        metavar='N',
+        help='keep only the newest N raw profiles in each directory (clang '
+             'only)'
+    )
+    prune.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='show what would be removed without removing it'
+    )
+
+    relocate = subparsers.add_parser(
+        'relocate',
+        help='move a gcc ".gcda" tree to match sources in a new location'
+    )
+    relocate.add_argument('input', help='".gcda" tree to relocate')
+    relocate.add_argument(
+        '--from',
+        dest='from_dir',
+        required=True,
+        help='directory the sources were in when the profile was collected'
+    )
+    relocate.add_argument(
+        '--to',
+        dest='to_dir',
+        required=True,
+        help='directory the sources are in now'
+    )
+    relocate.add_argument(
+        '-o', '--output',
+        help='directory the relocated tree is written to (defaults to '
+             'relocating it in place)'
+    )
+    return argparser
+
+
+def main(args=None):
+    args = create_argparser().parse_args(args)
+    try:
+        return COMMANDS[args.command](args) or 0
+    except (DistutilsError, OSError) as ex:
+        print(f'error: {ex}', file=sys.stderr)
+        return 1
+
+
+def merge(args):
+    inputs = [(1, path) for path in args.inputs]
+    for weighted_input in args.weighted_input:
+        weight, _, path = weighted_input.partition(',')
+        try:
+            weight = int(weight)
+            if weight < 1 or not path:
+                raise ValueError()
+        except ValueError:
+            raise ProfileError(
+                f'--weighted-input {weighted_input!r} must be a positive '
+                f'integer weight and a path separated by ","'
+            )
+        inputs.append((weight, path))
+    if not inputs:
+        raise ProfileError('no profile data to merge')
+    if args.jobs < 1:
+        raise ProfileError('--jobs must be a positive integer')
+    merges = []
+    if _get_profile_kind([path for _, path in inputs]) == 'clang':
+        # each extension's profiles are merged into a profile of its own,
+        # which can be used as profile data for a build
+        extensions = {}
+        for weight, path in inputs:
+            for name, profiles in _get_llvm_extension_profiles(path).items():
+                extensions.setdefault(name, []).extend(
+                    (weight * profile_weight, profile)
+                    for profile_weight, profile in profiles
+                )
+        for name, profiles in sorted(extensions.items()):
+            merges.append((
+                _merge_llvm_profiles,
+                os.path.join(args.output, name, f'{name}.profdata'),
+                profiles,
+                args.sparse
+            ))
+    else:
+        # gcov-tool merges whole trees, so each ".gcda" file is merged on its
+        # own so that they can be merged at the same time
+        gcdas = {}
+        for weight, path in inputs:
+            root, rel_gcdas = _get_gcda_tree(path)
+            for rel_gcda in rel_gcdas:
+                gcdas.setdefault(rel_gcda, []).append((
+                    os.path.join(root, rel_gcda),
+                    weight
+                ))
+        for rel_gcda, weighted_gcdas in sorted(gcdas.items()):
+            merges.append((
+                _merge_gcda,
+                args.output,
+                rel_gcda,
+                weighted_gcdas
+            ))
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(*merge) for merge in merges]
+        for future in futures:
+            future.result()
+
+
+def _merge_llvm_profiles(profdata, profiles, sparse):
+    os.makedirs(os.path.dirname(profdata), exist_ok=True)
+    _run_llvm_profdata([
+        'merge',
+        f'-output={profdata}',
+        *(['-sparse'] if sparse else []),
+        *(f'-weighted-input={weight},{profile}' for weight, profile in profiles)
+    ])
+
+
+def _merge_gcda(output, rel_gcda, weighted_gcdas):
+    with tempfile.TemporaryDirectory() as merge_dir:
+        workloads = []
+        for i, (gcda, weight) in enumerate(weighted_gcdas):
+            workload_dir = os.path.join(merge_dir, str(i))
+            target = os.path.join(workload_dir, rel_gcda)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(gcda, target)
+            workloads.append((workload_dir, weight))
+        _merge_gcdas(output, workloads)
+
+
+def show(args):
+    if args.top < 0:
+        raise ProfileError('--top must be a non-negative integer')
+    profiles = []
+    if _get_profile_kind([args.input]) == 'clang':
+        for name, llvm_profiles in sorted(
+            _get_llvm_extension_profiles(args.input).items()
+        ):
+            with tempfile.TemporaryDirectory() as merge_dir:
+                profdata = os.path.join(merge_dir, f'{name}.profdata')
+                _merge_llvm_profiles(profdata, llvm_profiles, False)
+                functions, counter_volume = _read_profdata(profdata)
+            profiles.append((name, functions, counter_volume))
+    else:
+        root, rel_gcdas = _get_gcda_tree(args.input)
+        for rel_gcda in rel_gcdas:
+            gcda = os.path.join(root, rel_gcda)
+            if os.path.exists(os.path.splitext(gcda)[0] + '.gcno'):
+                functions, counter_volume = _read_gcda(gcda)
+            else:
+                # without the notes the functions can't be named, nor their
+                # entry counts told apart from their other counters
+                functions = [
+                    {
+                        "name": f'ident={ident}',
+                        "count": sum(counts),
+                        "blocks": len(counts),
+                        "blocks_executed": sum(1 for c in counts if c),
+                    }
+                    for ident, (_, counts)
+                    in _read_gcda_counters(gcda).items()
+                ]
+                counter_volume = sum(f["count"] for f in functions)
+            profiles.append((rel_gcda, functions, counter_volume))
+    summaries = [
+        _summarize_extension_profile(name, functions, counter_volume, args.top)
+        for name, functions, counter_volume in profiles
+    ]
+    if args.json:
+        print(json.dumps({"profiles": summaries}, indent=4))
+    else:
+        for summary in summaries:
+            for line in _format_extension_profile(summary):
+                print(line)
+
+
+def diff(args):
+    if args.threshold is not None and not 0 <= args.threshold <= 1:
+        raise ProfileError('--threshold must be a number from 0 to 1')
+    kind = _get_profile_kind([args.input, args.other_input])
+    results = []
+    if kind == 'clang':
+        profiles = _get_llvm_extension_profiles(args.input)
+        other_profiles = _get_llvm_extension_profiles(args.other_input)
+        names = sorted(set(profiles) & set(other_profiles))
+        with tempfile.TemporaryDirectory() as merge_dir:
+            for name in names:
+                profdata = os.path.join(merge_dir, f'{name}.profdata')
+                other_profdata = os.path.join(merge_dir, f'{name}.other')
+                _merge_llvm_profiles(profdata, profiles[name], False)
+                _merge_llvm_profiles(
+                    other_profdata,
+                    other_profiles[name],
+                    False
+                )
+                results.append((
+                    name,
+                    *_get_profdata_overlap(profdata, other_profdata)
+                ))
+    else:
+        root, rel_gcdas = _get_gcda_tree(args.input)
+        other_root, other_rel_gcdas = _get_gcda_tree(args.other_input)
+        profiles, other_profiles = set(rel_gcdas), set(other_rel_gcdas)
+        names = sorted(profiles & other_profiles)
+        for name in names:
+            functions = {}
+            other_functions = {}
+            _add_gcda_counters(functions, [root], name)
+            _add_gcda_counters(other_functions, [other_root], name)
+            results.append((
+                name,
+                *_get_gcda_overlap(functions, other_functions)
+            ))
+    only = sorted(set(profiles) - set(other_profiles))
+    other_only = sorted(set(other_profiles) - set(profiles))
+    if args.json:
+        print(json.dumps({
+            "profiles": [
+                {
+                    "name": name,
+                    "overlap": overlap,
+                    "mismatched_functions": mismatched_functions,
+                }
+                for name, overlap, mismatched_functions in results
+            ],
+            "only_in_input": only,
+            "only_in_other_input": other_only,
+        }, indent=4))
+    else:
+        for name, overlap, mismatched_functions in results:
+            print(
+                f'{name}: {overlap:.1%} overlap, {mismatched_functions} '
+                f'mismatched functions'
+            )
+        for name in only:
+            print(f'{name}: only in {args.input}')
+        for name in other_only:
+            print(f'{name}: only in {args.other_input}')
+    if args.threshold is not None and any(
+        overlap < args.threshold
+        for _, overlap, _ in results
+    ):
+        return 1
+
+
+def prune(args):
+    if args.older_than is None and args.keep_newest is None:
+        raise ProfileError('one of --older-than or --keep-newest is required')
+    if args.keep_newest is not None and args.keep_newest < 0:
+        raise ProfileError('--keep-newest must be a non-negative integer')
+    if not os.path.isdir(args.input):
+        raise ProfileError(f'{args.input} is not a directory')
+    remove = set()
+    for root, _, files in os.walk(args.input):
+        profiles = [
+            os.path.join(root, file)
+            for file in files
+            if _is_profile(file)
+        ]
+        if args.older_than is not None:
+            cutoff = time.time() - args.older_than * 24 * 60 * 60
+            remove.update(
+                profile for profile in profiles
+                if os.path.getmtime(profile) < cutoff
+            )
+        # the ".gcda" files in a directory each belong to a different object,
+        # only raw profiles are interchangeable
+        if args.keep_newest is not None:
+            llvm_profiles = sorted(
+                (profile for profile in profiles if _is_llvm_profile(profile)),
+                key=os.path.getmtime,
+                reverse=True
+            )
+            remove.update(llvm_profiles[args.keep_newest:])
+    for profile in sorted(remove):
+        print(f'removing {profile}')
+        if not args.dry_run:
+            os.remove(profile)
+    if not args.dry_run:
+        for root, _, _ in os.walk(args.input, topdown=False):
+            if root != args.input and not os.listdir(root):
+                os.rmdir(root)
+
+
+def relocate(args):
+    if _get_profile_kind([args.input]) == 'clang':
+        raise ProfileError(
+            'only gcc ".gcda" trees can be relocated, clang profile data is '
+            'laid out by extension name'
+        )
+    root, rel_gcdas = _get_gcda_tree(args.input)
+    output = args.input if args.output is None else args.output
+    # the tree mirrors the absolute paths of the objects, which are built from
+    # the absolute paths of the sources
+    from_dir = _get_rel_source_dir(args.from_dir)
+    to_dir = _get_rel_source_dir(args.to_dir)
+    for rel_gcda in rel_gcdas:
+        if rel_gcda.startswith(from_dir + os.sep):
+            target_rel_gcda = os.path.join(
+                to_dir,
+                rel_gcda[len(from_dir) + len(os.sep):]
+            )
+        elif args.output is not None:
+            target_rel_gcda = rel_gcda
+        else:
+            continue
+        gcda = os.path.join(root, rel_gcda)
+        target = os.path.join(output, target_rel_gcda)
+        print(f'relocating {gcda} to {target}')
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if args.output is None:
+            shutil.move(gcda, target)
+        else:
+            shutil.copyfile(gcda, target)
+
+
+def _get_rel_source_dir(source_dir):
+    # the path an object is built at is the absolute path of its source in
+    # the build directory, without the drive
+    source_dir = os.path.splitdrive(os.path.abspath(source_dir))[1]
+    return source_dir.lstrip(os.sep).rstrip(os.sep)
+
+
+def _is_profile(file):
+    return file.endswith('.gcda') or _is_llvm_profile(file)
+
+
+def _iter_files(path):
+    if os.path.isfile(path):
+        yield path
+        return
+    if not os.path.isdir(path):
+        raise ProfileError(f'{path} does not exist')
+    for root, dirnames, files in os.walk(path):
+        # the unmerged profiles of each workload are not part of the profile
+        if '.pgo-workloads' in dirnames:
+            dirnames.remove('.pgo-workloads')
+        for file in files:
+            yield os.path.join(root, file)
+
+
+def _get_profile_kind(paths):
+    kinds = set()
+    for path in paths:
+        for file in _iter_files(path):
+            name = os.path.basename(file)
+            if name.endswith('.gcda'):
+                kinds.add('gcc')
+            elif (
+                _is_llvm_profile(name) or
+                name.startswith(LLVM_PROFDATA_PREFIX)
+            ):
+                kinds.add('clang')
+    if not kinds:
+        raise ProfileError(f'no profile data in {", ".join(paths)}')
+    if len(kinds) > 1:
+        raise ProfileError('clang and gcc profile data cannot be mixed')
+    return kinds.pop()
+
+
+def _get_llvm_extension_profiles(path):
+    # returns the (weight, path) of each profile of each extension by its
+    # name, a file is a profile of its own
+    if os.path.isfile(path):
+        name = os.path.basename(path)
+        if name.startswith(LLVM_PROFDATA_PREFIX):
+            name = name[len(LLVM_PROFDATA_PREFIX):]
+        else:
+            name = os.path.splitext(name)[0]
+        return {name: [(1, path)]}
+    extensions = {}
+    for name in sorted(os.listdir(path)):
+        entry = os.path.join(path, name)
+        if os.path.isdir(entry):
+            profiles = _get_weighted_profraws(entry)
+            if profiles:
+                extensions.setdefault(name, []).extend(profiles)
+        elif name.startswith(LLVM_PROFDATA_PREFIX):
+            extensions.setdefault(
+                name[len(LLVM_PROFDATA_PREFIX):],
+                []
+            ).append((1, entry))
+        elif _is_llvm_profile(name):
+            extensions.setdefault(
+                os.path.splitext(name)[0],
+                []
+            ).append((1, entry))
+    return extensions
+
+
+def _get_gcda_tree(path):
+    # returns the root of the tree and the path of each ".gcda" file in it
+    # relative to the root, a file is a tree of its own
+    if os.path.isfile(path):
+        return os.path.dirname(path), [os.path.basename(path)]
+    return path, sorted(
+        os.path.relpath(file, path)
+        for file in _iter_files(path)
+        if file.endswith('.gcda')
+    )
+
+
+COMMANDS = {
+    "merge": merge,
+    "show": show,
+    "diff": diff,
+    "prune": prune,
+    "relocate": relocate,
+}
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,228 @@
+
+__all__ = ['benchmark', 'make_build_ext_baseline', 'BenchmarkError']
+
+# pgo
+from .error import BenchmarkError, ProfileError
+from .profile import _run_profile
+from .report import _report_extension
+# python
+from math import factorial
+import os
+import shutil
+import statistics
+import time
+# setuptools
+from distutils.errors import DistutilsOptionError, DistutilsSetupError
+from distutils.log import info, warn
+from setuptools import Command
+
+
+def make_build_ext_baseline(base_class):
+
+    class build_ext_baseline(base_class):
+
+        description = (
+            'build the extensions without profile guided optimization to '
+            'benchmark against'
+        )
+
+        def finalize_options(self):
+            self.set_undefined_options('benchmark',
+                ('baseline_lib', 'build_lib'),
+                ('baseline_temp', 'build_temp'),
+            )
+            self.set_undefined_options('build', ('pgo_jobs', 'parallel'))
+            super().finalize_options()
+
+        def build_extension(self, ext):
+            with _report_extension(self, ext):
+                super().build_extension(ext)
+
+    return build_ext_baseline
+
+
+class benchmark(Command):
+
+    description = (
+        'benchmark the profile guided optimized extensions against a build '
+        'without profile guided optimization, keeping the faster'
+    )
+    user_options = [
+        ('repeat=', 'r', 'number of times the benchmark command is run for '
+                         'each build (default 7)'),
+        ('margin=', 'm', 'fraction that the profile guided optimized build '
+                         'must be faster than the baseline by to be kept '
+                         '(default 0)'),
+    ]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the wall times of each run of the benchmark command for each build
+        self.baseline_times = []
+        self.pgo_times = []
+        # whether the profile guided optimized build was kept
+        self.accepted = None
+
+    def initialize_options(self):
+        self.repeat = None
+        self.margin = None
+        self.baseline_lib = None
+        self.baseline_temp = None
+        self.build_temp = None
+
+    def finalize_options(self):
+        self.set_undefined_options('build_profile_use',
+            ('pgo_build_temp', 'build_temp'),
+        )
+        benchmark_dir = os.path.join(self.build_temp, '.pgo-benchmark')
+        if self.baseline_lib is None:
+            self.baseline_lib = os.path.join(benchmark_dir, 'lib')
+        if self.baseline_temp is None:
+            self.baseline_temp = os.path.join(benchmark_dir, 'temp')
+        pgo = self.distribution.pgo
+        if self.repeat is None:
+            self.repeat = pgo.get("benchmark_repeat", 7)
+        try:
+            self.repeat = int(self.repeat)
+            if self.repeat < 1:
+                raise ValueError()
+        except ValueError:
+            raise DistutilsOptionError('--repeat must be a positive integer')
+        if self.margin is None:
+            self.margin = pgo.get("benchmark_margin", 0)
+        try:
+            self.margin = float(self.margin)
+            if not 0 <= self.margin < 1:
+                raise ValueError()
+        except ValueError:
+            raise DistutilsOptionError(
+                '--margin must be a number from 0 up to (not including) 1'
+            )
+        try:
+            self.benchmark_command = tuple(pgo["benchmark_command"])
+        except KeyError:
+            raise DistutilsSetupError('"pgo" must define "benchmark_command"')
+
+    def run(self):
+        if self.dry_run:
+            return
+        build_ext = self.get_finalized_command('build_ext_profile_use')
+        if not self.distribution.have_run.get('build_ext_profile_use'):
+            self.run_command('build_ext_profile_use')
+        self.run_command('build_ext_baseline')
+        build_ext_baseline = self.get_finalized_command('build_ext_baseline')
+        ext_names = [
+            build_ext.get_ext_fullname(ext.name)
+            for ext in build_ext.extensions
+        ]
+        ext_paths = [
+            build_ext.get_ext_fullpath(ext_name)
+            for ext_name in ext_names
+        ]
+        baseline_ext_paths = [
+            build_ext_baseline.get_ext_fullpath(ext_name)
+            for ext_name in ext_names
+        ]
+        # the profile guided optimized extensions are put aside, since the
+        # builds take turns in the build directory so that the benchmark sees
+        # them exactly as they'll be installed
+        pgo_dir = os.path.join(self.build_temp, '.pgo-benchmark', 'pgo')
+        pgo_ext_paths = [
+            os.path.join(
+                pgo_dir,
+                os.path.relpath(ext_path, build_ext.build_lib)
+            )
+            for ext_path in ext_paths
+        ]
+        _copy_files(ext_paths, pgo_ext_paths)
+
+        self.baseline_times = []
+        self.pgo_times = []
+        try:
+            # the builds are interleaved so that any drift in the machine's
+            # performance affects both alike
+            for i in range(self.repeat):
+                variants = [
+                    (baseline_ext_paths, self.baseline_times),
+                    (pgo_ext_paths, self.pgo_times),
+                ]
+                if i % 2:
+                    variants.reverse()
+                for variant_ext_paths, times in variants:
+                    _copy_files(variant_ext_paths, ext_paths)
+                    times.append(_run_benchmark(
+                        build_ext.build_lib,
+                        self.build_temp,
+                        self.benchmark_command
+                    ))
+        finally:
+            _copy_files(pgo_ext_paths, ext_paths)
+
+        baseline_median = statistics.median(self.baseline_times)
+        pgo_median = statistics.median(self.pgo_times)
+        for name, times in (
+            ('baseline', self.baseline_times),
+            ('pgo', self.pgo_times),
+        ):
+            median = statistics.median(times)
+            low, high = _get_median_confidence_interval(times)
+            info(
+                '%s: median %.4fs (95%% confidence interval %.4fs - %.4fs) '
+                'over %d runs',
+                name, median, low, high, len(times)
+            )
+        self.accepted = pgo_median < baseline_median * (1 - self.margin)
+        speedup = 1 - pgo_median / baseline_median if baseline_median else 0
+        if self.accepted:
+            info(
+                'the profile guided optimized build is %.1f%% faster than '
+                'the baseline',
+                speedup * 100
+            )
+        else:
+            warn(
+                f'the profile guided optimized build is not faster than the '
+                f'baseline by at least {self.margin * 100:.1f}% '
+                f'({speedup * 100:.1f}%), using the baseline'
+            )
+            _copy_files(baseline_ext_paths, ext_paths)
+
+
+def _copy_files(sources, targets):
+    for source, target in zip(sources, targets):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(source, target)
+
+
+def _run_benchmark(build_lib, build_temp, benchmark_command):
+    # the benchmark command runs in the same environment as the profile
+    # command, its wall time is what's compared
+    start = time.perf_counter()
+    try:
+        _run_profile(
+            build_lib,
+            build_temp,
+            benchmark_command,
+            category='benchmark'
+        )
+    except ProfileError as ex:
+        raise BenchmarkError(f'benchmark failed: {ex}')
+    return time.perf_counter() - start
+
+
+def _get_median_confidence_interval(times, confidence=0.95):
+    # the distribution free confidence interval of the median, which is a
+    # pair of order statistics chosen using the binomial distribution, when
+    # there are too few times for the confidence the full range is used
+    times = sorted(times)
+    n = len(times)
+    interval = (times[0], times[-1])
+    for i in range(n // 2):
+        coverage = sum(
+            factorial(n) // (factorial(k) * factorial(n - k))
+            for k in range(i + 1, n - i)
+        ) / 2 ** n
+        if coverage < confidence:
+            break
+        interval = (times[i], times[n - 1 - i])
+    return interval
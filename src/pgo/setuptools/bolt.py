@@ -0,0 +1,250 @@
+
+__all__ = ['build_ext_bolt', 'BoltError']
+
+# pgo
+from .compiler import _new_compiler, is_msvc
+from .error import BoltError, ProfileError
+from .profile import _get_profile_workloads, _run_profiles
+from .profileuse import (_get_profile_use_digest_path,
+                         _update_profile_use_digest)
+from .report import _run_reported
+# python
+import os
+import shutil
+import subprocess
+import sys
+# setuptools
+from distutils.dir_util import remove_tree
+from distutils.errors import DistutilsOptionError
+from distutils.log import info, warn
+from setuptools import Command
+
+
+BOLT_PROFILERS = ('perf', 'instrument')
+
+
+class build_ext_bolt(Command):
+
+    description = (
+        'optimize the layout of the profile guided optimized extensions using '
+        'llvm-bolt'
+    )
+    user_options = [
+        ('profiler=', None, 'how the extensions are profiled for llvm-bolt, '
+                            'either "perf" (sampling with perf record, '
+                            'requires LBR) or "instrument" (llvm-bolt '
+                            'instrumentation)'),
+        ('jobs=', 'j', 'number of profile workloads to run at once (defaults '
+                       'to the build pgo-jobs)'),
+    ]
+
+    def initialize_options(self):
+        self.profiler = None
+        self.jobs = None
+        self.build_temp = None
+
+    def finalize_options(self):
+        self.set_undefined_options('build_profile_use',
+            ('pgo_build_temp', 'build_temp'),
+        )
+        self.set_undefined_options('build', ('pgo_jobs', 'jobs'))
+        if self.profiler is None:
+            self.profiler = self.distribution.pgo.get("bolt_profiler", "perf")
+        if self.profiler not in BOLT_PROFILERS:
+            raise DistutilsOptionError(
+                f'--profiler must be one of {", ".join(BOLT_PROFILERS)}'
+            )
+        self.jobs = int(self.jobs)
+        self.profile_workloads = _get_profile_workloads(self.distribution.pgo)
+
+    def run(self):
+        if self.dry_run:
+            return
+        build_ext = self.get_finalized_command('build_ext_profile_use')
+        if not self.distribution.have_run.get('build_ext_profile_use'):
+            self.run_command('build_ext_profile_use')
+        # only the extensions that were just linked have the relocations that
+        # llvm-bolt needs, an extension that was already optimized by
+        # llvm-bolt can't be optimized again
+        extensions = [
+            ext for ext in build_ext.extensions
+            if ext.name in build_ext.bolt_extensions
+        ]
+        ext_paths = [
+            build_ext.get_ext_fullpath(ext.name)
+            for ext in extensions
+        ]
+        if not ext_paths:
+            return
+        if sys.platform != 'linux':
+            warn('llvm-bolt is only supported on linux, skipping')
+            return
+        if is_msvc(_new_compiler(build_ext.compiler)):
+            warn('llvm-bolt does not support msvc, skipping')
+            return
+        tools = ['llvm-bolt', 'merge-fdata']
+        if self.profiler == 'perf':
+            tools += ['perf', 'perf2bolt']
+        missing_tools = [tool for tool in tools if shutil.which(tool) is None]
+        if missing_tools:
+            warn(
+                f'{", ".join(missing_tools)} not found, the extensions will '
+                f'not be optimized by llvm-bolt'
+            )
+            return
+
+        bolt_dir = os.path.join(self.build_temp, '.pgo-bolt')
+        if os.path.exists(bolt_dir):
+            remove_tree(bolt_dir)
+        os.makedirs(bolt_dir)
+        if self.profiler == 'perf':
+            fdatas = self._profile_perf(
+                build_ext.build_lib,
+                bolt_dir,
+                ext_paths
+            )
+        else:
+            fdatas = self._profile_instrument(
+                build_ext.build_lib,
+                bolt_dir,
+                ext_paths
+            )
+        for ext, ext_path, fdata in zip(extensions, ext_paths, fdatas):
+            _optimize(ext_path, fdata)
+            # the extension built from the profile data is now the one
+            # optimized by llvm-bolt, which shouldn't make the next build
+            # rebuild it
+            _update_profile_use_digest(
+                _get_profile_use_digest_path(build_ext.build_temp, ext),
+                ext_path
+            )
+
+    def _profile_perf(self, build_lib, bolt_dir, ext_paths):
+        # each workload is sampled into its own perf data file, which is then
+        # converted for each extension
+        perf_datas = []
+        profiles = []
+        for i, (name, weight, profile_command) in enumerate(
+            self.profile_workloads
+        ):
+            perf_data = os.path.join(bolt_dir, f'{i}.perf.data')
+            perf_datas.append(perf_data)
+            profiles.append((name, (
+                'perf', 'record',
+                '-e', 'cycles:u',
+                '-j', 'any,u',
+                '-o', perf_data,
+                '--',
+                *profile_command
+            ), {}))
+        self._run_profiles(build_lib, profiles)
+        fdatas = []
+        for ext_path in ext_paths:
+            ext_fdatas = []
+            for i, perf_data in enumerate(perf_datas):
+                ext_fdata = os.path.join(
+                    bolt_dir,
+                    f'{os.path.basename(ext_path)}.{i}.fdata'
+                )
+                _run_bolt_tool(f'perf2bolt {os.path.basename(ext_path)}', [
+                    'perf2bolt',
+                    '-p', perf_data,
+                    '-o', ext_fdata,
+                    ext_path
+                ])
+                ext_fdatas.append(ext_fdata)
+            fdatas.append(_merge_fdatas(bolt_dir, ext_path, ext_fdatas))
+        return fdatas
+
+    def _profile_instrument(self, build_lib, bolt_dir, ext_paths):
+        # the extensions are swapped for instrumented versions while the
+        # workloads run, every process writes its own profile
+        instrumentation_dirs = []
+        try:
+            for ext_path in ext_paths:
+                instrumentation_dir = os.path.join(
+                    bolt_dir,
+                    os.path.basename(ext_path)
+                )
+                os.makedirs(instrumentation_dir)
+                instrumentation_dirs.append(instrumentation_dir)
+                _run_bolt_tool(
+                    f'llvm-bolt -instrument {os.path.basename(ext_path)}',
+                    [
+                        'llvm-bolt', ext_path,
+                        '-instrument',
+                        '-instrumentation-file=' + os.path.join(
+                            instrumentation_dir,
+                            'prof.fdata'
+                        ),
+                        '-instrumentation-file-append-pid',
+                        '-o', ext_path + '.instrumented',
+                    ]
+                )
+                os.replace(ext_path, ext_path + '.pre-bolt')
+                os.replace(ext_path + '.instrumented', ext_path)
+            self._run_profiles(build_lib, [
+                (name, profile_command, {})
+                for name, weight, profile_command in self.profile_workloads
+            ])
+        finally:
+            for ext_path in ext_paths:
+                if os.path.exists(ext_path + '.pre-bolt'):
+                    os.replace(ext_path + '.pre-bolt', ext_path)
+                if os.path.exists(ext_path + '.instrumented'):
+                    os.remove(ext_path + '.instrumented')
+        return [
+            _merge_fdatas(bolt_dir, ext_path, [
+                os.path.join(instrumentation_dir, file)
+                for file in sorted(os.listdir(instrumentation_dir))
+            ])
+            for ext_path, instrumentation_dir
+            in zip(ext_paths, instrumentation_dirs)
+        ]
+
+    def _run_profiles(self, build_lib, profiles):
+        try:
+            _run_profiles(build_lib, self.build_temp, profiles, self.jobs)
+        except ProfileError as ex:
+            raise BoltError(ex)
+
+
+def _merge_fdatas(bolt_dir, ext_path, fdatas):
+    if not fdatas:
+        raise BoltError(f'missing llvm-bolt profile data for {ext_path}')
+    fdata = os.path.join(bolt_dir, f'{os.path.basename(ext_path)}.fdata')
+    with open(fdata, 'wb') as f:
+        _run_bolt_tool(
+            f'merge-fdata {os.path.basename(ext_path)}',
+            ['merge-fdata', *fdatas],
+            stdout=f
+        )
+    return fdata
+
+
+def _optimize(ext_path, fdata):
+    info('optimizing %s with llvm-bolt', ext_path)
+    try:
+        _run_bolt_tool(f'llvm-bolt {os.path.basename(ext_path)}', [
+            'llvm-bolt', ext_path,
+            '-o', ext_path + '.bolt',
+            f'-data={fdata}',
+            '-reorder-blocks=ext-tsp',
+            '-reorder-functions=hfsort+',
+            '-split-functions',
+            '-split-all-cold',
+            '-split-eh',
+            '-icf=1',
+            '-use-gnu-stack',
+        ])
+        os.replace(ext_path + '.bolt', ext_path)
+    finally:
+        if os.path.exists(ext_path + '.bolt'):
+            os.remove(ext_path + '.bolt')
+
+
+def _run_bolt_tool(name, command, **kwargs):
+    try:
+        _run_reported(name, 'bolt', command, **kwargs)
+    except (OSError, subprocess.CalledProcessError) as ex:
+        raise BoltError(ex)
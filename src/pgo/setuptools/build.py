@@ -2,12 +2,30 @@
 __all__ = ['make_build']
 
 # pgo
+from .benchmark import BenchmarkError
+from .bolt import BoltError
 from .command import PGO_BUILD_USER_OPTIONS
+from .compiler import get_compiler_identity, _new_compiler, is_clang, is_msvc
 from .profile import ProfileError
+from .profilecache import (_get_profile_cache_key, _restore_profile_cache,
+                           _store_profile_cache)
+from .profilearchive import _extract_profile_archive
+from .profiledata import _import_profile_data
+from .report import _reporting
 from .util import _dir_to_pgo_dir
+# python
+import os
+import sys
+import tempfile
 # setuptools
 from distutils.errors import (CCompilerError, DistutilsExecError, 
                               DistutilsOptionError, DistutilsPlatformError)
+from distutils.log import warn
+
+
+PGO_MODES = ('instrument', 'cs', 'sample')
+LTO_MODES = ('full', 'thin', 'off-for-instrumented')
+COUNTER_UPDATES = ('single', 'atomic', 'prefer-atomic')
 
 
 def make_build(base_class):
@@ -19,6 +37,59 @@ def make_build(base_class):
                                   'build will fail if environment does not '
                                   'support pgo'),
             ('pgo-disable', None, 'build without profile guided optimization'),
+            ('pgo-jobs=', None, 'number of parallel jobs used to build the '
+                                'instrumented and optimized extensions '
+                                '(defaults to the number of CPUs)'),
+            ('pgo-profile-cache=', None, 'directory to cache profile data in, '
+                                         'the instrumented build and profile '
+                                         'are skipped when the cache has '
+                                         'data for the current sources'),
+            ('pgo-object-cache=', None, 'directory to cache the instrumented '
+                                        'objects in, they are reused by later '
+                                        'builds of the same sources'),
+            ('pgo-mode=', None, 'kind of profile guided optimization, either '
+                                '"instrument" (the default), "cs" for '
+                                'clang\'s context sensitive pgo or "sample" '
+                                'for sampling with perf (linux only)'),
+            ('pgo-lto=', None, 'kind of link time optimization, either '
+                               '"full" (the default), "thin" for clang\'s '
+                               'thin lto or "off-for-instrumented" to skip '
+                               'it for the instrumented build'),
+            ('pgo-lto-jobs=', None, 'number of parallel jobs used by the link '
+                                    'time optimization of each extension '
+                                    '(defaults to the number of CPUs)'),
+            ('pgo-counter-update=', None, 'how the instrumented extensions '
+                                          'update their counters, either '
+                                          '"single", "atomic" or '
+                                          '"prefer-atomic" (defaults to the '
+                                          'compiler\'s default)'),
+            ('pgo-no-profile-values', None, 'leave out value profiling from '
+                                            'the instrumented extensions'),
+            ('pgo-perf-data=', None, 'perf data recorded elsewhere to use '
+                                     'for --pgo-mode=sample (separated by '
+                                     'os.pathsep)'),
+            ('pgo-profile-data-dir=', None, 'directories of raw profile data '
+                                            'collected elsewhere to optimize '
+                                            'with instead of running the '
+                                            'profile command (separated by '
+                                            'os.pathsep)'),
+            ('pgo-profile-archive=', None, 'profile archive written by '
+                                           'profile_export to optimize with '
+                                           'instead of running the profile '
+                                           'command'),
+            ('pgo-profile-data-local', None, 'also run the profile command '
+                                             'and merge its profile data '
+                                             'with --pgo-profile-data-dir'),
+            ('pgo-bolt', None, 'optimize the layout of the extensions with '
+                               'llvm-bolt after profile guided optimization '
+                               '(linux only)'),
+            ('pgo-report=', None, 'write a json report of the time spent on '
+                                  'each step of the build to this file'),
+            ('pgo-report-trace=', None, 'write the report as a chrome trace '
+                                        'event file to this file'),
+            ('pgo-verify', None, 'benchmark the profile guided optimized '
+                                 'extensions against a build without it and '
+                                 'keep the faster'),
             *PGO_BUILD_USER_OPTIONS,
         ]
 
@@ -26,6 +97,22 @@ def make_build(base_class):
             super().initialize_options()
             self.pgo_require = None
             self.pgo_disable = None
+            self.pgo_jobs = None
+            self.pgo_profile_cache = None
+            self.pgo_object_cache = None
+            self.pgo_bolt = None
+            self.pgo_verify = None
+            self.pgo_report = None
+            self.pgo_report_trace = None
+            self.pgo_mode = None
+            self.pgo_lto = None
+            self.pgo_lto_jobs = None
+            self.pgo_counter_update = None
+            self.pgo_no_profile_values = None
+            self.pgo_perf_data = None
+            self.pgo_profile_data_dir = None
+            self.pgo_profile_archive = None
+            self.pgo_profile_data_local = None
             self.pgo_build_lib = None
             self.pgo_build_temp = None
 
@@ -35,30 +122,329 @@ def make_build(base_class):
                 raise DistutilsOptionError(
                     'cannot specify --pgo-require and --pgo-disable'
                 )
+            if self.pgo_jobs is None:
+                self.pgo_jobs = self.parallel or os.cpu_count() or 1
+            try:
+                self.pgo_jobs = int(self.pgo_jobs)
+                if self.pgo_jobs < 1:
+                    raise ValueError()
+            except ValueError:
+                raise DistutilsOptionError(
+                    '--pgo-jobs must be a positive integer'
+                )
+            if self.pgo_profile_cache is None:
+                self.pgo_profile_cache = self.distribution.pgo.get(
+                    "profile_cache"
+                )
+            if self.pgo_object_cache is None:
+                self.pgo_object_cache = self.distribution.pgo.get(
+                    "object_cache"
+                )
+            if self.pgo_mode is None:
+                self.pgo_mode = self.distribution.pgo.get("mode", "instrument")
+            if self.pgo_mode not in PGO_MODES:
+                raise DistutilsOptionError(
+                    f'--pgo-mode must be one of {", ".join(PGO_MODES)}'
+                )
+            if self.pgo_lto is None:
+                self.pgo_lto = self.distribution.pgo.get("lto", "full")
+            if self.pgo_lto not in LTO_MODES:
+                raise DistutilsOptionError(
+                    f'--pgo-lto must be one of {", ".join(LTO_MODES)}'
+                )
+            if self.pgo_lto_jobs is None:
+                self.pgo_lto_jobs = self.distribution.pgo.get("lto_jobs")
+            if self.pgo_lto_jobs is not None:
+                try:
+                    self.pgo_lto_jobs = int(self.pgo_lto_jobs)
+                    if self.pgo_lto_jobs < 1:
+                        raise ValueError()
+                except ValueError:
+                    raise DistutilsOptionError(
+                        '--pgo-lto-jobs must be a positive integer'
+                    )
+            if self.pgo_counter_update is None:
+                self.pgo_counter_update = self.distribution.pgo.get(
+                    "counter_update"
+                )
+            if (
+                self.pgo_counter_update is not None and
+                self.pgo_counter_update not in COUNTER_UPDATES
+            ):
+                raise DistutilsOptionError(
+                    f'--pgo-counter-update must be one of '
+                    f'{", ".join(COUNTER_UPDATES)}'
+                )
+            if self.pgo_no_profile_values is None:
+                self.pgo_no_profile_values = not self.distribution.pgo.get(
+                    "profile_values",
+                    True
+                )
+            if self.pgo_perf_data is None:
+                self.pgo_perf_data = self.distribution.pgo.get("perf_data", [])
+            elif isinstance(self.pgo_perf_data, str):
+                self.pgo_perf_data = self.pgo_perf_data.split(os.pathsep)
+            self.pgo_perf_data = list(self.pgo_perf_data)
+            if self.pgo_profile_data_dir is None:
+                self.pgo_profile_data_dir = self.distribution.pgo.get(
+                    "profile_data", []
+                )
+            if isinstance(self.pgo_profile_data_dir, str):
+                self.pgo_profile_data_dir = self.pgo_profile_data_dir.split(
+                    os.pathsep
+                )
+            self.pgo_profile_data_dir = list(self.pgo_profile_data_dir)
+            if self.pgo_profile_archive is None:
+                self.pgo_profile_archive = self.distribution.pgo.get(
+                    "profile_archive"
+                )
+            if self.pgo_profile_data_local is None:
+                self.pgo_profile_data_local = bool(
+                    self.distribution.pgo.get("profile_data_local", False)
+                )
+            if self.pgo_profile_data_dir and self.pgo_mode != 'instrument':
+                raise DistutilsOptionError(
+                    '--pgo-profile-data-dir can only be used with '
+                    '--pgo-mode=instrument'
+                )
+            if self.pgo_profile_archive and self.pgo_mode != 'instrument':
+                raise DistutilsOptionError(
+                    '--pgo-profile-archive can only be used with '
+                    '--pgo-mode=instrument'
+                )
+            if self.pgo_bolt is None:
+                self.pgo_bolt = bool(self.distribution.pgo.get("bolt", False))
+            if self.pgo_verify is None:
+                self.pgo_verify = bool(
+                    self.distribution.pgo.get("verify", False)
+                )
+            if self.pgo_report is None:
+                self.pgo_report = self.distribution.pgo.get("report")
+            if self.pgo_report_trace is None:
+                self.pgo_report_trace = self.distribution.pgo.get(
+                    "report_trace"
+                )
             if self.pgo_build_lib is None:
                 self.pgo_build_lib = _dir_to_pgo_dir(self.build_lib)
             if self.pgo_build_temp is None:
                 self.pgo_build_temp = _dir_to_pgo_dir(self.build_temp)
 
         def run(self):
-            if not self.pgo_disable:
-                try:
-                    self.run_pgo()
-                    return
-                except (
-                    CCompilerError,
-                    DistutilsExecError,
-                    DistutilsPlatformError,
-                    ProfileError
-                ) as ex:
-                    if self.pgo_require:
-                        raise
-            self.run_no_pgo()
+            with _reporting(
+                self.distribution,
+                self.pgo_report,
+                self.pgo_report_trace
+            ):
+                if not self.pgo_disable:
+                    try:
+                        self.run_pgo()
+                        return
+                    except (
+                        CCompilerError,
+                        DistutilsExecError,
+                        DistutilsPlatformError,
+                        ProfileError
+                    ) as ex:
+                        if self.pgo_require:
+                            raise
+                self.run_no_pgo()
 
         def run_pgo(self):
+            build_ext = self.get_finalized_command('build_ext_profile_use')
+            compiler = _new_compiler(build_ext.compiler)
+            if self.pgo_mode == 'cs' and not is_clang(compiler):
+                warn(
+                    'context sensitive pgo is only supported by clang, using '
+                    'instrumented pgo'
+                )
+                self.pgo_mode = 'instrument'
+                build_ext.pgo_mode = 'instrument'
+            if (
+                self.pgo_counter_update is not None or
+                self.pgo_no_profile_values
+            ):
+                if self.pgo_mode == 'sample' or is_msvc(compiler):
+                    warn(
+                        'the counters can only be changed for instrumented '
+                        'clang and gcc builds, ignoring --pgo-counter-update '
+                        'and --pgo-no-profile-values'
+                    )
+                elif (
+                    self.pgo_counter_update is not None and
+                    not get_compiler_identity(compiler).supports_profile_update
+                ):
+                    warn(
+                        'the compiler does not support -fprofile-update, '
+                        'ignoring --pgo-counter-update'
+                    )
+            if self.distribution.pgo.get("partial_training"):
+                if is_msvc(compiler) or (
+                    self.pgo_mode == 'sample' and not is_clang(compiler)
+                ):
+                    warn(
+                        'partial training is only supported by instrumented '
+                        'clang and gcc builds and sample based clang builds, '
+                        'ignoring "partial_training"'
+                    )
+                elif is_clang(compiler) and not (
+                    get_compiler_identity(compiler).supports_pgso
+                ):
+                    warn(
+                        'the compiler does not support -mllvm -pgso=false, '
+                        'ignoring "partial_training"'
+                    )
+                elif not is_clang(compiler) and not (
+                    get_compiler_identity(compiler)
+                    .supports_profile_partial_training
+                ):
+                    warn(
+                        'the compiler does not support '
+                        '-fprofile-partial-training, ignoring '
+                        '"partial_training"'
+                    )
+            if "instrument_sources" in self.distribution.pgo and (
+                self.pgo_mode == 'sample' or is_msvc(compiler)
+            ):
+                warn(
+                    'the instrumented sources can only be chosen for '
+                    'instrumented clang and gcc builds, ignoring '
+                    '"instrument_sources"'
+                )
+            if self.pgo_mode == 'sample' and (
+                sys.platform != 'linux' or is_msvc(compiler)
+            ):
+                raise DistutilsPlatformError(
+                    'sample based pgo is only supported on linux'
+                )
+            if self.pgo_profile_data_dir or self.pgo_profile_archive:
+                self.run_pgo_profile_data(compiler)
+                return
+            profile_cache_key = None
+            if self.pgo_profile_cache and not self.dry_run:
+                profile_cache_key = _get_profile_cache_key(
+                    self.distribution,
+                    compiler,
+                    self.pgo_build_lib,
+                    self.pgo_build_temp,
+                    self.pgo_mode,
+                    self.pgo_perf_data,
+                    {
+                        "lto": self.pgo_lto,
+                        "lto_jobs": self.pgo_lto_jobs,
+                        "counter_update": self.pgo_counter_update,
+                        "no_profile_values": self.pgo_no_profile_values,
+                    }
+                )
+                if _restore_profile_cache(
+                    self.pgo_profile_cache,
+                    profile_cache_key,
+                    self.pgo_build_lib,
+                    self.pgo_build_temp
+                ):
+                    # the cached profile data stands in for running the
+                    # instrumented build and profile
+                    profile = self.distribution.get_command_obj('profile')
+                    profile.restored = True
+                    self.run_command('build_profile_use')
+                    self.run_bolt()
+                    self.run_verify()
+                    return
             self.run_command('build_profile_generate')
             self.run_command('profile')
+            if self.pgo_mode == 'cs':
+                # a second round, instrumented after inlining, using the
+                # profile of the first
+                self.run_command('build_ext_profile_cs_generate')
+                self.run_command('profile_cs')
+            self.run_command('build_profile_use')
+            self.run_bolt()
+            self.run_verify()
+            if profile_cache_key is not None:
+                profile = self.distribution.get_command_obj('profile')
+                if profile.profiled:
+                    _store_profile_cache(
+                        self.pgo_profile_cache,
+                        profile_cache_key,
+                        compiler,
+                        self.pgo_build_lib,
+                        self.pgo_build_temp,
+                        self.pgo_mode
+                    )
+
+        def run_pgo_profile_data(self, compiler):
+            if is_msvc(compiler):
+                raise DistutilsPlatformError(
+                    'importing profile data is not supported by msvc'
+                )
+            if self.pgo_profile_data_local:
+                # importing replaces the profile data left in the build
+                # directories by an earlier profile, so the profile must
+                # always be run again to get the local profile data
+                build_ext = self.distribution.get_command_obj(
+                    'build_ext_profile_generate'
+                )
+                build_ext.force = 1
+                self.run_command('build_profile_generate')
+                self.run_command('profile')
+            if not self.dry_run:
+                ignore_extensions = self.distribution.pgo.get(
+                    "ignore_extensions", []
+                )
+                extensions = [
+                    ext for ext in self.distribution.ext_modules or []
+                    if ext.name not in ignore_extensions
+                ]
+                with tempfile.TemporaryDirectory() as archive_dir:
+                    # the archive is imported like any other profile data
+                    # directory once it's extracted
+                    profile_data = list(self.pgo_profile_data_dir)
+                    if self.pgo_profile_archive:
+                        _extract_profile_archive(
+                            compiler,
+                            self.pgo_profile_archive,
+                            self.pgo_build_temp,
+                            extensions,
+                            archive_dir,
+                            self.pgo_profile_data_local
+                        )
+                        profile_data.append(archive_dir)
+                    _import_profile_data(
+                        compiler,
+                        profile_data,
+                        self.pgo_build_lib,
+                        self.pgo_build_temp,
+                        extensions,
+                        self.pgo_profile_data_local
+                    )
             self.run_command('build_profile_use')
+            self.run_bolt()
+            self.run_verify()
+
+        def run_bolt(self):
+            if not self.pgo_bolt:
+                return
+            # the extensions are already profile guided optimized, so failing
+            # to also optimize them with llvm-bolt is not a reason to throw
+            # that away
+            try:
+                self.run_command('build_ext_bolt')
+            except BoltError as ex:
+                if self.pgo_require:
+                    raise
+                warn(f'failed to optimize the extensions with llvm-bolt: {ex}')
+
+        def run_verify(self):
+            if not self.pgo_verify:
+                return
+            try:
+                self.run_command('benchmark')
+            except BenchmarkError as ex:
+                if self.pgo_require:
+                    raise
+                warn(
+                    f'failed to benchmark the extensions, the profile guided '
+                    f'optimized extensions are not verified: {ex}'
+                )
 
         def run_no_pgo(self):
             super().run()
@@ -1,109 +1,579 @@
 
-__all__ = ['is_clang', 'is_msvc']
+__all__ = [
+    'CompilerIdentity',
+    'get_compiler_identity',
+    'is_clang',
+    'is_msvc',
+]
 
 # pgo
 from .error import ProfileError, ProfileUseError
-from .profile import _run_profile
+from .report import _run_reported
 # python
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import functools
+import hashlib
 import os
-from pathlib import Path
+from pathlib import Path, PurePosixPath
+import re
+import shutil
 import subprocess
 import sys
+import tempfile
 try:
     import winreg
 except ModuleNotFoundError:
     winreg = None
 # setuptools
-from distutils.ccompiler import CCompiler, new_compiler
+from distutils.ccompiler import CCompiler, get_default_compiler, new_compiler
+from distutils.dir_util import remove_tree
 from distutils.errors import DistutilsPlatformError
+from distutils.sysconfig import customize_compiler
 from distutils.util import get_platform
 
 
-def is_msvc(compiler):
+# the root that the instrumented objects built with the object cache write
+# their ".gcda" files under, GCOV_PREFIX puts pgo_build_temp back in its place
+# when the profile is run
+_RELOCATED_GCDA_ROOT = '/pgo-build-temp'
+
+
+CompilerIdentity = namedtuple('CompilerIdentity', [
+    'vendor',
+    'version',
+    'supports_profile_update',
+    'supports_profile_partial_training',
+    'supports_lto_auto',
+    'supports_profile_prefix_path',
+    'supports_pgso',
+])
+
+
+def get_compiler_identity(compiler):
     if not isinstance(compiler, CCompiler):
         compiler = new_compiler(compiler=compiler)
-    return compiler.compiler_type == 'msvc'
+    if compiler.compiler_type == 'msvc':
+        if not compiler.initialized:
+            compiler.initialize()
+        return _get_msvc_identity(compiler.cc)
+    try:
+        cc = compiler.compiler[0]
+    except (AttributeError, IndexError):
+        return CompilerIdentity('unknown', None, False, False, False, False, False)
+    return _get_cc_identity(cc)
+
+
+def _new_compiler(compiler):
+    # the compiler that build_ext would use, compiler may be the name of a
+    # compiler type or an already created compiler
+    if isinstance(compiler, CCompiler):
+        return compiler
+    compiler = new_compiler(compiler=compiler)
+    if not is_msvc(compiler):
+        customize_compiler(compiler)
+    return compiler
+
+
+def is_msvc(compiler):
+    if isinstance(compiler, CCompiler):
+        compiler_type = compiler.compiler_type
+    else:
+        compiler_type = compiler or get_default_compiler()
+    return compiler_type == 'msvc'
     
     
 def is_clang(compiler):
-    if not isinstance(compiler, CCompiler):
-        compiler = new_compiler(compiler=compiler)
-    if compiler.compiler_type == 'unix':
-        cc = compiler.compiler[0]
+    if is_msvc(compiler):
+        return False
+    return get_compiler_identity(compiler).vendor == 'clang'
+
+
+@functools.cache
+def _get_msvc_identity(cc):
+    # the toolset version is part of the path to cl.exe:
+    # ...\VC\Tools\MSVC\14.29.30133\bin\HostX86\x64\cl.exe
+    match = re.search(r'[\\/]MSVC[\\/](\d+(?:\.\d+)*)[\\/]', cc or '')
+    version = _parse_version(match.group(1)) if match else None
+    return CompilerIdentity(
+        'msvc',
+        version,
+        False,
+        False,
+        False,
+        False,
+        False
+    )
+
+
+@functools.cache
+def _get_cc_identity(cc):
+    # a gcc compatible compiler is only ever probed once per executable, every
+    # flag decision is made from the resulting identity
+    try:
         out = subprocess.run(
-            [cc],
+            [cc, '--version'],
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            stderr=subprocess.STDOUT
+        ).stdout.decode('utf-8', errors='replace')
+    except OSError:
+        return CompilerIdentity('unknown', None, False, False, False, False, False)
+    first_line = (out.splitlines() or [''])[0]
+    if 'clang' in first_line:
+        vendor = 'clang'
+    elif 'Free Software Foundation' in out or 'gcc' in first_line.lower():
+        vendor = 'gcc'
+    else:
+        vendor = 'unknown'
+    match = re.search(r'version\s+(\d+(?:\.\d+)*)', first_line)
+    if not match:
+        match = re.search(r'(\d+(?:\.\d+)+)(?!.*\d+\.\d+)', first_line)
+    version = _parse_version(match.group(1)) if match else None
+    with tempfile.TemporaryDirectory() as probe_dir:
+        def supports(*flags):
+            source = os.path.join(probe_dir, 'probe.c')
+            with open(source, 'w') as f:
+                f.write('int pgo_probe(void) { return 0; }\n')
+            try:
+                return subprocess.run(
+                    [
+                        cc, *flags,
+                        '-c', source,
+                        '-o', os.path.join(probe_dir, 'probe.o')
+                    ],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL
+                ).returncode == 0
+            except OSError:
+                return False
+        return CompilerIdentity(
+            vendor,
+            version,
+            supports('-fprofile-update=atomic'),
+            supports('-fprofile-partial-training'),
+            supports('-flto=auto'),
+            supports('-fprofile-prefix-path=.'),
+            supports('-mllvm', '-pgso=false'),
+        )
+        
+        
+def _parse_version(version):
+    return tuple(int(part) for part in version.split('.'))
+
+
+def _get_instrumentation_flags(compiler, counter_update, profile_values):
+    # returns the flags for how the instrumented gcc and clang extensions
+    # update their counters, both when compiling and when linking
+    flags = []
+    # the counters aren't updated atomically by default, so extensions whose
+    # code is run by several threads at once lose counts
+    if (
+        counter_update is not None and
+        get_compiler_identity(compiler).supports_profile_update
+    ):
+        flags.append(f'-fprofile-update={counter_update}')
+    # value profiling records the values of divisors and the targets of
+    # indirect calls, which is slower than counting
+    if not profile_values:
+        if is_clang(compiler):
+            flags.extend(['-mllvm', '-disable-vp=true'])
+        else:
+            flags.append('-fno-profile-values')
+    return flags
+
+
+def _get_partial_training_flags(compiler):
+    # returns the flags for gcc and clang that optimize the code the profile
+    # never ran as if there was no profile, rather than for size, both when
+    # compiling and when linking
+    identity = get_compiler_identity(compiler)
+    if is_clang(compiler):
+        # clang has no partial training, the closest is to stop it from
+        # optimizing the code that the profile found cold for size, which is
+        # an internal llvm option that may not be there
+        if identity.supports_pgso:
+            return ['-mllvm', '-pgso=false']
+        return []
+    if identity.supports_profile_partial_training:
+        return ['-fprofile-partial-training']
+    return []
+
+
+def _get_lto_flags(compiler, lto, lto_jobs, instrumented=False):
+    # returns the link time optimization flags for gcc and clang when
+    # compiling and when linking
+    #
+    # gcc has no thin lto, its link time optimization is always split into
+    # partitions that are optimized in parallel, so both modes are the same
+    if instrumented and lto == 'off-for-instrumented':
+        return [], []
+    jobs = lto_jobs or os.cpu_count() or 1
+    if is_clang(compiler):
+        if lto == 'thin':
+            # the jobs only matter to the link, clang warns that they're
+            # unused when compiling
+            return ['-flto=thin'], ['-flto=thin', f'-flto-jobs={jobs}']
+        # full lto is optimized by a single thread
+        return ['-flto'], ['-flto']
+    if lto_jobs is None and get_compiler_identity(compiler).supports_lto_auto:
+        # gcc picks the number of jobs from the jobserver or the CPUs
+        flag = '-flto=auto'
+    else:
+        flag = f'-flto={jobs}'
+    return [flag], [flag]
+
+
+def _get_instrument_sources_flags(compiler, pgo_build_temp, include, exclude):
+    # returns the flags that instrument only the sources of an extension
+    # matching one of the include globs (or every source when there are none)
+    # and none of the exclude globs
+    #
+    # a relative glob matches the end of a path, so "src/*.c" matches the
+    # sources in any "src" directory however the path is given to the
+    # compiler
+    if is_clang(compiler):
+        # clang reads the globs from a file, which is named by its contents
+        # so that extensions built with different globs don't share objects
+        lines = [f'src:{glob}' for glob in _get_clang_globs(include or ['*'])]
+        lines.extend(f'!src:{glob}' for glob in _get_clang_globs(exclude))
+        contents = ''.join(f'{line}\n' for line in lines)
+        digest = hashlib.sha256(contents.encode('utf-8')).hexdigest()[:16]
+        profile_list = os.path.join(
+            pgo_build_temp,
+            '.pgo-profile-lists',
+            f'{digest}.txt'
         )
-        return out.stderr.startswith(b'clang:')
-    return False
+        if not os.path.exists(profile_list):
+            os.makedirs(os.path.dirname(profile_list), exist_ok=True)
+            with open(profile_list, 'w') as f:
+                f.write(contents)
+        return [f'-fprofile-list={os.path.abspath(profile_list)}']
+    # gcc takes POSIX regular expressions separated by semicolons
+    flags = []
+    if include:
+        flags.append(
+            '-fprofile-filter-files=' +
+            ';'.join(_glob_to_regex(glob) for glob in include)
+        )
+    if exclude:
+        flags.append(
+            '-fprofile-exclude-files=' +
+            ';'.join(_glob_to_regex(glob) for glob in exclude)
+        )
+    return flags
+
+
+def _get_clang_globs(globs):
+    # the globs of clang's special case lists match the whole path and their
+    # "*" matches "/"
+    for glob in globs:
+        glob = glob.replace('**', '*')
+        yield glob
+        if not os.path.isabs(glob) and not glob.startswith('*'):
+            yield f'*/{glob}'
+
+
+def _glob_to_regex(glob):
+    # "**" matches any part of a path, "*" and "?" don't match "/"
+    regex = []
+    i = 0
+    while i < len(glob):
+        if glob.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+        c = glob[i]
+        if c == '*':
+            regex.append('[^/]*')
+        elif c == '?':
+            regex.append('[^/]')
+        elif c in '.^$+(){}[]|\\':
+            regex.append(f'\\{c}')
+        else:
+            regex.append(c)
+        i += 1
+    if os.path.isabs(glob):
+        return '^' + ''.join(regex) + '$'
+    return '^(.*/)?' + ''.join(regex) + '$'
     
     
 def _get_pgd(rel_ext_path, pgo_build_lib):
     return os.path.join(pgo_build_lib, f'{rel_ext_path}.pgd')
     
     
-def _get_profdata_dir(pgo_build_temp):
-    return os.path.join(pgo_build_temp, '.pgo-profdatas')
+def _get_profdata_dir(pgo_build_temp, cs=False):
+    # the raw profiles of the context sensitive round are kept apart from the
+    # first round's
+    return os.path.join(
+        pgo_build_temp,
+        '.pgo-cs-profdatas' if cs else '.pgo-profdatas'
+    )
+    
+    
+def _get_profraw_dir(pgo_build_temp, extension_name, cs=False):
+    return os.path.join(_get_profdata_dir(pgo_build_temp, cs), extension_name)
     
     
-def _merge_profdata(dry_run, pgo_build_lib, pgo_build_temp, extension):
-    profdata = os.path.join(pgo_build_lib, f'.pgo-profdata-{extension.name}')
+def _get_workload_gcda_dir(pgo_build_temp, workload_name):
+    return os.path.join(pgo_build_temp, '.pgo-workloads', workload_name)
+    
+    
+def _get_gcov_prefix_strip(pgo_build_temp, relocated=False):
+    # the number of leading directories to strip from the absolute path of an
+    # object file so that GCOV_PREFIX replaces pgo_build_temp (or the root
+    # that relocated objects write their ".gcda" files under)
+    if relocated:
+        return len(PurePosixPath(_RELOCATED_GCDA_ROOT).parts) - 1
+    return len(Path(os.path.abspath(pgo_build_temp)).parts) - 1
+
+
+def _get_gcov_env(gcda_dir, pgo_build_temp, relocated=False):
+    # the environment that makes gcc's profile runtime write the ".gcda" files
+    # of the objects in pgo_build_temp to the same paths in gcda_dir
+    return {
+        "GCOV_PREFIX": os.path.abspath(gcda_dir),
+        "GCOV_PREFIX_STRIP": str(
+            _get_gcov_prefix_strip(pgo_build_temp, relocated)
+        ),
+    }
+
+
+def _relocates_gcda(compiler, object_cache, pgo_build_temp):
+    # gcc builds the path of the ".gcda" file into the instrumented object,
+    # the objects built with the object cache write theirs under
+    # _RELOCATED_GCDA_ROOT instead of pgo_build_temp so that they don't
+    # depend on where the checkout is, which gcc can only do for the objects
+    # it's given a relative path to
+    return (
+        bool(object_cache) and
+        not os.path.isabs(pgo_build_temp) and
+        not is_msvc(compiler) and
+        not is_clang(compiler) and
+        get_compiler_identity(compiler).supports_profile_prefix_path
+    )
+    
+    
+def _get_profdata(pgo_build_lib, extension, cs=False):
+    prefix = '.pgo-cs-profdata-' if cs else '.pgo-profdata-'
+    return os.path.join(pgo_build_lib, f'{prefix}{extension.name}')
+    
+    
+def _iter_profile_files(
+    compiler,
+    pgo_build_lib,
+    pgo_build_temp,
+    pgo_mode='instrument'
+):
+    # yields the (root, relative path) of each file that build_profile_use
+    # consumes to optimize the extensions
+    if pgo_mode == 'sample':
+        root = pgo_build_lib
+        prefixes = ('.pgo-sample-profile-',)
+        suffixes = None
+    elif is_msvc(compiler):
+        root = pgo_build_lib
+        suffixes = ('.pgd', '.pgc')
+    elif is_clang(compiler):
+        root = pgo_build_lib
+        prefixes = ('.pgo-profdata-', '.pgo-cs-profdata-')
+        suffixes = None
+    else:
+        root = pgo_build_temp
+        suffixes = ('.gcda',)
+    for dirpath, dirnames, files in os.walk(root):
+        # the unmerged profiles of each workload are not consumed
+        if '.pgo-workloads' in dirnames:
+            dirnames.remove('.pgo-workloads')
+        for file in files:
+            if suffixes is None:
+                if not file.startswith(prefixes):
+                    continue
+            elif not file.endswith(suffixes):
+                continue
+            yield root, os.path.relpath(os.path.join(dirpath, file), root)
+    
+    
+def _merge_profdata(
+    dry_run,
+    pgo_build_lib,
+    pgo_build_temp,
+    extension,
+    cs=False
+):
     if dry_run:
-        return profdata
-    # all of the clang profile data is built in the same directory without 
-    # any real distinguishing features
-    #
-    # this presents a problem when multiple extensions are being profiled,
-    # because we need to direct the extension to the profile data specifically
-    # belonging to it
-    #
-    # in order to figure that out we'll just import the instrumented extension,
-    # which should update the mtime of the profile data, then we know that the
-    # latest updated profile is the one for this extension
-    profdata_dir = _get_profdata_dir(pgo_build_temp)
-    try:
-        profraws = set(Path(profdata_dir).iterdir())
-    except FileNotFoundError:
-        profraws = set()
-    try:
-        _run_profile(
-            pgo_build_lib,
-            pgo_build_temp,
-            [sys.executable, '-c', f'import {extension.name}']
-        )
-    except ProfileError as ex:
-        raise ProfileUseError(ex)
-    try:
-        profraw = sorted(
-            Path(profdata_dir).iterdir(),
-            key=os.path.getmtime
-        )[-1]
-    except IndexError:
-        raise ProfileUseError(f'missing profile data for {extension.name}')
-    # it's possible there is a problem with the actual profiling script that
-    # prevents it from generating the profile data, so we might just be
-    # creating a dummy profraw, make sure it existed before we ran our little
-    # hack
-    if profraw not in profraws:
+        return _get_profdata(pgo_build_lib, extension, cs)
+    profdata = _get_profdata(pgo_build_lib, extension)
+    # each extension writes its ".profraw" files to its own directory, so
+    # everything in that directory belongs to this extension
+    profraw_dir = _get_profraw_dir(pgo_build_temp, extension.name, cs)
+    profraws = [
+        f'-weighted-input={weight},{profraw}'
+        for weight, profraw in _get_weighted_profraws(profraw_dir)
+    ]
+    if not profraws:
         raise ProfileUseError(f'missing profile data for {extension.name}')
+    # the context sensitive profile is combined with the first round's profile
+    # that it was built with
+    if cs:
+        profraws.append(profdata)
+        profdata = _get_profdata(pgo_build_lib, extension, cs)
     # llvm-profdata will merge our profraw data into the correct profdata file
     # we need
     llvm_profdata_merge = [
         'llvm-profdata', 'merge',
         f'-output={profdata}',
-        profraw
+        *profraws
     ]
     if sys.platform == 'darwin':
         # on macs the llvm-profdata command isn't normally on
         # the path, so run it through xcrun
         llvm_profdata_merge.insert(0, 'xcrun')
     try:
-        subprocess.run(llvm_profdata_merge, check=True)
-    except subprocess.CalledProcessError as ex:
+        _run_reported(
+            f'llvm-profdata {extension.name}',
+            'merge',
+            llvm_profdata_merge
+        )
+    except (OSError, subprocess.CalledProcessError) as ex:
         raise ProfileUseError(ex)
     return profdata
+    
+    
+def _is_llvm_profile(file):
+    # raw profiles and already merged (indexed) profiles can both be merged
+    return file.endswith(('.profraw', '.profdata'))
+    
+    
+def _get_weighted_profraws(profraw_dir):
+    # returns the (weight, path) of each profile in the directory, the
+    # profiles of weighted workloads are collected into a sub-directory per
+    # weight
+    profraws = []
+    for root, dirnames, files in os.walk(profraw_dir):
+        dirnames.sort()
+        if root == profraw_dir:
+            weight = 1
+        else:
+            try:
+                weight = int(os.path.basename(root)[len('weight-'):])
+            except ValueError:
+                weight = 1
+        for file in sorted(files):
+            if _is_llvm_profile(file):
+                profraws.append((weight, os.path.join(root, file)))
+    return profraws
+    
+    
+def _merge_profdatas(
+    dry_run,
+    pgo_build_lib,
+    pgo_build_temp,
+    extensions,
+    jobs,
+    cs=False
+):
+    # llvm-profdata only uses a single core for most of its work, so the
+    # merges for each extension are run side by side
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(
+                _merge_profdata,
+                dry_run,
+                pgo_build_lib,
+                pgo_build_temp,
+                extension,
+                cs
+            )
+            for extension in extensions
+        ]
+        return [future.result() for future in futures]
+
+
+def _clear_workload_profraws(pgo_build_temp, cs=False):
+    # raw profiles from previous runs would skew the weights of the workloads
+    profdata_dir = _get_profdata_dir(pgo_build_temp, cs)
+    try:
+        extension_names = os.listdir(profdata_dir)
+    except FileNotFoundError:
+        return
+    for extension_name in extension_names:
+        profraw_dir = os.path.join(profdata_dir, extension_name)
+        for name in os.listdir(profraw_dir):
+            path = os.path.join(profraw_dir, name)
+            if os.path.isdir(path):
+                remove_tree(path)
+            else:
+                os.remove(path)
+    
+    
+def _collect_workload_profraws(pgo_build_temp, weight, cs=False):
+    # moves the raw profiles written by the workloads of a weight into a
+    # sub-directory named after it so that they can be weighted when they're
+    # merged
+    profdata_dir = _get_profdata_dir(pgo_build_temp, cs)
+    try:
+        extension_names = os.listdir(profdata_dir)
+    except FileNotFoundError:
+        return
+    for extension_name in extension_names:
+        profraw_dir = os.path.join(profdata_dir, extension_name)
+        workload_dir = os.path.join(profraw_dir, f'weight-{weight}')
+        for name in os.listdir(profraw_dir):
+            if name.endswith('.profraw'):
+                os.makedirs(workload_dir, exist_ok=True)
+                os.replace(
+                    os.path.join(profraw_dir, name),
+                    os.path.join(workload_dir, name)
+                )
+    
+    
+def _merge_gcdas(pgo_build_temp, workloads):
+    # merges the ".gcda" trees written by each workload (see
+    # _get_workload_gcda_dir) into pgo_build_temp using their weights
+    workloads = [
+        (gcda_dir, weight)
+        for gcda_dir, weight in workloads
+        if os.path.isdir(gcda_dir)
+    ]
+    if not workloads:
+        return
+    with tempfile.TemporaryDirectory() as merge_dir:
+        # "gcov-tool merge" copies the files that only one of the trees has
+        # without applying its weight, so each tree is scaled by its weight
+        # on its own and the scaled trees are merged as they are
+        gcda_dirs = []
+        for i, (gcda_dir, weight) in enumerate(workloads):
+            if weight != 1:
+                scaled_dir = os.path.join(merge_dir, f'scaled-{i}')
+                _run_gcov_tool('rewrite', [
+                    '-s', str(weight),
+                    '-o', scaled_dir,
+                    gcda_dir
+                ])
+                gcda_dir = scaled_dir
+            gcda_dirs.append(gcda_dir)
+        merged_dir = gcda_dirs[0]
+        for i, gcda_dir in enumerate(gcda_dirs[1:]):
+            output_dir = os.path.join(merge_dir, f'merged-{i}')
+            _run_gcov_tool('merge', ['-o', output_dir, merged_dir, gcda_dir])
+            merged_dir = output_dir
+        for root, _, files in os.walk(merged_dir):
+            for file in files:
+                if not file.endswith('.gcda'):
+                    continue
+                target = os.path.join(
+                    pgo_build_temp,
+                    os.path.relpath(os.path.join(root, file), merged_dir)
+                )
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(os.path.join(root, file), target)
+    
+    
+def _run_gcov_tool(command, args):
+    try:
+        _run_reported('gcov-tool', command, ['gcov-tool', command, *args])
+    except (OSError, subprocess.CalledProcessError) as ex:
+        raise ProfileError(ex)
 
 
 @functools.cache
@@ -8,4 +8,16 @@ class ProfileError(DistutilsExecError):
 
 
 class ProfileUseError(DistutilsExecError):
+    pass
+
+
+class BoltError(DistutilsExecError):
+    pass
+
+
+class BenchmarkError(DistutilsExecError):
+    pass
+
+
+class ProfileCheckError(DistutilsExecError):
     pass
\ No newline at end of file
@@ -1,5 +1,7 @@
 
 # pgo
+from .benchmark import benchmark, make_build_ext_baseline
+from .bolt import build_ext_bolt
 from .build import make_build
 from .clean import make_clean
 from .install_lib import make_install_lib
@@ -7,22 +9,36 @@ from .profilegen import (
     clean_profile_generate,
     make_build_profile_generate,
     make_build_ext_profile_generate,
+    make_build_ext_profile_cs_generate,
     make_build_py_profile_generate,
 )
 from .profileuse import (
     make_build_profile_use,
     make_build_ext_profile_use,
 )
-from .profile import profile
+from .profile import profile, profile_cs
+from .profilearchive import profile_export
+from .profilecheck import profile_check
+from .profilereport import profile_report
 # setuptools
 from distutils.log import warn
 
 def pgo(dist, attr, value):
     assert attr == 'pgo'
-    if "profile_command" not in value:
+    if not any(
+        key in value
+        for key in (
+            "profile_command",
+            "profile_workloads",
+            "perf_data",
+            "profile_data",
+            "profile_archive",
+        )
+    ):
         warn(
-            '"pgo" option defined, but no "profile_command" -- '
-            'extensions will not be built with PGO'
+            '"pgo" option defined, but no "profile_command", '
+            '"profile_workloads", "perf_data", "profile_data" or '
+            '"profile_archive" -- extensions will not be built with PGO'
         )
         return
     # patch the build command to include PGO steps
@@ -34,10 +50,20 @@ def pgo(dist, attr, value):
     dist.cmdclass["build_profile_generate"] = make_build_profile_generate(build)
     dist.cmdclass["build_profile_use"] = make_build_profile_use(build)
     dist.cmdclass["build_ext_profile_generate"] = make_build_ext_profile_generate(build_ext)
+    dist.cmdclass["build_ext_profile_cs_generate"] = (
+        make_build_ext_profile_cs_generate(build_ext)
+    )
     dist.cmdclass["build_ext_profile_use"] = make_build_ext_profile_use(build_ext)
+    dist.cmdclass["build_ext_bolt"] = build_ext_bolt
+    dist.cmdclass["build_ext_baseline"] = make_build_ext_baseline(build_ext)
     dist.cmdclass["build_py_profile_generate"] = make_build_py_profile_generate(build_py)
     dist.cmdclass["clean"] = make_clean(clean)
     dist.cmdclass["clean_profile_generate"] = clean_profile_generate
     dist.cmdclass["install_lib"] = make_install_lib(install_lib)
     dist.cmdclass["profile"] = profile
+    dist.cmdclass["profile_cs"] = profile_cs
+    dist.cmdclass["profile_report"] = profile_report
+    dist.cmdclass["profile_check"] = profile_check
+    dist.cmdclass["profile_export"] = profile_export
+    dist.cmdclass["benchmark"] = benchmark
     dist.cmdclass["build"] = make_build(build)
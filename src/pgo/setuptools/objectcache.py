@@ -0,0 +1,282 @@
+
+__all__ = []
+
+# pgo
+from .compiler import (
+    _RELOCATED_GCDA_ROOT,
+    _relocates_gcda,
+    get_compiler_identity,
+    is_clang,
+    is_msvc,
+)
+import pgo
+# python
+import hashlib
+import json
+import os
+from pathlib import Path, PurePosixPath
+import re
+import shutil
+import subprocess
+import uuid
+# setuptools
+from distutils.ccompiler import gen_preprocess_options
+from distutils.log import info
+
+
+# the path in the line markers of preprocessed source, which are either
+# '# 1 "path" 1 3' (gcc and clang) or '#line 1 "path"' (msvc)
+_LINE_MARKER_PATH = re.compile(
+    rb'^(#(?:line)? \d+ )"(?:[^"\\]|\\.)*"',
+    re.MULTILINE
+)
+
+
+def _cache_compiler_objects(compiler, object_cache):
+    # makes the compiler restore the objects it would compile from the object
+    # cache when they're there, and store them when they're not
+    if getattr(compiler, '_pgo_object_cache', None) == object_cache:
+        return
+    compiler._pgo_object_cache = object_cache
+    compile = compiler.compile
+    def cached_compile(
+        sources,
+        output_dir=None,
+        macros=None,
+        include_dirs=None,
+        debug=0,
+        extra_preargs=None,
+        extra_postargs=None,
+        depends=None
+    ):
+        objects = compiler.object_filenames(sources, output_dir=output_dir)
+        uncached = []
+        for source, obj in zip(sources, objects):
+            key = _get_object_cache_key(
+                compiler,
+                object_cache,
+                source,
+                obj,
+                output_dir,
+                macros,
+                include_dirs,
+                debug,
+                extra_preargs,
+                extra_postargs
+            )
+            if key is None or not _restore_object(object_cache, key, obj):
+                uncached.append((source, obj, key))
+        if (
+            _relocates_gcda(compiler, object_cache, output_dir or os.curdir) and
+            '-fprofile-generate' in (extra_postargs or [])
+        ):
+            # the flags that relocate the ".gcda" file are different for each
+            # object, so they're compiled one at a time
+            batches = [
+                (
+                    [source],
+                    _get_gcda_relocation_flags(obj, output_dir)
+                )
+                for source, obj, _ in uncached
+            ]
+        elif uncached:
+            batches = [([source for source, _, _ in uncached], [])]
+        else:
+            batches = []
+        for batch_sources, flags in batches:
+            compile(
+                batch_sources,
+                output_dir=output_dir,
+                macros=macros,
+                include_dirs=include_dirs,
+                debug=debug,
+                extra_preargs=extra_preargs,
+                extra_postargs=[*(extra_postargs or []), *flags],
+                depends=depends
+            )
+        for _, obj, key in uncached:
+            if key is not None:
+                _store_object(object_cache, key, obj)
+        return objects
+    compiler.compile = cached_compile
+
+
+def _get_object_cache_key(
+    compiler,
+    object_cache,
+    source,
+    obj,
+    output_dir,
+    macros,
+    include_dirs,
+    debug,
+    extra_preargs,
+    extra_postargs
+):
+    # the key is a digest of the preprocessed source (so that changes to the
+    # headers it includes are seen) and every flag it's compiled with, the
+    # paths of the headers aren't part of the key and the paths of the source
+    # and the object are only as they're given to the compiler, so that the
+    # objects can be shared between checkouts that give them as relative
+    # paths
+    #
+    # returns None when the source can't be preprocessed, in which case the
+    # object is not cached
+    preprocessed = _preprocess(
+        compiler,
+        source,
+        macros,
+        include_dirs,
+        extra_preargs,
+        extra_postargs
+    )
+    if preprocessed is None:
+        return None
+    hash = hashlib.sha256()
+    def update(value):
+        hash.update(json.dumps(value, default=str).encode('utf-8'))
+    update(pgo.__version__)
+    update(get_compiler_identity(compiler))
+    update([
+        getattr(compiler, name, None)
+        for name in ('compiler_so', 'compile_options')
+    ])
+    update([debug, extra_preargs, extra_postargs])
+    # the functions that aren't exported are named (clang) or checksummed
+    # (gcc) with the paths of the source and the object
+    update([source, obj])
+    # gcc writes the ".gcda" file next to where the object was compiled to,
+    # so that path is built into the object, it's only the same for every
+    # checkout when the ".gcda" file is relocated
+    if (
+        not is_msvc(compiler) and
+        not is_clang(compiler) and
+        not _relocates_gcda(compiler, object_cache, output_dir or os.curdir)
+    ):
+        update(os.path.abspath(obj))
+    hash.update(preprocessed)
+    return hash.hexdigest()
+
+
+def _preprocess(
+    compiler,
+    source,
+    macros,
+    include_dirs,
+    extra_preargs,
+    extra_postargs
+):
+    _, macros, include_dirs = compiler._fix_compile_args(
+        None,
+        macros,
+        include_dirs
+    )
+    pp_opts = gen_preprocess_options(macros, include_dirs)
+    if is_msvc(compiler):
+        if not compiler.initialized:
+            compiler.initialize()
+        command = [
+            compiler.cc, '/nologo', '/E',
+            *pp_opts,
+            *(extra_preargs or []),
+            source,
+            *(extra_postargs or []),
+        ]
+    else:
+        command = [
+            *compiler.compiler_so,
+            *(extra_preargs or []),
+            *pp_opts,
+            '-E',
+            source,
+            *(extra_postargs or []),
+        ]
+    try:
+        preprocessed = subprocess.run(
+            command,
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    # the line numbers are built into the object (by its debug info and by
+    # the line checksums of its profile data), so the line markers are kept
+    # without the paths in them
+    return _LINE_MARKER_PATH.sub(rb'\1""', preprocessed)
+
+
+def _get_gcda_relocation_flags(obj, output_dir):
+    # gcc names the ".gcda" file by the path of the object (joined to its
+    # working directory) relative to "-fprofile-prefix-path" and puts it in
+    # "-fprofile-dir", which makes the path of the ".gcda" file relative to
+    # output_dir (pgo_build_temp) under _RELOCATED_GCDA_ROOT
+    obj_dir = os.path.join(_get_pwd(), os.path.dirname(obj))
+    rel_obj_dir = os.path.relpath(
+        os.path.abspath(obj_dir),
+        os.path.abspath(output_dir or os.curdir)
+    )
+    profile_dir = PurePosixPath(
+        _RELOCATED_GCDA_ROOT,
+        *Path(rel_obj_dir).parts
+    )
+    return [
+        f'-fprofile-dir={profile_dir}',
+        f'-fprofile-prefix-path={obj_dir}',
+    ]
+
+
+def _get_pwd():
+    # the working directory as gcc sees it, which is PWD (keeping any symbolic
+    # links in it) when that is the working directory
+    pwd = os.environ.get('PWD')
+    try:
+        if pwd and os.path.isabs(pwd) and os.path.samefile(pwd, os.curdir):
+            return pwd
+    except OSError:
+        pass
+    return os.getcwd()
+
+
+def _get_cached_object(object_cache, key):
+    return os.path.join(object_cache, key[:2], key)
+
+
+def _get_gcno(obj):
+    # gcc writes the ".gcno" coverage notes for the object next to it
+    return os.path.splitext(obj)[0] + '.gcno'
+
+
+def _restore_object(object_cache, key, obj):
+    cached_object = _get_cached_object(object_cache, key)
+    if not os.path.isfile(cached_object):
+        return False
+    info('restoring %s from the object cache', obj)
+    os.makedirs(os.path.dirname(obj) or '.', exist_ok=True)
+    shutil.copyfile(cached_object, obj)
+    if os.path.isfile(f'{cached_object}.gcno'):
+        shutil.copyfile(f'{cached_object}.gcno', _get_gcno(obj))
+    return True
+
+
+def _store_object(object_cache, key, obj):
+    cached_object = _get_cached_object(object_cache, key)
+    os.makedirs(os.path.dirname(cached_object), exist_ok=True)
+    # the notes are stored first, so that the object is never found without
+    # them
+    gcno = _get_gcno(obj)
+    if os.path.isfile(gcno):
+        _store_file(gcno, f'{cached_object}.gcno')
+    _store_file(obj, cached_object)
+
+
+def _store_file(file, cached_file):
+    # the file is copied under a temporary name and then moved into place so
+    # that a concurrent build never sees a partial file
+    staging = f'{cached_file}.tmp-{uuid.uuid4().hex}'
+    try:
+        shutil.copyfile(file, staging)
+        os.replace(staging, cached_file)
+    finally:
+        if os.path.exists(staging):
+            os.remove(staging)
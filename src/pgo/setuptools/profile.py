@@ -1,17 +1,57 @@
 
-__all__ = ['profile', 'ProfileError']
+__all__ = ['profile', 'profile_cs', 'ProfileError']
 
 # pgo
 from .command import PGO_BUILD_USER_OPTIONS
+from .compiler import (
+    _clear_workload_profraws,
+    _collect_workload_profraws,
+    _get_gcov_env,
+    _get_workload_gcda_dir,
+    _merge_gcdas,
+    _new_compiler,
+    _relocates_gcda,
+    is_clang,
+    is_msvc,
+)
 from .error import ProfileError
+from .report import _run_reported
+from .sample import (_check_sample_tools, _create_sample_profile,
+                     _get_perf_data_dir, _get_perf_record_command,
+                     _get_sample_profile)
 # python
+from concurrent.futures import ThreadPoolExecutor
+from importlib.machinery import PathFinder
 import os
+import re
 import subprocess
 import sys
 # setuptools
+from distutils.dir_util import remove_tree
+from distutils.errors import DistutilsOptionError, DistutilsSetupError
+from distutils.log import info, warn
 from setuptools import Command
 
 
+# the python run by a child interpreter to call each "module:function" entry
+# point given as an argument, one after the other, with the instrumented build
+# first on the path so that the sources in the working directory (which python
+# puts first) aren't imported instead
+_ENTRY_POINT_RUNNER = '''\
+import importlib
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.environ["PGO_BUILD_LIB"]))
+for entry_point in sys.argv[1:]:
+    module_name, _, qualname = entry_point.partition(":")
+    function = importlib.import_module(module_name)
+    for name in qualname.split("."):
+        function = getattr(function, name)
+    function()
+'''
+_ENTRY_POINT_PATTERN = re.compile(r'^\w+(\.\w+)*:\w+(\.\w+)*$')
+
+
 class profile(Command):
 
     description = 'generate profiling data for profile guided optimization'
@@ -22,42 +62,338 @@ class profile(Command):
             desc,
         )
         for name, value, desc in PGO_BUILD_USER_OPTIONS
+    ] + [
+        ('jobs=', 'j', 'number of profile workloads to run at once (defaults '
+                       'to the build pgo-jobs)'),
     ]
+    # the command that builds the instrumented extensions this profiles
+    build_ext_command = 'build_ext_profile_generate'
+    # whether this profiles the context sensitive round of clang's pgo
+    cs = False
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.profiled = False
+        # set when the profile data was restored from a cache instead of
+        # running the profile command
+        self.restored = False
 
     def initialize_options(self):
         self.profile_command = None
+        self.profile_workloads = None
         self.build_lib = None
         self.build_temp = None
+        self.jobs = None
+        self.pgo_mode = None
+        self.pgo_object_cache = None
+        self.perf_data = None
 
     def finalize_options(self):
         self.set_undefined_options('build_profile_generate',
             ('build_lib', 'build_lib'),
             ('build_temp', 'build_temp')
         )
-        self.profile_command = tuple(self.distribution.pgo["profile_command"])
+        self.set_undefined_options('build',
+            ('pgo_jobs', 'jobs'),
+            ('pgo_mode', 'pgo_mode'),
+            ('pgo_object_cache', 'pgo_object_cache'),
+            ('pgo_perf_data', 'perf_data'),
+        )
+        try:
+            self.jobs = int(self.jobs)
+        except ValueError:
+            self.jobs = 0
+        if self.jobs < 1:
+            raise DistutilsOptionError('--jobs must be a positive integer')
+        self.profile_workloads = _get_profile_workloads(self.distribution.pgo)
+        if "profile_command" in self.distribution.pgo:
+            self.profile_command = _get_profile_command(
+                self.distribution.pgo["profile_command"]
+            )
+        if self.perf_data and self.pgo_mode != 'sample':
+            raise DistutilsOptionError(
+                'perf data can only be used with --pgo-mode=sample'
+            )
+        if not self.profile_workloads and not self.perf_data:
+            raise DistutilsSetupError(
+                '"pgo" must define "profile_command" or "profile_workloads"'
+            )
 
     def run(self):
         if self.dry_run:
             return
         # skip running the profile if we've ran build_ext_profile_generate and
         # it didn't do anything
-        if self.distribution.have_run.get('build_ext_profile_generate'):
+        if self.distribution.have_run.get(self.build_ext_command):
             build_ext = self.distribution.get_command_obj(
-                'build_ext_profile_generate'
+                self.build_ext_command
             )
             if not build_ext.did_build():
                 return
             
-        _run_profile(self.build_lib, self.build_temp, self.profile_command)
+        if self.pgo_mode == 'sample':
+            self._run_profile_sample()
+        elif self.profile_command is not None:
+            build_ext = self.get_finalized_command(self.build_ext_command)
+            compiler = _new_compiler(build_ext.compiler)
+            env = {}
+            if _relocates_gcda(
+                compiler,
+                self.pgo_object_cache,
+                self.build_temp
+            ):
+                env = _get_gcov_env(self.build_temp, self.build_temp, True)
+            _run_profile(
+                self.build_lib,
+                self.build_temp,
+                self.profile_command,
+                env
+            )
+        else:
+            self._run_profile_workloads()
         self.profiled = True
+        
+    def _run_profile_sample(self):
+        build_ext = self.get_finalized_command(self.build_ext_command)
+        compiler = _new_compiler(build_ext.compiler)
+        _check_sample_tools(
+            compiler,
+            bool(self.profile_workloads),
+            len(self.perf_data) + len(self.profile_workloads) > 1
+        )
+        for perf_data in self.perf_data:
+            if not os.path.isfile(perf_data):
+                raise ProfileError(f'perf data {perf_data} does not exist')
+        # each workload is recorded to its own perf data, next to any perf
+        # data that was collected elsewhere
+        perf_data_dir = _get_perf_data_dir(self.build_temp)
+        if os.path.exists(perf_data_dir):
+            remove_tree(perf_data_dir)
+        os.makedirs(perf_data_dir)
+        perf_datas = [(perf_data, 1) for perf_data in self.perf_data]
+        profiles = []
+        for i, (name, weight, profile_command) in enumerate(
+            self.profile_workloads
+        ):
+            perf_data = os.path.join(perf_data_dir, f'{i}.data')
+            perf_datas.append((perf_data, weight))
+            profiles.append((
+                name,
+                _get_perf_record_command(perf_data, profile_command),
+                {}
+            ))
+        _run_profiles(self.build_lib, self.build_temp, profiles, self.jobs)
+        ignore_extensions = self.distribution.pgo.get("ignore_extensions", [])
+        for ext in build_ext.extensions:
+            if ext.name in ignore_extensions:
+                continue
+            _create_sample_profile(
+                compiler,
+                build_ext.get_ext_fullpath(ext.name),
+                perf_datas,
+                _get_sample_profile(self.build_lib, ext)
+            )
+        
+    def _run_profile_workloads(self):
+        build_ext = self.get_finalized_command(self.build_ext_command)
+        compiler = _new_compiler(build_ext.compiler)
+        if is_msvc(compiler):
+            # the pgc files written by the runtime can't be told apart, nor is
+            # the runtime safe to run from several processes at once
+            warn('workload weights are not supported by msvc, ignoring them')
+            for name, weight, profile_command in self.profile_workloads:
+                info('running profile workload %s', name)
+                _run_profile(self.build_lib, self.build_temp, profile_command)
+        elif is_clang(compiler):
+            # the raw profiles are merged online by the profile runtime, which
+            # is safe to do from several processes, but the workloads of each
+            # weight must be run apart from the others so that their raw
+            # profiles can be collected for weighting
+            _clear_workload_profraws(self.build_temp, self.cs)
+            weights = {}
+            for name, weight, profile_command in self.profile_workloads:
+                weights.setdefault(weight, []).append((name, profile_command))
+            for weight, workloads in weights.items():
+                _run_profiles(
+                    self.build_lib,
+                    self.build_temp,
+                    [
+                        (name, profile_command, {})
+                        for name, profile_command in workloads
+                    ],
+                    self.jobs
+                )
+                _collect_workload_profraws(self.build_temp, weight, self.cs)
+        else:
+            # each workload writes its gcda files to its own tree, so they can
+            # all run at once, the trees are then merged into the build
+            # directory with their weights
+            relocated = _relocates_gcda(
+                compiler,
+                self.pgo_object_cache,
+                self.build_temp
+            )
+            gcda_dirs = []
+            profiles = []
+            for name, weight, profile_command in self.profile_workloads:
+                gcda_dir = _get_workload_gcda_dir(self.build_temp, name)
+                if os.path.exists(gcda_dir):
+                    remove_tree(gcda_dir)
+                profiles.append((name, profile_command, _get_gcov_env(
+                    gcda_dir,
+                    self.build_temp,
+                    relocated
+                )))
+                gcda_dirs.append((gcda_dir, weight))
+            _run_profiles(
+                self.build_lib,
+                self.build_temp,
+                profiles,
+                self.jobs
+            )
+            _merge_gcdas(self.build_temp, gcda_dirs)
+
+
+class profile_cs(profile):
+
+    description = (
+        'generate context sensitive profiling data for profile guided '
+        'optimization'
+    )
+    build_ext_command = 'build_ext_profile_cs_generate'
+    cs = True
+
+
+def _get_profile_workloads(pgo):
+    # returns a list of (name, weight, profile command) for each workload that
+    # should be run, a plain "profile_command" is a single unnamed workload
+    if "profile_command" not in pgo and "profile_workloads" not in pgo:
+        return []
+    if "profile_command" in pgo:
+        if "profile_workloads" in pgo:
+            raise DistutilsSetupError(
+                '"pgo" may define "profile_command" or "profile_workloads", '
+                'but not both'
+            )
+        return [(None, 1, _get_profile_command(pgo["profile_command"]))]
+    workloads = []
+    for name, workload in pgo["profile_workloads"].items():
+        if not isinstance(name, str) or not re.match(r'^[\w.-]+$', name):
+            raise DistutilsSetupError(
+                f'profile workload name {name!r} must only contain letters, '
+                f'digits, "_", "." and "-"'
+            )
+        try:
+            profile_command = _get_profile_command(
+                workload["profile_command"],
+                name
+            )
+        except (KeyError, TypeError):
+            raise DistutilsSetupError(
+                f'profile workload {name!r} must define a "profile_command"'
+            )
+        weight = workload.get("weight", 1)
+        if (
+            not isinstance(weight, int) or
+            isinstance(weight, bool) or
+            weight < 1
+        ):
+            raise DistutilsSetupError(
+                f'profile workload {name!r} weight must be a positive integer'
+            )
+        workloads.append((name, weight, profile_command))
+    if not workloads:
+        raise DistutilsSetupError('"profile_workloads" must not be empty')
+    return workloads
+
+
+def _get_profile_command(profile_command, workload_name=None):
+    # a profile command is either the arguments of the command to run or a
+    # string of "module:function" entry points separated by whitespace, which
+    # are all called by the same python process so that they share its
+    # startup and imports
+    if not isinstance(profile_command, str):
+        return tuple(profile_command)
+    entry_points = profile_command.split()
+    if not entry_points or not all(
+        _ENTRY_POINT_PATTERN.match(entry_point)
+        for entry_point in entry_points
+    ):
+        if workload_name is None:
+            name = '"profile_command"'
+        else:
+            name = f'profile workload {workload_name!r} "profile_command"'
+        raise DistutilsSetupError(
+            f'{name} must be a list of arguments or a string of '
+            f'"module:function" entry points'
+        )
+    return (sys.executable, '-c', _ENTRY_POINT_RUNNER, *entry_points)
+
+
+def _get_entry_points(profile_command):
+    # the entry points called by a profile command from _get_profile_command,
+    # or an empty list if it's the arguments of some other command
+    if tuple(profile_command[1:3]) == ('-c', _ENTRY_POINT_RUNNER):
+        return list(profile_command[3:])
+    return []
+
+
+def _find_entry_point_file(entry_point):
+    # the file of the module an entry point is in, found without importing it
+    # (or its packages) relative to the working directory, which is where the
+    # profile command is run from
+    path = [os.getcwd()]
+    spec = None
+    for name in entry_point.partition(':')[0].split('.'):
+        if path is None:
+            return None
+        spec = PathFinder.find_spec(name, path)
+        if spec is None:
+            return None
+        path = spec.submodule_search_locations
+    if spec.origin is None or not os.path.isfile(spec.origin):
+        return None
+    return spec.origin
+
+
+def _format_profile_command(profile_command):
+    entry_points = _get_entry_points(profile_command)
+    if entry_points:
+        return ' '.join(entry_points)
+    return ' '.join(profile_command)
+
+        
+def _run_profiles(build_lib, build_temp, profiles, jobs):
+    # each profile command runs in its own process, so threads are enough
+    # to run them side by side
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for name, profile_command, env in profiles:
+            info('running profile workload %s', name)
+            futures.append(executor.submit(
+                _run_profile,
+                build_lib,
+                build_temp,
+                profile_command,
+                env
+            ))
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
 
         
-def _run_profile(build_lib, build_temp, profile_command):
-    env = dict(os.environ)
+def _run_profile(
+    build_lib,
+    build_temp,
+    profile_command,
+    env={},
+    category='profile'
+):
+    env = {**os.environ, **env}
     env["PGO_BUILD_LIB"] = build_lib
     env["PGO_BUILD_TEMP"] = build_temp
     env["PGO_PYTHON"] = sys.executable
@@ -71,15 +407,15 @@ def _run_profile(build_lib, build_temp, profile_command):
     env["PYTHONPATH"] = os.pathsep.join(python_path)
     
     try:
-        subprocess.run(profile_command, check=True, env=env)
+        _run_reported(category, category, profile_command, env=env)
     except FileNotFoundError as ex:
         raise ProfileError(
-            f'Profile command ({" ".join(profile_command)}) '
+            f'Profile command ({_format_profile_command(profile_command)}) '
             f'failed, the command could not be found'
         )
     except subprocess.CalledProcessError as ex:
         raise ProfileError(
-            f'Profile command ({" ".join(profile_command)}) '
+            f'Profile command ({_format_profile_command(profile_command)}) '
             f'exited with error: {ex.returncode}'
         )
 
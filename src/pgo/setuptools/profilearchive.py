@@ -0,0 +1,358 @@
+
+__all__ = ['profile_export']
+
+# pgo
+from .command import PGO_BUILD_USER_OPTIONS
+from .compiler import (get_compiler_identity, is_clang, is_msvc,
+                       _get_profdata, _merge_profdata, _new_compiler)
+from .error import ProfileError, ProfileUseError
+import pgo
+# python
+import hashlib
+import json
+import os
+import sysconfig
+import zipfile
+# setuptools
+from distutils.errors import DistutilsOptionError, DistutilsPlatformError
+from distutils.log import info, warn
+from setuptools import Command
+
+
+# the version of the layout of the archive, archives with a newer format than
+# this can't be imported
+PROFILE_ARCHIVE_FORMAT = 1
+PROFILE_ARCHIVE_METADATA = 'pgo-profile.json'
+
+
+class profile_export(Command):
+
+    description = (
+        'package the merged profile of each extension into an archive that '
+        'can be imported by builds on other hosts'
+    )
+    user_options = [
+        (
+            name[len("pgo-"):] if name.startswith('pgo-') else name,
+            value,
+            desc,
+        )
+        for name, value, desc in PGO_BUILD_USER_OPTIONS
+    ] + [
+        ('output=', 'o', 'file to write the profile archive to'),
+    ]
+
+    def initialize_options(self):
+        self.output = None
+        self.build_lib = None
+        self.build_temp = None
+        self.pgo_mode = None
+
+    def finalize_options(self):
+        self.set_undefined_options('build_profile_generate',
+            ('build_lib', 'build_lib'),
+            ('build_temp', 'build_temp')
+        )
+        self.set_undefined_options('build', ('pgo_mode', 'pgo_mode'))
+        if self.output is None:
+            self.output = self.distribution.pgo.get("profile_export_output")
+        if not self.output:
+            raise DistutilsOptionError(
+                '--output (or "profile_export_output" in "pgo") must name '
+                'the profile archive to write'
+            )
+        if self.pgo_mode != 'instrument':
+            raise DistutilsOptionError(
+                'profile archives can only be exported with '
+                '--pgo-mode=instrument'
+            )
+
+    def run(self):
+        build_ext = self.get_finalized_command('build_ext_profile_generate')
+        compiler = _new_compiler(build_ext.compiler)
+        if is_msvc(compiler):
+            raise DistutilsPlatformError(
+                'exporting profile data is not supported by msvc'
+            )
+        self.run_command('build_profile_generate')
+        self.run_command('profile')
+        if self.dry_run:
+            return
+        ignore_extensions = self.distribution.pgo.get("ignore_extensions", [])
+        _export_profile_archive(
+            compiler,
+            self.output,
+            self.build_lib,
+            self.build_temp,
+            [
+                ext for ext in build_ext.extensions
+                if ext.name not in ignore_extensions
+            ]
+        )
+
+
+def _export_profile_archive(
+    compiler,
+    archive,
+    pgo_build_lib,
+    pgo_build_temp,
+    extensions
+):
+    # the archive has the merged profile of each extension along with the
+    # metadata needed to tell whether it can be used by another build
+    #
+    # for clang each extension's indexed profile is at "<name>/<name>.profdata"
+    # and for gcc each ".gcda" file is at its path relative to pgo_build_temp,
+    # which is how profile data directories are laid out (see
+    # _import_profile_data)
+    files = []
+    if is_clang(compiler):
+        for ext in extensions:
+            profdata = _get_profdata(pgo_build_lib, ext)
+            if not os.path.exists(profdata):
+                try:
+                    profdata = _merge_profdata(
+                        False,
+                        pgo_build_lib,
+                        pgo_build_temp,
+                        ext
+                    )
+                except ProfileUseError as ex:
+                    raise ProfileError(str(ex))
+            files.append((profdata, f'{ext.name}/{ext.name}.profdata'))
+    else:
+        for ext in extensions:
+            # objects without any instrumented functions have no ".gcda"
+            # file
+            gcdas = [
+                os.path.splitext(obj)[0] + '.gcda'
+                for obj in compiler.object_filenames(
+                    ext.sources,
+                    output_dir=pgo_build_temp
+                )
+            ]
+            if not any(os.path.exists(gcda) for gcda in gcdas):
+                raise ProfileError(
+                    f'missing profile data for {ext.name} ({gcdas[0]})'
+                )
+            files.extend(
+                (
+                    gcda,
+                    _to_archive_path(os.path.relpath(gcda, pgo_build_temp))
+                )
+                for gcda in gcdas
+                if os.path.exists(gcda)
+            )
+    identity = get_compiler_identity(compiler)
+    metadata = {
+        "format": PROFILE_ARCHIVE_FORMAT,
+        "pgo_version": pgo.__version__,
+        "compiler": {
+            "vendor": identity.vendor,
+            "version": identity.version,
+        },
+        "python_abi": _get_python_abi(),
+        "pgo_build_temp": _get_portable_build_temp(pgo_build_temp),
+        "extensions": {
+            ext.name: {
+                "sources": _get_source_digests(ext),
+                "source_paths": _get_source_paths(ext),
+            }
+            for ext in extensions
+        },
+    }
+    info('writing profile archive to %s', archive)
+    os.makedirs(os.path.dirname(os.path.abspath(archive)), exist_ok=True)
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as f:
+        f.writestr(PROFILE_ARCHIVE_METADATA, json.dumps(metadata, indent=4))
+        for path, archive_path in files:
+            f.write(path, archive_path)
+
+
+def _extract_profile_archive(
+    compiler,
+    archive,
+    pgo_build_temp,
+    extensions,
+    target_dir,
+    local
+):
+    # extracts the profile archive into target_dir as a profile data
+    # directory for _import_profile_data, after checking that it was exported
+    # by a build that it can be used for
+    #
+    # the paths in the archive are relative to the build directory they were
+    # exported from, so they're moved to this build's directory by importing
+    # them into it
+    try:
+        f = zipfile.ZipFile(archive)
+    except (OSError, zipfile.BadZipFile) as ex:
+        raise ProfileUseError(f'unable to read profile archive {archive}: {ex}')
+    with f:
+        try:
+            metadata = json.loads(f.read(PROFILE_ARCHIVE_METADATA))
+        except (KeyError, ValueError):
+            raise ProfileUseError(f'{archive} is not a profile archive')
+        if metadata.get("format", 0) > PROFILE_ARCHIVE_FORMAT:
+            raise ProfileUseError(
+                f'{archive} has a newer format than this version of pgo '
+                f'supports, upgrade pgo to import it'
+            )
+        members = [
+            (archive_path, _get_archive_member_target(
+                archive,
+                archive_path,
+                target_dir,
+                metadata["extensions"]
+            ))
+            for archive_path in f.namelist()
+            if archive_path != PROFILE_ARCHIVE_METADATA
+        ]
+        identity = get_compiler_identity(compiler)
+        if metadata["compiler"]["vendor"] != identity.vendor:
+            raise ProfileUseError(
+                f'{archive} was exported by {metadata["compiler"]["vendor"]} '
+                f'and cannot be used by {identity.vendor}'
+            )
+        if (
+            metadata["compiler"]["version"] is not None and
+            identity.version is not None and
+            tuple(metadata["compiler"]["version"]) != tuple(identity.version)
+        ):
+            warn(
+                f'{archive} was exported by {identity.vendor} '
+                f'{_format_version(metadata["compiler"]["version"])}, not '
+                f'{_format_version(identity.version)}'
+            )
+        if metadata["python_abi"] != _get_python_abi():
+            warn(
+                f'{archive} was exported for {metadata["python_abi"]}, not '
+                f'{_get_python_abi()}'
+            )
+        # gcc checksums the functions of an object with the path the object
+        # was compiled to, which is only the same for another checkout or
+        # host when the build directory is relative, and the profile data is
+        # laid out by that path, so there's no moving it to another one
+        if not is_clang(compiler) and (
+            metadata["pgo_build_temp"] is None or
+            metadata["pgo_build_temp"] !=
+            _get_portable_build_temp(pgo_build_temp)
+        ):
+            raise ProfileUseError(
+                f'{archive} was exported from a different --pgo-build-temp '
+                f'({metadata["pgo_build_temp"] or "an absolute path"}), gcc '
+                f'will not match its profile data to the functions, export it '
+                f'with the same relative --pgo-build-temp'
+            )
+        for ext in extensions:
+            try:
+                exported = metadata["extensions"][ext.name]
+            except KeyError:
+                if local:
+                    continue
+                raise ProfileUseError(
+                    f'{archive} has no profile data for {ext.name}'
+                )
+            # the compilers name (gcc) or checksum (clang and gcc) the
+            # functions that aren't exported by the path of their source as
+            # it's given to the compiler, which is only the same for another
+            # checkout or host when the sources are given as relative paths
+            source_paths = _get_source_paths(ext)
+            if exported.get("source_paths", source_paths) != source_paths:
+                raise ProfileUseError(
+                    f'{archive} was exported with the sources of {ext.name} '
+                    f'at other paths '
+                    f'({", ".join(exported["source_paths"])}), the compiler '
+                    f'will not match its profile data to the functions, give '
+                    f'the sources as paths relative to the project'
+                )
+            digests = _get_source_digests(ext)
+            changed = sorted(
+                path
+                for path, digest in digests.items()
+                if exported["sources"].get(path) != digest
+            )
+            if changed:
+                warn(
+                    f'the sources of {ext.name} changed since {archive} was '
+                    f'exported ({", ".join(changed)}), its profile data may '
+                    f'be stale'
+                )
+        info('importing profile archive %s', archive)
+        for archive_path, target in members:
+            if target is None:
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as target_f:
+                target_f.write(f.read(archive_path))
+
+
+def _get_archive_member_target(archive, archive_path, target_dir, extensions):
+    # the path that a member of the archive is extracted to, archives come
+    # from other hosts so a member must not be written outside of target_dir
+    #
+    # only the profile data laid out by _export_profile_archive is extracted,
+    # anything else (such as directories) is skipped
+    parts = archive_path.replace('\\', '/').split('/')
+    if (
+        archive_path.startswith(('/', '\\')) or
+        os.path.splitdrive(archive_path)[0] or
+        ':' in parts[0] or
+        os.pardir in parts
+    ):
+        raise ProfileUseError(
+            f'{archive} has a member outside of the archive ({archive_path})'
+        )
+    if not parts[-1] or not (
+        archive_path.endswith('.gcda') or
+        (parts[0] in extensions and archive_path.endswith('.profdata'))
+    ):
+        return None
+    target_dir = os.path.abspath(target_dir)
+    target = os.path.normpath(os.path.join(target_dir, *parts))
+    if os.path.commonpath([target_dir, target]) != target_dir:
+        raise ProfileUseError(
+            f'{archive} has a member outside of the archive ({archive_path})'
+        )
+    return target
+
+
+def _get_source_digests(extension):
+    # the sha256 of each source and dependency of the extension, by its path
+    # relative to the project so that checkouts elsewhere compare equal
+    digests = {}
+    for path in (*extension.sources, *extension.depends):
+        try:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            digest = None
+        rel_path = os.path.relpath(os.path.abspath(path))
+        if rel_path.startswith(os.pardir):
+            rel_path = path
+        digests[_to_archive_path(rel_path)] = digest
+    return digests
+
+
+def _get_source_paths(extension):
+    # the paths of the extension's sources as they're given to the compiler
+    return [_to_archive_path(path) for path in extension.sources]
+
+
+def _get_portable_build_temp(pgo_build_temp):
+    # an absolute build directory is particular to this checkout
+    if os.path.isabs(pgo_build_temp):
+        return None
+    return _to_archive_path(os.path.normpath(pgo_build_temp))
+
+
+def _get_python_abi():
+    return sysconfig.get_config_var('EXT_SUFFIX')
+
+
+def _format_version(version):
+    return '.'.join(str(v) for v in version)
+
+
+def _to_archive_path(path):
+    return path.replace(os.sep, '/')
@@ -0,0 +1,160 @@
+
+__all__ = []
+
+# pgo
+from .compiler import get_compiler_identity, _iter_profile_files
+from .profile import (_find_entry_point_file, _get_entry_points,
+                      _get_profile_workloads)
+import pgo
+# python
+import hashlib
+import json
+import os
+import shutil
+import sys
+import sysconfig
+import uuid
+# setuptools
+from distutils.log import info
+
+
+def _get_profile_cache_key(
+    distribution,
+    compiler,
+    pgo_build_lib,
+    pgo_build_temp,
+    pgo_mode,
+    perf_data,
+    build_options
+):
+    # the key is a digest of everything that could change the profile data:
+    # the extension sources and flags, the compiler and the profile command
+    #
+    # build_options are the resolved build options that change how the
+    # extensions are instrumented (such as --pgo-lto), since they may come
+    # from the command line rather than the "pgo" setup keyword
+    #
+    # gcc identifies some functions in its profile data by the path of the
+    # object file they were compiled to, so the build directories are part
+    # of the key as well
+    hash = hashlib.sha256()
+    def update(value):
+        hash.update(json.dumps(value, default=str).encode('utf-8'))
+    def update_file(path):
+        try:
+            with open(path, 'rb') as f:
+                hash.update(f.read())
+        except OSError:
+            update(None)
+    update(pgo.__version__)
+    update(pgo_mode)
+    update(sorted(build_options.items()))
+    update([os.path.abspath(pgo_build_lib), os.path.abspath(pgo_build_temp)])
+    update(sys.implementation.cache_tag)
+    update(sysconfig.get_config_var('EXT_SUFFIX'))
+    update(get_compiler_identity(compiler))
+    update([
+        getattr(compiler, name, None)
+        for name in ('compiler_so', 'linker_so')
+    ])
+    update(sorted(distribution.pgo.items()))
+    for ext in distribution.ext_modules or []:
+        update([
+            ext.name,
+            ext.sources,
+            ext.depends,
+            ext.define_macros,
+            ext.undef_macros,
+            ext.include_dirs,
+            ext.libraries,
+            ext.library_dirs,
+            ext.extra_compile_args,
+            ext.extra_link_args,
+        ])
+        for path in (*ext.sources, *ext.depends):
+            update_file(path)
+    # any argument of a profile command that is a file (such as the script
+    # being run) is considered part of the command, as is the program itself
+    # when it's a script rather than an interpreter (whose version is already
+    # part of the key)
+    for _, _, profile_command in _get_profile_workloads(distribution.pgo):
+        for i, arg in enumerate(profile_command):
+            if not isinstance(arg, str) or not os.path.isfile(arg):
+                continue
+            if i > 0 or _is_script(arg):
+                update_file(arg)
+        # as is the module of each entry point
+        for entry_point in _get_entry_points(profile_command):
+            entry_point_file = _find_entry_point_file(entry_point)
+            if entry_point_file is not None:
+                update_file(entry_point_file)
+    for path in perf_data:
+        update_file(path)
+    return hash.hexdigest()
+
+
+def _is_script(path):
+    # whether the file runs through an interpreter named by its "#!" line
+    try:
+        with open(path, 'rb') as f:
+            return f.read(2) == b'#!'
+    except (OSError, TypeError):
+        return False
+
+
+def _restore_profile_cache(profile_cache, key, pgo_build_lib, pgo_build_temp):
+    entry = os.path.join(profile_cache, key)
+    if not os.path.isdir(entry):
+        return False
+    info('restoring profile data from %s', entry)
+    for name, target in (('lib', pgo_build_lib), ('temp', pgo_build_temp)):
+        source = os.path.join(entry, name)
+        for dirpath, _, files in os.walk(source):
+            target_dirpath = os.path.join(
+                target,
+                os.path.relpath(dirpath, source)
+            )
+            os.makedirs(target_dirpath, exist_ok=True)
+            for file in files:
+                shutil.copyfile(
+                    os.path.join(dirpath, file),
+                    os.path.join(target_dirpath, file)
+                )
+    return True
+
+
+def _store_profile_cache(
+    profile_cache,
+    key,
+    compiler,
+    pgo_build_lib,
+    pgo_build_temp,
+    pgo_mode
+):
+    entry = os.path.join(profile_cache, key)
+    if os.path.isdir(entry):
+        return
+    info('storing profile data in %s', entry)
+    # the entry is built under a temporary name and then moved into place so
+    # that a concurrent build never sees a partial entry
+    staging = os.path.join(profile_cache, f'.tmp-{uuid.uuid4().hex}')
+    try:
+        for root, path in _iter_profile_files(
+            compiler,
+            pgo_build_lib,
+            pgo_build_temp,
+            pgo_mode
+        ):
+            name = 'lib' if root == pgo_build_lib else 'temp'
+            target = os.path.join(staging, name, path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(os.path.join(root, path), target)
+        os.makedirs(staging, exist_ok=True)
+        try:
+            os.replace(staging, entry)
+        except OSError:
+            # another build stored the same entry first
+            if not os.path.isdir(entry):
+                raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
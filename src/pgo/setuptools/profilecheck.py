@@ -0,0 +1,390 @@
+
+__all__ = ['profile_check', 'ProfileCheckError']
+
+# pgo
+from .command import PGO_BUILD_USER_OPTIONS
+from .compiler import (is_clang, is_msvc, _get_gcov_env, _is_llvm_profile,
+                       _new_compiler, _relocates_gcda)
+from .error import ProfileCheckError, ProfileError
+from .profile import (_get_profile_command, _get_profile_workloads,
+                      _run_profiles)
+from .profilereport import _read_gcda_counters
+# python
+import json
+import os
+import re
+import subprocess
+import sys
+# setuptools
+from distutils.dir_util import remove_tree
+from distutils.errors import DistutilsOptionError
+from distutils.log import info, warn
+from setuptools import Command
+
+
+class profile_check(Command):
+
+    description = (
+        'check that stored profile data still matches the extensions by '
+        'comparing it with a fresh profile'
+    )
+    user_options = [
+        (
+            name[len("pgo-"):] if name.startswith('pgo-') else name,
+            value,
+            desc,
+        )
+        for name, value, desc in PGO_BUILD_USER_OPTIONS
+    ] + [
+        ('profile-data-dir=', None, 'directories of the stored raw profile '
+                                    'data (separated by os.pathsep, defaults '
+                                    'to the build pgo-profile-data-dir)'),
+        ('threshold=', 't', 'minimum overlap of the stored and fresh profile '
+                            'of each extension (default 0.9)'),
+        ('output=', 'o', 'write the results as json to this file'),
+        ('jobs=', 'j', 'number of profile workloads to run at once (defaults '
+                       'to the build pgo-jobs)'),
+    ]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the overlap and the number of mismatched functions of each
+        # extension, as written to the json results
+        self.extension_checks = []
+
+    def initialize_options(self):
+        self.profile_data_dir = None
+        self.threshold = None
+        self.output = None
+        self.jobs = None
+        self.build_lib = None
+        self.build_temp = None
+        self.pgo_object_cache = None
+
+    def finalize_options(self):
+        self.set_undefined_options('build_profile_generate',
+            ('build_lib', 'build_lib'),
+            ('build_temp', 'build_temp')
+        )
+        self.set_undefined_options('build',
+            ('pgo_jobs', 'jobs'),
+            ('pgo_object_cache', 'pgo_object_cache'),
+            ('pgo_profile_data_dir', 'profile_data_dir'),
+        )
+        if isinstance(self.profile_data_dir, str):
+            self.profile_data_dir = self.profile_data_dir.split(os.pathsep)
+        self.profile_data_dir = list(self.profile_data_dir)
+        if not self.profile_data_dir:
+            raise DistutilsOptionError(
+                '--profile-data-dir (or "profile_data" in "pgo") must name '
+                'the stored profile data to check'
+            )
+        pgo = self.distribution.pgo
+        if self.threshold is None:
+            self.threshold = pgo.get("profile_check_threshold", 0.9)
+        try:
+            self.threshold = float(self.threshold)
+            if not 0 <= self.threshold <= 1:
+                raise ValueError()
+        except ValueError:
+            raise DistutilsOptionError(
+                '--threshold must be a number from 0 to 1'
+            )
+        if self.output is None:
+            self.output = pgo.get("profile_check_output")
+        try:
+            self.jobs = int(self.jobs)
+        except ValueError:
+            self.jobs = 0
+        if self.jobs < 1:
+            raise DistutilsOptionError('--jobs must be a positive integer')
+        # a quicker command than the full profile may be run for the check
+        if "profile_check_command" in pgo:
+            self.profile_commands = [
+                (None, _get_profile_command(pgo["profile_check_command"]))
+            ]
+        else:
+            self.profile_commands = [
+                (name, profile_command)
+                for name, _, profile_command
+                in _get_profile_workloads(pgo)
+            ]
+
+    def run(self):
+        if self.dry_run:
+            return
+        build_ext = self.get_finalized_command('build_ext_profile_generate')
+        compiler = _new_compiler(build_ext.compiler)
+        if is_msvc(compiler):
+            warn('profile checks are not supported by msvc')
+            return
+        for profile_data_dir in self.profile_data_dir:
+            if not os.path.isdir(profile_data_dir):
+                raise ProfileCheckError(
+                    f'profile data directory {profile_data_dir} does not exist'
+                )
+        self.run_command('build_profile_generate')
+        check_dir = os.path.join(self.build_temp, '.pgo-check')
+        if os.path.exists(check_dir):
+            remove_tree(check_dir)
+        os.makedirs(check_dir)
+
+        ignore_extensions = self.distribution.pgo.get("ignore_extensions", [])
+        extensions = [
+            ext for ext in build_ext.extensions
+            if ext.name not in ignore_extensions
+        ]
+        # the fresh profile is written to a directory of its own, leaving the
+        # profile data in the build directory alone
+        fresh_dir = os.path.join(check_dir, 'fresh')
+        if is_clang(compiler):
+            # the runtime writes a raw profile for each extension ("%m")
+            # instead of to the extension's own directory
+            _run_profiles(
+                self.build_lib,
+                self.build_temp,
+                [
+                    (name, profile_command, {
+                        "LLVM_PROFILE_FILE": os.path.join(
+                            os.path.abspath(fresh_dir),
+                            '%m.profraw'
+                        ),
+                    })
+                    for name, profile_command in self.profile_commands
+                ],
+                self.jobs
+            )
+            fresh_profraws = _get_extension_profraws(fresh_dir, extensions)
+            results = [
+                _check_profdata(
+                    self.profile_data_dir,
+                    fresh_profraws[ext.name],
+                    check_dir,
+                    ext
+                )
+                for ext in extensions
+            ]
+        else:
+            _run_profiles(
+                self.build_lib,
+                self.build_temp,
+                [
+                    (name, profile_command, _get_gcov_env(
+                        fresh_dir,
+                        self.build_temp,
+                        _relocates_gcda(
+                            compiler,
+                            self.pgo_object_cache,
+                            self.build_temp
+                        )
+                    ))
+                    for name, profile_command in self.profile_commands
+                ],
+                self.jobs
+            )
+            results = [
+                _check_gcdas(
+                    compiler,
+                    self.profile_data_dir,
+                    self.build_temp,
+                    fresh_dir,
+                    ext
+                )
+                for ext in extensions
+            ]
+
+        self.extension_checks = []
+        for ext, (overlap, mismatched_functions) in zip(extensions, results):
+            self.extension_checks.append({
+                "name": ext.name,
+                "overlap": overlap,
+                "mismatched_functions": mismatched_functions,
+            })
+            info(
+                '%s: %.1f%% overlap, %d mismatched functions',
+                ext.name,
+                overlap * 100,
+                mismatched_functions
+            )
+        if self.output is not None:
+            info('writing profile check to %s', self.output)
+            with open(self.output, 'w', encoding='utf-8') as f:
+                json.dump({
+                    "threshold": self.threshold,
+                    "extensions": self.extension_checks,
+                }, f, indent=4)
+        stale = [
+            extension_check["name"]
+            for extension_check in self.extension_checks
+            if extension_check["overlap"] < self.threshold
+        ]
+        if stale:
+            raise ProfileCheckError(
+                f'the stored profile data of {", ".join(stale)} overlaps '
+                f'the fresh profile by less than {self.threshold:.1%}'
+            )
+
+
+def _get_extension_profraws(fresh_dir, extensions):
+    # the raw profiles in fresh_dir by the name of the extension they're for,
+    # which is told by the module init function ("PyInit_<name>") that each
+    # extension has
+    init_functions = {
+        f'PyInit_{ext.name.rpartition(".")[2]}': ext.name
+        for ext in extensions
+    }
+    profraws = {ext.name: [] for ext in extensions}
+    try:
+        files = sorted(os.listdir(fresh_dir))
+    except FileNotFoundError:
+        files = []
+    for file in files:
+        if not file.endswith('.profraw'):
+            continue
+        profraw = os.path.join(fresh_dir, file)
+        # each function is listed by its name on a line of its own, like:
+        #
+        #   PyInit__pgo_test:
+        #     Hash: 0x0000000000000000
+        output = _run_llvm_profdata(['show', '--all-functions', profraw])
+        for name in re.findall(r'^  (\S.*):$', output, re.MULTILINE):
+            if name in init_functions:
+                profraws[init_functions[name]].append(profraw)
+    return profraws
+
+
+def _check_profdata(profile_data, fresh_profraws, check_dir, extension):
+    # the stored and fresh raw profiles are each merged and compared by
+    # "llvm-profdata overlap", functions whose hash doesn't match the current
+    # build are mismatched
+    stored_profraws = [
+        os.path.join(root, file)
+        for profile_data_dir in profile_data
+        for root, _, files in os.walk(
+            os.path.join(profile_data_dir, extension.name)
+        )
+        for file in sorted(files)
+        if _is_llvm_profile(file)
+    ]
+    if not fresh_profraws:
+        raise ProfileCheckError(f'no fresh profile data for {extension.name}')
+    if not stored_profraws:
+        raise ProfileCheckError(f'no stored profile data for {extension.name}')
+    fresh_profdata = os.path.join(check_dir, f'{extension.name}.fresh')
+    stored_profdata = os.path.join(check_dir, f'{extension.name}.stored')
+    for profdata, profraws in (
+        (fresh_profdata, fresh_profraws),
+        (stored_profdata, stored_profraws),
+    ):
+        _run_llvm_profdata(['merge', f'-output={profdata}', *profraws])
+    return _get_profdata_overlap(fresh_profdata, stored_profdata)
+
+
+def _get_profdata_overlap(profdata, other_profdata):
+    # returns the overlap of the two indexed profiles and the number of
+    # functions whose hashes don't match
+    output = _run_llvm_profdata(['overlap', profdata, other_profdata])
+    # the program level results are listed first, like:
+    #
+    #   # of functions mismatch: 1
+    #   Edge profile overlap: 81.818%
+    #
+    # the mismatch count is left out when there are none
+    overlap = re.search(r'Edge profile overlap: ([\d.]+)%', output)
+    if overlap is None:
+        raise ProfileCheckError(
+            f'unable to read the overlap of {profdata} and {other_profdata}'
+        )
+    mismatch = re.search(r'# of functions mismatch: (\d+)', output)
+    return (
+        float(overlap.group(1)) / 100,
+        int(mismatch.group(1)) if mismatch else 0,
+    )
+
+
+def _run_llvm_profdata(args):
+    llvm_profdata = ['llvm-profdata', *args]
+    if sys.platform == 'darwin':
+        llvm_profdata.insert(0, 'xcrun')
+    try:
+        return subprocess.run(
+            llvm_profdata,
+            check=True,
+            stdout=subprocess.PIPE,
+            universal_newlines=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError) as ex:
+        raise ProfileCheckError(ex)
+
+
+def _check_gcdas(compiler, profile_data, pgo_build_temp, fresh_dir, extension):
+    # the ".gcda" files of the extension are compared function by function
+    stored = {}
+    fresh = {}
+    for obj in compiler.object_filenames(
+        extension.sources,
+        output_dir=pgo_build_temp
+    ):
+        rel_gcda = os.path.relpath(
+            os.path.splitext(obj)[0] + '.gcda',
+            pgo_build_temp
+        )
+        _add_gcda_counters(fresh, [fresh_dir], rel_gcda)
+        _add_gcda_counters(stored, profile_data, rel_gcda)
+    if not fresh:
+        raise ProfileCheckError(f'no fresh profile data for {extension.name}')
+    if not stored:
+        raise ProfileCheckError(f'no stored profile data for {extension.name}')
+    return _get_gcda_overlap(fresh, stored)
+
+
+def _add_gcda_counters(functions, gcda_dirs, rel_gcda):
+    # adds the counters of the ".gcda" file at rel_gcda in each of the trees
+    # to the functions, keyed by (rel_gcda, ident)
+    for gcda_dir in gcda_dirs:
+        gcda = os.path.join(gcda_dir, rel_gcda)
+        if not os.path.exists(gcda):
+            continue
+        try:
+            gcda_functions = _read_gcda_counters(gcda)
+        except ProfileError as ex:
+            raise ProfileCheckError(str(ex))
+        for ident, (checksums, counts) in gcda_functions.items():
+            key = (rel_gcda, ident)
+            if key in functions:
+                _, total_counts = functions[key]
+                if len(total_counts) == len(counts):
+                    for i, count in enumerate(counts):
+                        total_counts[i] += count
+            else:
+                functions[key] = (checksums, list(counts))
+
+
+def _get_gcda_overlap(functions, other_functions):
+    # a function whose checksums differ was changed between the profiles, the
+    # overlap of the rest is computed like gcov-tool's: the sum of the smaller
+    # share of each counter
+    mismatched_functions = 0
+    total = sum(sum(counts) for _, counts in functions.values())
+    other_total = sum(sum(counts) for _, counts in other_functions.values())
+    if not total or not other_total:
+        overlap = 1.0 if total == other_total else 0.0
+    else:
+        overlap = 0.0
+    for key, (checksums, counts) in functions.items():
+        try:
+            other_checksums, other_counts = other_functions[key]
+        except KeyError:
+            continue
+        if (
+            checksums != other_checksums or
+            len(counts) != len(other_counts)
+        ):
+            mismatched_functions += 1
+            continue
+        if total and other_total:
+            overlap += sum(
+                min(count / total, other_count / other_total)
+                for count, other_count in zip(counts, other_counts)
+            )
+    return overlap, mismatched_functions
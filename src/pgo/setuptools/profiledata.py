@@ -0,0 +1,114 @@
+
+__all__ = []
+
+# pgo
+from .compiler import (is_clang, _get_profdata_dir, _get_profraw_dir,
+                       _is_llvm_profile, _merge_gcdas)
+from .error import ProfileUseError
+# python
+import os
+import shutil
+import tempfile
+# setuptools
+from distutils.dir_util import remove_tree
+from distutils.log import info
+
+
+def _import_profile_data(
+    compiler,
+    profile_data,
+    pgo_build_lib,
+    pgo_build_temp,
+    extensions,
+    local
+):
+    # brings raw profile data collected elsewhere into the build directories
+    # as if it had been written by the profile command, when local is set it
+    # is added to the profile data the profile command wrote
+    #
+    # for clang each profile data directory has a directory of ".profraw" files
+    # for each extension (like _get_profdata_dir), for gcc each is a tree of
+    # ".gcda" files laid out like pgo_build_temp (like GCOV_PREFIX would), gcc
+    # identifies functions by the paths of the objects so it must have been
+    # collected with the same pgo_build_temp
+    for profile_data_dir in profile_data:
+        if not os.path.isdir(profile_data_dir):
+            raise ProfileUseError(
+                f'profile data directory {profile_data_dir} does not exist'
+            )
+    os.makedirs(pgo_build_lib, exist_ok=True)
+    os.makedirs(pgo_build_temp, exist_ok=True)
+    if is_clang(compiler):
+        _import_profraws(
+            profile_data,
+            pgo_build_temp,
+            extensions,
+            local
+        )
+    else:
+        _import_gcdas(profile_data, pgo_build_temp, local)
+
+
+def _import_profraws(profile_data, pgo_build_temp, extensions, local):
+    profdata_dir = _get_profdata_dir(pgo_build_temp)
+    if not local and os.path.exists(profdata_dir):
+        remove_tree(profdata_dir)
+    for extension in extensions:
+        profraws = [
+            os.path.join(root, file)
+            for profile_data_dir in profile_data
+            for root, _, files in os.walk(
+                os.path.join(profile_data_dir, extension.name)
+            )
+            for file in sorted(files)
+            if _is_llvm_profile(file)
+        ]
+        if not profraws and not local:
+            raise ProfileUseError(
+                f'no imported profile data for {extension.name}'
+            )
+        # the imported raw profiles are weighted the same as the profile
+        # command's (see _merge_profdata)
+        target_dir = os.path.join(
+            _get_profraw_dir(pgo_build_temp, extension.name),
+            'weight-1'
+        )
+        os.makedirs(target_dir, exist_ok=True)
+        for i, profraw in enumerate(profraws):
+            info('importing %s', profraw)
+            shutil.copyfile(
+                profraw,
+                os.path.join(
+                    target_dir,
+                    f'imported-{i}-{os.path.basename(profraw)}'
+                )
+            )
+
+
+def _import_gcdas(profile_data, pgo_build_temp, local):
+    with tempfile.TemporaryDirectory() as local_dir:
+        # the gcda files in pgo_build_temp are replaced by the merged ones, so
+        # the local profile data is moved aside first
+        has_local = False
+        for root, dirnames, files in os.walk(pgo_build_temp):
+            if '.pgo-workloads' in dirnames:
+                dirnames.remove('.pgo-workloads')
+            for file in files:
+                if not file.endswith('.gcda'):
+                    continue
+                path = os.path.join(root, file)
+                if local:
+                    target = os.path.join(
+                        local_dir,
+                        os.path.relpath(path, pgo_build_temp)
+                    )
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.move(path, target)
+                    has_local = True
+                else:
+                    os.remove(path)
+        gcda_dirs = [(profile_data_dir, 1) for profile_data_dir in profile_data]
+        if has_local:
+            gcda_dirs.insert(0, (local_dir, 1))
+        info('importing profile data from %s', ', '.join(profile_data))
+        _merge_gcdas(pgo_build_temp, gcda_dirs)
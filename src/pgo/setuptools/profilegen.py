@@ -3,18 +3,27 @@ __all__ = [
     'clean_profile_generate',
     'make_build_profile_generate',
     'make_build_ext_profile_generate',
+    'make_build_ext_profile_cs_generate',
     'make_build_py_profile_generate',
 ]
 
 # pgo
 from .command import PGO_BUILD_USER_OPTIONS
-from .compiler import (is_clang, is_msvc, _get_pgd, _get_pgort_dll,
-                       _get_profdata_dir)
+from .compiler import (is_clang, is_msvc, _get_instrument_sources_flags,
+                       _get_instrumentation_flags, _get_lto_flags, _get_pgd,
+                       _get_pgort_dll, _get_profdata, _get_profraw_dir,
+                       _merge_profdatas)
+from .objectcache import _cache_compiler_objects
+from .profilereport import _get_min_coverage
+from .report import _report_extension
 # python
 from copy import deepcopy
 import os
+import threading
 # setuptools
+from distutils.dep_util import newer_group
 from distutils.dir_util import mkpath, remove_tree
+from distutils.errors import DistutilsSetupError
 from distutils.file_util import copy_file
 from setuptools import Command
 
@@ -83,27 +92,83 @@ def make_build_profile_generate(base_class):
     return build_profile_generate
 
 
+_pgort_dll_lock = threading.Lock()
+
+
 def make_build_ext_profile_generate(base_class):
 
     class build_ext_profile_generate(base_class):
     
+        def initialize_options(self):
+            super().initialize_options()
+            self.pgo_mode = None
+            self.pgo_object_cache = None
+            self.pgo_lto = None
+            self.pgo_lto_jobs = None
+            self.pgo_counter_update = None
+            self.pgo_no_profile_values = None
+    
         def finalize_options(self):
             self.set_undefined_options('build_profile_generate',
                 ('build_lib', 'build_lib'),
                 ('build_temp', 'build_temp')
             )
+            self.set_undefined_options('build',
+                ('pgo_jobs', 'parallel'),
+                ('pgo_mode', 'pgo_mode'),
+                ('pgo_object_cache', 'pgo_object_cache'),
+                ('pgo_lto', 'pgo_lto'),
+                ('pgo_lto_jobs', 'pgo_lto_jobs'),
+                ('pgo_counter_update', 'pgo_counter_update'),
+                ('pgo_no_profile_values', 'pgo_no_profile_values'),
+            )
             super().finalize_options()
+
+        def build_extensions(self):
+            if self.pgo_object_cache and not self.dry_run:
+                _cache_compiler_objects(self.compiler, self.pgo_object_cache)
+            super().build_extensions()
             
         def build_extension(self, ext):
-            if ext.name in self.distribution.pgo.get("ignore_extensions", []):
-                super().build_extension(ext)
-            else:
-                self.build_extension_with_pgo(ext)
+            with _report_extension(self, ext):
+                if ext.name in self.distribution.pgo.get(
+                    "ignore_extensions",
+                    []
+                ):
+                    super().build_extension(ext)
+                else:
+                    self.build_extension_with_pgo(ext)
+
+        def reads_profile(self, ext):
+            # whether the profile of the extension is read by profile_report
+            # or to check its coverage when it's used
+            pgo = self.distribution.pgo
+            return (
+                'profile_report' in self.distribution.commands or
+                _get_min_coverage(
+                    pgo,
+                    "min_function_coverage",
+                    ext.name
+                ) is not None or
+                _get_min_coverage(
+                    pgo,
+                    "min_block_coverage",
+                    ext.name
+                ) is not None
+            )
 
         def build_extension_with_pgo(self, ext):
             ext = deepcopy(ext)
             ext_path = self.get_ext_fullpath(ext.name)
-            if is_msvc(self.compiler):
+            if self.pgo_mode == 'sample':
+                # sampling doesn't need instrumentation, just the debug info
+                # to map the samples back to the source
+                ext.extra_compile_args.append('-g')
+                if is_clang(self.compiler):
+                    ext.extra_compile_args.append(
+                        '-fdebug-info-for-profiling'
+                    )
+            elif is_msvc(self.compiler):
                 # since we're profiling in a different directory than we're
                 # building we need to direct the compiler to the "pgd" (and
                 # adjacent "pgc" files) to use, to do that properly we need to
@@ -120,18 +185,74 @@ def make_build_ext_profile_generate(base_class):
                 # a unique directory to dump these ".profraw" files per
                 # extension so that they can be recombined later in the use
                 # step
-                profdata_dir = _get_profdata_dir(self.build_temp)
-                profdata_format = os.path.join(
-                    profdata_dir, '%m.profraw'
-                )
-                profile_generate_flag = (
-                    f'-fprofile-instr-generate={profdata_format}'
+                #
+                # "%m" makes every process that loads this build of the
+                # extension merge its counters into the same file
+                profraw_dir = _get_profraw_dir(self.build_temp, ext.name)
+                if self.pgo_mode == 'cs':
+                    # the context sensitive round requires the first round
+                    # to be instrumented at the IR level, which always names
+                    # its files "default_%m.profraw"
+                    profile_generate_flag = f'-fprofile-generate={profraw_dir}'
+                else:
+                    profdata_format = os.path.join(profraw_dir, '%m.profraw')
+                    profile_generate_flag = (
+                        f'-fprofile-instr-generate={profdata_format}'
+                    )
+                instrumentation_flags = _get_instrumentation_flags(
+                    self.compiler,
+                    self.pgo_counter_update,
+                    not self.pgo_no_profile_values
                 )
-                ext.extra_compile_args.extend([profile_generate_flag])
-                ext.extra_link_args.extend([profile_generate_flag])
+                ext.extra_compile_args.extend([
+                    profile_generate_flag,
+                    *instrumentation_flags,
+                    *self.get_instrument_sources_flags(ext),
+                ])
+                ext.extra_link_args.extend([
+                    profile_generate_flag,
+                    *instrumentation_flags,
+                ])
+                # raw profiles written by a previous build of the extension
+                # don't match the new build, so they are thrown away
+                if (
+                    (self.force or newer_group(
+                        ext.sources + ext.depends,
+                        ext_path,
+                        'newer'
+                    )) and
+                    os.path.exists(profraw_dir)
+                ):
+                    remove_tree(profraw_dir, dry_run=self.dry_run)
             else:
-                ext.extra_compile_args.extend(['-fprofile-generate', '-flto'])
-                ext.extra_link_args.extend(['-fprofile-generate', '-flto'])
+                lto_compile_flags, lto_link_flags = _get_lto_flags(
+                    self.compiler,
+                    self.pgo_lto,
+                    self.pgo_lto_jobs,
+                    instrumented=True
+                )
+                instrumentation_flags = _get_instrumentation_flags(
+                    self.compiler,
+                    self.pgo_counter_update,
+                    not self.pgo_no_profile_values
+                )
+                ext.extra_compile_args.extend([
+                    '-fprofile-generate',
+                    *instrumentation_flags,
+                    *self.get_instrument_sources_flags(ext),
+                    *lto_compile_flags,
+                ])
+                ext.extra_link_args.extend([
+                    '-fprofile-generate',
+                    *instrumentation_flags,
+                    *lto_link_flags,
+                ])
+                # "-ftest-coverage" writes the ".gcno" notes next to each
+                # object, which are needed to name the functions of the
+                # profile, so they're only written when the profile is going
+                # to be read
+                if self.reads_profile(ext):
+                    ext.extra_compile_args.append('-ftest-coverage')
                 
             super().build_extension(ext)
             
@@ -148,13 +269,32 @@ def make_build_ext_profile_generate(base_class):
                         os.path.dirname(ext_path),
                         os.path.basename(pgort_dll)
                     )
-                    if not os.path.exists(target_pgort_dll):
-                        mkpath(os.path.dirname(ext_path), dry_run=self.dry_run)
-                        copy_file(
-                            pgort_dll, 
-                            target_pgort_dll,
-                            dry_run=self.dry_run
-                        )
+                    # extensions may be built in parallel, so make sure only
+                    # one of them copies the dll to any given directory
+                    with _pgort_dll_lock:
+                        if not os.path.exists(target_pgort_dll):
+                            mkpath(
+                                os.path.dirname(ext_path),
+                                dry_run=self.dry_run
+                            )
+                            copy_file(
+                                pgort_dll, 
+                                target_pgort_dll,
+                                dry_run=self.dry_run
+                            )
+
+        def get_instrument_sources_flags(self, ext):
+            instrument_sources = _get_instrument_sources(
+                self.distribution.pgo,
+                ext.name
+            )
+            if instrument_sources is None or self.dry_run:
+                return []
+            return _get_instrument_sources_flags(
+                self.compiler,
+                self.build_temp,
+                *instrument_sources
+            )
 
         def did_build(self):
             return hasattr(self, '_built_objects')
@@ -162,6 +302,125 @@ def make_build_ext_profile_generate(base_class):
     return build_ext_profile_generate
 
 
+def make_build_ext_profile_cs_generate(base_class):
+
+    class build_ext_profile_cs_generate(base_class):
+    
+        description = (
+            'build instrumented extensions for the context sensitive round '
+            'of profile guided optimization'
+        )
+    
+        def initialize_options(self):
+            super().initialize_options()
+            self.pgo_lto = None
+            self.pgo_lto_jobs = None
+            self.pgo_counter_update = None
+            self.pgo_no_profile_values = None
+
+        def finalize_options(self):
+            self.set_undefined_options('build_profile_generate',
+                ('build_lib', 'build_lib'),
+                ('build_temp', 'build_temp')
+            )
+            self.set_undefined_options('build',
+                ('pgo_jobs', 'parallel'),
+                ('pgo_lto', 'pgo_lto'),
+                ('pgo_lto_jobs', 'pgo_lto_jobs'),
+                ('pgo_counter_update', 'pgo_counter_update'),
+                ('pgo_no_profile_values', 'pgo_no_profile_values'),
+            )
+            super().finalize_options()
+            
+        def run(self):
+            # the extensions must be rebuilt with the new profile from the
+            # first round
+            profile = self.distribution.get_command_obj('profile')
+            if profile.profiled:
+                self.force = 1
+            super().run()
+            
+        def build_extensions(self):
+            # the first round's profile data is what these extensions are
+            # optimized with
+            ignore_extensions = self.distribution.pgo.get(
+                "ignore_extensions", []
+            )
+            _merge_profdatas(
+                self.dry_run,
+                self.build_lib,
+                self.build_temp,
+                [
+                    ext for ext in self.extensions
+                    if ext.name not in ignore_extensions
+                ],
+                self.parallel if self.parallel is not True else None
+            )
+            super().build_extensions()
+            
+        def build_extension(self, ext):
+            with _report_extension(self, ext):
+                if ext.name in self.distribution.pgo.get(
+                    "ignore_extensions",
+                    []
+                ):
+                    super().build_extension(ext)
+                else:
+                    self.build_extension_with_pgo(ext)
+                
+        def build_extension_with_pgo(self, ext):
+            ext = deepcopy(ext)
+            ext_path = self.get_ext_fullpath(ext.name)
+            profdata = _get_profdata(self.build_lib, ext)
+            profraw_dir = _get_profraw_dir(self.build_temp, ext.name, cs=True)
+            # the context sensitive instrumentation is added after inlining,
+            # which for the most part happens at link time, so this build is
+            # never without link time optimization
+            lto_compile_flags, lto_link_flags = _get_lto_flags(
+                self.compiler,
+                self.pgo_lto,
+                self.pgo_lto_jobs
+            )
+            flags = [
+                f'-fprofile-use={profdata}',
+                f'-fcs-profile-generate={profraw_dir}',
+                *_get_instrumentation_flags(
+                    self.compiler,
+                    self.pgo_counter_update,
+                    not self.pgo_no_profile_values
+                ),
+            ]
+            instrument_sources = _get_instrument_sources(
+                self.distribution.pgo,
+                ext.name
+            )
+            if instrument_sources is not None and not self.dry_run:
+                ext.extra_compile_args.extend(_get_instrument_sources_flags(
+                    self.compiler,
+                    self.build_temp,
+                    *instrument_sources
+                ))
+            ext.extra_compile_args.extend([*flags, *lto_compile_flags])
+            ext.extra_link_args.extend([*flags, *lto_link_flags])
+            # raw profiles written by a previous build of the extension don't
+            # match the new build, so they are thrown away
+            if (
+                (self.force or newer_group(
+                    ext.sources + ext.depends,
+                    ext_path,
+                    'newer'
+                )) and
+                os.path.exists(profraw_dir)
+            ):
+                remove_tree(profraw_dir, dry_run=self.dry_run)
+            super().build_extension(ext)
+            
+        def did_build(self):
+            return hasattr(self, '_built_objects')
+        
+    return build_ext_profile_cs_generate
+
+
 def make_build_py_profile_generate(base_class):
 
     class build_py_profile_generate(base_class):
@@ -175,3 +434,40 @@ def make_build_py_profile_generate(base_class):
             super().finalize_options()
 
     return build_py_profile_generate
+
+
+def _get_instrument_sources(pgo, ext_name):
+    # the sources of each extension to instrument are given as a dict of
+    # extension names to a dict of "include" and "exclude" globs, returns the
+    # include and exclude globs for the extension or None when all of its
+    # sources are instrumented
+    instrument_sources = pgo.get("instrument_sources")
+    if instrument_sources is None:
+        return None
+    if not isinstance(instrument_sources, dict):
+        raise DistutilsSetupError(
+            '"instrument_sources" must be a dict of extension names to dicts '
+            'of "include" and "exclude" globs'
+        )
+    globs = instrument_sources.get(ext_name)
+    if globs is None:
+        return None
+    if not isinstance(globs, dict) or set(globs) - {"include", "exclude"}:
+        raise DistutilsSetupError(
+            f'"instrument_sources" for {ext_name} must be a dict of '
+            f'"include" and "exclude" globs'
+        )
+    include = globs.get("include", [])
+    exclude = globs.get("exclude", [])
+    for key, value in (("include", include), ("exclude", exclude)):
+        if (
+            not isinstance(value, (list, tuple)) or
+            not all(isinstance(glob, str) and glob for glob in value)
+        ):
+            raise DistutilsSetupError(
+                f'"{key}" of "instrument_sources" for {ext_name} must be a '
+                f'list of globs'
+            )
+    if not include and not exclude:
+        return None
+    return list(include), list(exclude)
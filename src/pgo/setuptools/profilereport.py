@@ -0,0 +1,380 @@
+
+__all__ = ['profile_report']
+
+# pgo
+from .command import PGO_BUILD_USER_OPTIONS
+from .compiler import (is_clang, is_msvc, _get_profdata, _merge_profdata,
+                       _new_compiler)
+from .error import ProfileError, ProfileUseError
+# python
+import json
+import os
+import re
+import subprocess
+import sys
+# setuptools
+from distutils.errors import DistutilsOptionError, DistutilsSetupError
+from distutils.log import info, warn
+from setuptools import Command
+
+
+class profile_report(Command):
+
+    description = (
+        'report the hottest functions and the coverage of the profile '
+        'generated for profile guided optimization'
+    )
+    user_options = [
+        (
+            name[len("pgo-"):] if name.startswith('pgo-') else name,
+            value,
+            desc,
+        )
+        for name, value, desc in PGO_BUILD_USER_OPTIONS
+    ] + [
+        ('top=', 'n', 'number of hottest functions listed for each '
+                      'extension (default 10)'),
+        ('output=', 'o', 'write the report as json to this file'),
+    ]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the summary of the profile of each extension, as written to the
+        # json report
+        self.extension_profiles = []
+
+    def initialize_options(self):
+        self.top = None
+        self.output = None
+        self.build_lib = None
+        self.build_temp = None
+        self.pgo_mode = None
+
+    def finalize_options(self):
+        self.set_undefined_options('build_profile_generate',
+            ('build_lib', 'build_lib'),
+            ('build_temp', 'build_temp')
+        )
+        self.set_undefined_options('build', ('pgo_mode', 'pgo_mode'))
+        pgo = self.distribution.pgo
+        if self.top is None:
+            self.top = pgo.get("profile_report_top", 10)
+        try:
+            self.top = int(self.top)
+            if self.top < 0:
+                raise ValueError()
+        except ValueError:
+            raise DistutilsOptionError('--top must be a non-negative integer')
+        if self.output is None:
+            self.output = pgo.get("profile_report_output")
+
+    def run(self):
+        if self.dry_run:
+            return
+        build_ext = self.get_finalized_command('build_ext_profile_generate')
+        compiler = _new_compiler(build_ext.compiler)
+        if self.pgo_mode == 'sample':
+            warn('profile reports are not supported for --pgo-mode=sample')
+            return
+        if is_msvc(compiler):
+            warn('profile reports are not supported by msvc')
+            return
+        ignore_extensions = self.distribution.pgo.get("ignore_extensions", [])
+        self.extension_profiles = []
+        for ext in build_ext.extensions:
+            if ext.name in ignore_extensions:
+                continue
+            functions, counter_volume = _read_extension_profile(
+                compiler,
+                self.build_lib,
+                self.build_temp,
+                ext,
+                self.pgo_mode
+            )
+            self.extension_profiles.append(_summarize_extension_profile(
+                ext.name,
+                functions,
+                counter_volume,
+                self.top
+            ))
+        for extension_profile in self.extension_profiles:
+            for line in _format_extension_profile(extension_profile):
+                info('%s', line)
+        if self.output is not None:
+            info('writing profile report to %s', self.output)
+            with open(self.output, 'w', encoding='utf-8') as f:
+                json.dump({
+                    "extensions": self.extension_profiles,
+                }, f, indent=4)
+
+
+def _summarize_extension_profile(name, functions, counter_volume, top):
+    zero_functions = sum(1 for function in functions if not function["count"])
+    function_coverage, block_coverage = _get_profile_coverage(functions)
+    hottest = sorted(functions, key=lambda f: (-f["count"], f["name"]))
+    return {
+        "name": name,
+        "functions": len(functions),
+        "zero_functions": zero_functions,
+        "zero_function_fraction": (
+            zero_functions / len(functions) if functions else 0.0
+        ),
+        "counter_volume": counter_volume,
+        "function_coverage": function_coverage,
+        "block_coverage": block_coverage,
+        "hottest": [
+            {"name": function["name"], "count": function["count"]}
+            for function in hottest[:top]
+        ],
+    }
+
+
+def _format_extension_profile(extension_profile):
+    # the lines of the text report of an extension's profile summary
+    return [
+        f'{extension_profile["name"]}: '
+        f'{extension_profile["functions"]} functions, '
+        f'{extension_profile["zero_function_fraction"]:.1%} never run, '
+        f'{extension_profile["counter_volume"]} counts',
+        *(
+            f'    {function["count"]:12d}  {function["name"]}'
+            for function in extension_profile["hottest"]
+        ),
+    ]
+
+
+def _get_min_coverage(pgo, key, ext_name):
+    # the minimum coverage may be given for every extension or as a dict of
+    # the minimum coverage for each extension by name
+    min_coverage = pgo.get(key)
+    if isinstance(min_coverage, dict):
+        min_coverage = min_coverage.get(ext_name)
+    if min_coverage is None:
+        return None
+    if (
+        isinstance(min_coverage, bool) or
+        not isinstance(min_coverage, (int, float)) or
+        not 0 <= min_coverage <= 1
+    ):
+        raise DistutilsSetupError(
+            f'"{key}" must be a number from 0 to 1 or a dict of extension '
+            f'names to numbers from 0 to 1'
+        )
+    return min_coverage
+
+
+def _get_profile_coverage(functions):
+    # the fractions of the functions and of their blocks that were run
+    blocks = sum(function["blocks"] for function in functions)
+    blocks_executed = sum(
+        function["blocks_executed"]
+        for function in functions
+    )
+    return (
+        (
+            sum(1 for function in functions if function["count"]) /
+            len(functions)
+            if functions else 0.0
+        ),
+        blocks_executed / blocks if blocks else 0.0,
+    )
+
+
+def _read_extension_profile(
+    compiler,
+    pgo_build_lib,
+    pgo_build_temp,
+    extension,
+    pgo_mode='instrument'
+):
+    # returns the functions in the profile of the extension, each a dict with
+    # its "name", entry "count" and its number of "blocks" and of
+    # "blocks_executed", along with the sum of every counter in the profile
+    if is_clang(compiler):
+        profdata = _get_profdata(
+            pgo_build_lib,
+            extension,
+            cs=pgo_mode == 'cs'
+        )
+        if not os.path.exists(profdata):
+            profdata = _get_profdata(pgo_build_lib, extension)
+        # the profile hasn't been merged by build_ext_profile_use yet
+        if not os.path.exists(profdata):
+            try:
+                profdata = _merge_profdata(
+                    False,
+                    pgo_build_lib,
+                    pgo_build_temp,
+                    extension
+                )
+            except ProfileUseError as ex:
+                raise ProfileError(str(ex))
+        return _read_profdata(profdata)
+    # gcc writes the ".gcda" file next to each object, the matching ".gcno"
+    # file has the names of its functions
+    #
+    # objects without any instrumented functions (such as the sources that
+    # are excluded by "instrument_sources") have no ".gcda" file
+    gcdas = [
+        os.path.splitext(obj)[0] + '.gcda'
+        for obj in compiler.object_filenames(
+            extension.sources,
+            output_dir=pgo_build_temp
+        )
+    ]
+    if not any(os.path.exists(gcda) for gcda in gcdas):
+        raise ProfileError(
+            f'missing profile data for {extension.name} ({gcdas[0]})'
+        )
+    functions = []
+    counter_volume = 0
+    for gcda in gcdas:
+        if not os.path.exists(gcda):
+            continue
+        if not os.path.exists(os.path.splitext(gcda)[0] + '.gcno'):
+            raise ProfileError(
+                f'missing coverage notes for {extension.name}, build it with '
+                f'profile_report on the command line (such as '
+                f'"setup.py build profile_report")'
+            )
+        gcda_functions, gcda_counter_volume = _read_gcda(gcda)
+        functions.extend(gcda_functions)
+        counter_volume += gcda_counter_volume
+    return functions, counter_volume
+
+
+def _read_profdata(profdata):
+    llvm_profdata_show = [
+        'llvm-profdata', 'show',
+        '--all-functions',
+        '--counts',
+        profdata
+    ]
+    if sys.platform == 'darwin':
+        llvm_profdata_show.insert(0, 'xcrun')
+    try:
+        output = subprocess.run(
+            llvm_profdata_show,
+            check=True,
+            stdout=subprocess.PIPE,
+            universal_newlines=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError) as ex:
+        raise ProfileError(ex)
+    # each function is listed like:
+    #
+    #   name:
+    #     Hash: 0x...
+    #     Counters: 3
+    #     Function count: 100
+    #     Block counts: [96, 4]
+    functions = []
+    counter_volume = 0
+    function = None
+    for line in output.splitlines():
+        match = re.match(r'^  (\S.*):$', line)
+        if match:
+            function = {
+                "name": match.group(1),
+                "count": 0,
+                "blocks": 0,
+                "blocks_executed": 0,
+            }
+            functions.append(function)
+            continue
+        if function is None or not line.startswith('    '):
+            continue
+        key, _, value = line.strip().partition(': ')
+        if key == 'Counters':
+            function["blocks"] = int(value)
+            continue
+        elif key == 'Function count':
+            counts = [int(value)]
+            function["count"] = counts[0]
+        elif key == 'Block counts':
+            counts = [
+                int(count)
+                for count in value.strip('[]').split(',')
+                if count.strip()
+            ]
+        else:
+            continue
+        function["blocks_executed"] += sum(1 for count in counts if count)
+        counter_volume += sum(counts)
+    return functions, counter_volume
+
+
+def _read_gcda(gcda):
+    try:
+        output = subprocess.run(
+            ['gcov', '--json-format', '--stdout', gcda],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError) as ex:
+        raise ProfileError(ex)
+    functions = []
+    for document in output.splitlines():
+        if not document.strip():
+            continue
+        for file in json.loads(document)["files"]:
+            for function in file["functions"]:
+                functions.append({
+                    "name": function["demangled_name"],
+                    "count": function["execution_count"],
+                    "blocks": function["blocks"],
+                    "blocks_executed": function["blocks_executed"],
+                })
+    counter_volume = sum(
+        sum(counts)
+        for _, counts in _read_gcda_counters(gcda).values()
+    )
+    return functions, counter_volume
+
+
+def _read_gcda_counters(gcda):
+    # returns the checksums and arc counters of each function in the ".gcda"
+    # file by its ident, the checksums are a tuple of its line number and
+    # control flow graph checksums
+    try:
+        output = subprocess.run(
+            ['gcov-dump', '-l', gcda],
+            check=True,
+            stdout=subprocess.PIPE,
+            universal_newlines=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError) as ex:
+        raise ProfileError(ex)
+    # the counters of the arcs are the edges of each function's control flow
+    # graph that were instrumented, they're listed after each "COUNTERS arcs"
+    # record as "index: count count ..."
+    functions = {}
+    counts = None
+    in_arcs = False
+    for line in output.splitlines():
+        line = line[len(gcda) + 1:]
+        match = re.search(
+            r'FUNCTION ident=(\d+), '
+            r'lineno_checksum=(0x[0-9a-f]+), '
+            r'cfg_checksum=(0x[0-9a-f]+)',
+            line
+        )
+        if match:
+            counts = []
+            functions[int(match.group(1))] = (
+                (match.group(2), match.group(3)),
+                counts,
+            )
+            in_arcs = False
+            continue
+        if 'COUNTERS' in line:
+            in_arcs = 'COUNTERS arcs' in line
+            continue
+        match = re.match(r'^\s*\d+:((?:\s+\d+)+)\s*$', line)
+        if match is None:
+            in_arcs = False
+        elif in_arcs and counts is not None:
+            counts.extend(int(count) for count in match.group(1).split())
+    return functions
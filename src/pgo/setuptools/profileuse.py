@@ -6,15 +6,26 @@ __all__ = [
 
 # pgo
 from .command import PGO_BUILD_USER_OPTIONS
-from .compiler import is_clang, is_msvc, _get_pgd, _merge_profdata
-from .error import ProfileUseError
+from .compiler import (get_compiler_identity, is_clang, is_msvc,
+                       _get_lto_flags, _get_partial_training_flags,
+                       _get_pgd, _get_profdata, _merge_profdatas)
+from .error import ProfileError, ProfileUseError
+from .profilegen import _get_instrument_sources
+from .profilereport import (_get_min_coverage, _get_profile_coverage,
+                            _read_extension_profile)
+from .report import _report_extension
+from .sample import _get_sample_profile
 from .util import _dir_to_pgo_dir
 # python
 from copy import deepcopy
+import hashlib
+import json
 import os
 import re
+import sys
 # setuptools
-from distutils.errors import CompileError, LinkError
+from distutils.errors import CompileError, DistutilsSetupError, LinkError
+from distutils.log import info, warn
 
 
 def make_build_profile_use(base_class):
@@ -65,6 +76,18 @@ def make_build_ext_profile_use(base_class):
         def initialize_options(self):
             super().initialize_options()
             self.pgo_build_lib = None
+            self.pgo_bolt = None
+            self.pgo_mode = None
+            self.pgo_profile_data_dir = None
+            self.pgo_profile_archive = None
+            self.pgo_require = None
+            self.pgo_lto = None
+            self.pgo_lto_jobs = None
+            # the names of the extensions linked for llvm-bolt
+            self.bolt_extensions = []
+            # the names of the extensions whose profile missed the minimum
+            # coverage, which are built without profile guided optimization
+            self.undercovered_extensions = set()
 
         def finalize_options(self):
             self.set_undefined_options('build_profile_use',
@@ -72,34 +95,188 @@ def make_build_ext_profile_use(base_class):
                 ('pgo_build_temp', 'build_temp'),
                 ('build_lib', 'build_lib'),
             )
+            self.set_undefined_options('build',
+                ('pgo_jobs', 'parallel'),
+                ('pgo_bolt', 'pgo_bolt'),
+                ('pgo_mode', 'pgo_mode'),
+                ('pgo_profile_data_dir', 'pgo_profile_data_dir'),
+                ('pgo_profile_archive', 'pgo_profile_archive'),
+                ('pgo_require', 'pgo_require'),
+                ('pgo_lto', 'pgo_lto'),
+                ('pgo_lto_jobs', 'pgo_lto_jobs'),
+            )
             super().finalize_options()
             
-        def run(self):
-            # force building if the profile command actually profiled
-            profile = self.distribution.get_command_obj('profile')
-            if profile.profiled:
-                self.force = 1
-            super().run()
+        def build_extensions(self):
+            if self.pgo_mode != 'sample' and is_clang(self.compiler):
+                # the profile data for every extension is merged up front, so
+                # that the merges can run in parallel
+                profile = self.distribution.get_command_obj('profile')
+                if not profile.restored:
+                    ignore_extensions = self.distribution.pgo.get(
+                        "ignore_extensions", []
+                    )
+                    _merge_profdatas(
+                        self.dry_run,
+                        self.pgo_build_lib,
+                        self.build_temp,
+                        [
+                            ext for ext in self.extensions
+                            if ext.name not in ignore_extensions
+                        ],
+                        self.parallel if self.parallel is not True else None,
+                        cs=self.pgo_mode == 'cs'
+                    )
+            if not self.dry_run:
+                self.check_profile_coverage()
+            super().build_extensions()
+
+        def check_profile_coverage(self):
+            self.undercovered_extensions = set()
+            pgo = self.distribution.pgo
+            ignore_extensions = pgo.get("ignore_extensions", [])
+            for ext in self.extensions:
+                if ext.name in ignore_extensions:
+                    continue
+                min_function_coverage = _get_min_coverage(
+                    pgo,
+                    "min_function_coverage",
+                    ext.name
+                )
+                min_block_coverage = _get_min_coverage(
+                    pgo,
+                    "min_block_coverage",
+                    ext.name
+                )
+                if (
+                    min_function_coverage is None and
+                    min_block_coverage is None
+                ):
+                    continue
+                if self.pgo_mode == 'sample' or is_msvc(self.compiler):
+                    warn(
+                        'the profile coverage can only be checked for '
+                        'instrumented clang and gcc builds, ignoring '
+                        '"min_function_coverage" and "min_block_coverage"'
+                    )
+                    return
+                try:
+                    functions, _ = _read_extension_profile(
+                        self.compiler,
+                        self.pgo_build_lib,
+                        self.build_temp,
+                        ext,
+                        self.pgo_mode
+                    )
+                except ProfileError as ex:
+                    warn(
+                        f'unable to check the profile coverage of {ext.name}: '
+                        f'{ex}'
+                    )
+                    continue
+                function_coverage, block_coverage = _get_profile_coverage(
+                    functions
+                )
+                missed = [
+                    f'{coverage:.1%} of its {name} (the minimum is '
+                    f'{min_coverage:.1%})'
+                    for name, coverage, min_coverage in (
+                        ('functions', function_coverage,
+                         min_function_coverage),
+                        ('blocks', block_coverage, min_block_coverage),
+                    )
+                    if min_coverage is not None and coverage < min_coverage
+                ]
+                if not missed:
+                    continue
+                message = (
+                    f'the profile of {ext.name} covers only '
+                    f'{" and ".join(missed)}'
+                )
+                if self.pgo_require:
+                    raise ProfileUseError(message)
+                warn(
+                    f'{message}, building it without profile guided '
+                    f'optimization'
+                )
+                self.undercovered_extensions.add(ext.name)
 
         def build_extension(self, ext):
-            if ext.name in self.distribution.pgo.get("ignore_extensions", []):
-                super().build_extension(ext)
-            else:
-                self.build_extension_with_pgo(ext)
+            with _report_extension(self, ext):
+                if ext.name in self.distribution.pgo.get(
+                    "ignore_extensions",
+                    []
+                ):
+                    super().build_extension(ext)
+                else:
+                    self.build_extension_with_pgo(ext)
                 
         def build_extension_with_pgo(self, ext):
             ext = deepcopy(ext)
-            if is_msvc(self.compiler):
+            ext_path = self.get_ext_fullpath(ext.name)
+            # the files whose contents are the profile data for the extension
+            profile_files = []
+            if not is_msvc(self.compiler):
+                lto_compile_flags, lto_link_flags = _get_lto_flags(
+                    self.compiler,
+                    self.pgo_lto,
+                    self.pgo_lto_jobs
+                )
+                if _get_partial_training(self.distribution.pgo, ext.name):
+                    partial_training_flags = _get_partial_training_flags(
+                        self.compiler
+                    )
+                else:
+                    partial_training_flags = []
+            if ext.name in self.undercovered_extensions:
+                # optimized as it would be with profile data, just without
+                # any, so that the rarely profiled code isn't pessimized
+                if is_msvc(self.compiler):
+                    ext.extra_compile_args.extend(['/O2', '/GL'])
+                    ext.extra_link_args.append('/LTCG')
+                else:
+                    ext.extra_compile_args.extend(['-O3', *lto_compile_flags])
+                    ext.extra_link_args.extend(['-O3', *lto_link_flags])
+            elif self.pgo_mode == 'sample':
+                sample_profile = _get_sample_profile(self.pgo_build_lib, ext)
+                if not self.dry_run and not os.path.exists(sample_profile):
+                    raise ProfileUseError(
+                        f'missing sample profile for {ext.name}'
+                    )
+                if is_clang(self.compiler):
+                    profile_use_flags = [
+                        f'-fprofile-sample-use={sample_profile}',
+                        *partial_training_flags,
+                    ]
+                else:
+                    # gcc's partial training only applies to -fprofile-use
+                    profile_use_flags = [f'-fauto-profile={sample_profile}']
+                # the samples are matched to the code by its debug info, so
+                # it's built with the same debug info as the profiled build
+                debug_flags = ['-g']
+                if is_clang(self.compiler):
+                    debug_flags.append('-fdebug-info-for-profiling')
+                ext.extra_compile_args.extend([
+                    *debug_flags,
+                    *profile_use_flags,
+                    *lto_compile_flags,
+                ])
+                ext.extra_link_args.extend([
+                    *profile_use_flags,
+                    *lto_link_flags,
+                ])
+                profile_files.append(sample_profile)
+            elif is_msvc(self.compiler):
                 # since we're building in a different directory than we
                 # profiled from we need to direct the compiler to the "pgd"
                 # (and adjacent "pgc" files) that we created in the
                 # pgo_build_lib directory
-                ext_path = self.get_ext_fullpath(ext.name)
                 pgd = _get_pgd(
                     os.path.relpath(ext_path, self.build_lib),
                     self.pgo_build_lib
                 )
                 ext.extra_link_args.append(f'/USEPROFILE:PGD={pgd}')
+                profile_files.append(pgd)
                 # the msvc linker will produce a warning if there are no pgc
                 # files (the actual profiling data) for a given pgd, but there
                 # is no way to turn that into an error, so we'll need to search
@@ -114,38 +291,232 @@ def make_build_ext_profile_use(base_class):
                         pgd_dir_files = os.listdir(pgd_dirname)
                     except FileNotFoundError:
                         pgd_dir_files = []
-                    for file in pgd_dir_files:
-                        if pgc_pattern.match(file):
-                            break
-                    else:
+                    pgc_files = [
+                        os.path.join(pgd_dirname, file)
+                        for file in sorted(pgd_dir_files)
+                        if pgc_pattern.match(file)
+                    ]
+                    profile_files.extend(pgc_files)
+                    if not pgc_files:
                         raise ProfileUseError(
                             f'No .PCG matching "{pgd_name}!*.pgc" in '
                             f'{pgd_dirname}'
                         )
             elif is_clang(self.compiler):
-                profdata = _merge_profdata(
-                    self.dry_run,
+                profdata = _get_profdata(
                     self.pgo_build_lib,
-                    self.build_temp,
-                    ext
+                    ext,
+                    cs=self.pgo_mode == 'cs'
                 )
                 profile_use_flag = f'-fprofile-use={profdata}'
-                ext.extra_compile_args.extend([profile_use_flag, '-flto'])
-                ext.extra_link_args.extend([profile_use_flag, '-flto'])
+                ext.extra_compile_args.extend([
+                    profile_use_flag,
+                    *partial_training_flags,
+                    *lto_compile_flags,
+                ])
+                ext.extra_link_args.extend([
+                    profile_use_flag,
+                    *partial_training_flags,
+                    *lto_link_flags,
+                ])
+                profile_files.append(profdata)
+                # imported profile data must match the current sources, gcc
+                # already treats a mismatch as an error
+                if self.pgo_profile_data_dir or self.pgo_profile_archive:
+                    ext.extra_compile_args.append(
+                        '-Werror=profile-instr-out-of-date'
+                    )
             else:
+                # the sources that weren't instrumented have no profile data,
+                # which is expected, they're still optimized with the profile
+                # of the rest of the extension when it's linked
+                if _get_instrument_sources(
+                    self.distribution.pgo,
+                    ext.name
+                ) is None:
+                    missing_profile_flags = ['-Werror=missing-profile']
+                else:
+                    missing_profile_flags = ['-Wno-missing-profile']
                 ext.extra_compile_args.extend([
                     '-fprofile-use',
-                    '-Werror=missing-profile',
-                    '-flto',
+                    *missing_profile_flags,
+                    *partial_training_flags,
+                    *lto_compile_flags,
                 ])
                 ext.extra_link_args.extend([
                     '-fprofile-use',
-                    '-Werror=missing-profile',
-                    '-flto',
+                    *missing_profile_flags,
+                    *partial_training_flags,
+                    *lto_link_flags,
                 ])
+                # gcc reads the ".gcda" file next to each object
+                profile_files.extend(
+                    os.path.splitext(obj)[0] + '.gcda'
+                    for obj in self.compiler.object_filenames(
+                        ext.sources,
+                        output_dir=self.build_temp
+                    )
+                )
+            if self.is_bolt_supported():
+                # llvm-bolt needs the relocations to rearrange the code, gcc
+                # splitting functions itself gets in the way of that
+                if not is_clang(self.compiler):
+                    ext.extra_compile_args.append(
+                        '-fno-reorder-blocks-and-partition'
+                    )
+                ext.extra_link_args.append('-Wl,--emit-relocs')
+            # instead of rebuilding every extension whenever there is new
+            # profile data, an extension is only rebuilt when its sources,
+            # flags or profile data have changed since it was last built
+            digest_path = _get_profile_use_digest_path(self.build_temp, ext)
+            digest = None
+            if not self.dry_run:
+                digest = _get_profile_use_digest(self, ext, profile_files)
+                if not self.force and _is_profile_use_up_to_date(
+                    digest_path,
+                    digest,
+                    ext_path
+                ):
+                    info(
+                        'skipping \'%s\' extension (profile data unchanged)',
+                        ext.name
+                    )
+                    return
+                # build_ext would skip an extension whose sources are older
+                # than it
+                if os.path.exists(ext_path):
+                    os.remove(ext_path)
+                if os.path.exists(digest_path):
+                    os.remove(digest_path)
+            if self.is_bolt_supported():
+                self.bolt_extensions.append(ext.name)
             try:
                 super().build_extension(ext)
             except (CompileError, LinkError) as ex:
                 raise ProfileUseError(ex)
+            if digest is not None:
+                _write_profile_use_digest(digest_path, digest, ext_path)
         
+        def is_bolt_supported(self):
+            # build_ext_bolt only runs llvm-bolt on linux, the linkers of
+            # other platforms (such as ld64) reject --emit-relocs
+            return (
+                self.pgo_bolt and
+                sys.platform == 'linux' and
+                not is_msvc(self.compiler)
+            )
+
     return build_ext_profile_use
+
+
+def _get_partial_training(pgo, ext_name):
+    # partial training may be enabled for every extension or as a list of the
+    # names of the extensions to enable it for
+    partial_training = pgo.get("partial_training", False)
+    if isinstance(partial_training, bool):
+        return partial_training
+    if (
+        isinstance(partial_training, (list, tuple)) and
+        all(isinstance(name, str) for name in partial_training)
+    ):
+        return ext_name in partial_training
+    raise DistutilsSetupError(
+        '"partial_training" must be a bool or a list of extension names'
+    )
+
+
+def _get_profile_use_digest_path(build_temp, ext):
+    return os.path.join(build_temp, '.pgo-use-digests', ext.name)
+
+
+def _get_profile_use_digest(build_ext, ext, profile_files):
+    # a digest of everything that goes into the profile guided optimized build
+    # of an extension: its sources, flags, compiler and profile data
+    hash = hashlib.sha256()
+    def update(value):
+        hash.update(json.dumps(value, default=str).encode('utf-8'))
+    def update_file(path):
+        try:
+            with open(path, 'rb') as f:
+                hash.update(f.read())
+        except OSError:
+            update(None)
+    compiler = build_ext.compiler
+    update(get_compiler_identity(compiler))
+    update([
+        getattr(compiler, name, None)
+        for name in ('compiler_so', 'linker_so')
+    ])
+    update([
+        build_ext.include_dirs,
+        build_ext.define,
+        build_ext.undef,
+        build_ext.libraries,
+        build_ext.library_dirs,
+        build_ext.rpath,
+        build_ext.link_objects,
+        build_ext.debug,
+    ])
+    update([
+        ext.name,
+        ext.sources,
+        ext.depends,
+        ext.define_macros,
+        ext.undef_macros,
+        ext.include_dirs,
+        ext.libraries,
+        ext.library_dirs,
+        ext.runtime_library_dirs,
+        ext.extra_objects,
+        ext.extra_compile_args,
+        ext.extra_link_args,
+        ext.export_symbols,
+        ext.language,
+    ])
+    for path in (*ext.sources, *ext.depends):
+        update_file(path)
+    for path in profile_files:
+        update(path)
+        update_file(path)
+    return hash.hexdigest()
+
+
+def _get_file_digest(path):
+    hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        hash.update(f.read())
+    return hash.hexdigest()
+
+
+def _is_profile_use_up_to_date(digest_path, digest, ext_path):
+    # the built extension is recorded as well, so that an extension that was
+    # replaced since (by a build without pgo for example) is rebuilt
+    try:
+        with open(digest_path, 'r', encoding='utf-8') as f:
+            record = json.load(f)
+        return (
+            record["digest"] == digest and
+            record["extension"] == _get_file_digest(ext_path)
+        )
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+
+def _write_profile_use_digest(digest_path, digest, ext_path):
+    os.makedirs(os.path.dirname(digest_path), exist_ok=True)
+    with open(digest_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            "digest": digest,
+            "extension": _get_file_digest(ext_path),
+        }, f)
+
+
+def _update_profile_use_digest(digest_path, ext_path):
+    # records the extension again after it was rewritten in place (by
+    # llvm-bolt), so that it's still seen as built from the profile data
+    try:
+        with open(digest_path, 'r', encoding='utf-8') as f:
+            digest = json.load(f)["digest"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return
+    _write_profile_use_digest(digest_path, digest, ext_path)
@@ -0,0 +1,202 @@
+
+__all__ = []
+
+# python
+from contextlib import contextmanager
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+# setuptools
+from distutils.log import info
+
+# the report being recorded by the running build, if any
+_report = None
+
+
+class _Report:
+    # records what happened during a build as a list of timed events, each
+    # event is recorded from the thread it happened on so that the work done
+    # side by side (compiling extensions, running workloads, merging) can be
+    # told apart
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.events = []
+        self._lock = threading.Lock()
+        # the thread that the build is run on is the first
+        self._thread_ids = {threading.get_ident(): 0}
+        self._local = threading.local()
+
+    @contextmanager
+    def event(self, name, category, **args):
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            thread = threading.get_ident()
+            with self._lock:
+                thread_id = self._thread_ids.setdefault(
+                    thread,
+                    len(self._thread_ids)
+                )
+                self.events.append({
+                    "name": name,
+                    "category": category,
+                    "start": start - self.start,
+                    "seconds": end - start,
+                    "thread": thread_id,
+                    **args,
+                })
+
+    @contextmanager
+    def extension(self, build_ext, ext):
+        self._report_compiler(build_ext.compiler)
+        with self.event(
+            ext.name,
+            'extension',
+            command=build_ext.get_command_name()
+        ):
+            self._local.extension = ext.name
+            try:
+                yield
+            finally:
+                self._local.extension = None
+
+    def _report_compiler(self, compiler):
+        # the compile and link of each extension are recorded by wrapping
+        # the compiler that build_ext uses, build_ext calls these for every
+        # extension (link_shared_object calls link)
+        if getattr(compiler, '_pgo_report', None) is self:
+            return
+        compiler._pgo_report = self
+        for method_name in ('compile', 'link'):
+            setattr(compiler, method_name, self._report_compiler_method(
+                method_name,
+                getattr(compiler, method_name)
+            ))
+
+    def _report_compiler_method(self, name, method):
+        def reported(*args, **kwargs):
+            extension = getattr(self._local, 'extension', None)
+            with self.event(extension or name, name):
+                return method(*args, **kwargs)
+        return reported
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "seconds": time.perf_counter() - self.start,
+                "events": sorted(self.events, key=lambda e: e["start"]),
+            }, f, indent=4)
+
+    def write_trace(self, path):
+        # the chrome trace event format, which can be loaded by
+        # chrome://tracing or https://ui.perfetto.dev
+        pid = os.getpid()
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "traceEvents": [
+                    {
+                        "name": event["name"],
+                        "cat": event["category"],
+                        "ph": "X",
+                        "ts": event["start"] * 1000000,
+                        "dur": event["seconds"] * 1000000,
+                        "pid": pid,
+                        "tid": event["thread"],
+                        "args": {
+                            key: value
+                            for key, value in event.items()
+                            if key not in (
+                                "name",
+                                "category",
+                                "start",
+                                "seconds",
+                                "thread",
+                            )
+                        },
+                    }
+                    for event in sorted(self.events, key=lambda e: e["start"])
+                ],
+                "displayTimeUnit": "ms",
+            }, f)
+
+
+@contextmanager
+def _reporting(distribution, report_path, trace_path):
+    # records the report for everything the distribution runs until this
+    # exits, each command run is an event
+    global _report
+    if report_path is None and trace_path is None:
+        yield
+        return
+    report = _report = _Report()
+    run_command = distribution.run_command
+    def reported_run_command(command):
+        if distribution.have_run.get(command):
+            return run_command(command)
+        with report.event(command, 'command'):
+            return run_command(command)
+    distribution.run_command = reported_run_command
+    try:
+        yield
+    finally:
+        del distribution.run_command
+        _report = None
+        if report_path is not None:
+            info('writing pgo report to %s', report_path)
+            report.write(report_path)
+        if trace_path is not None:
+            info('writing pgo trace to %s', trace_path)
+            report.write_trace(trace_path)
+
+
+@contextmanager
+def _report_extension(build_ext, ext):
+    if _report is None:
+        yield
+        return
+    with _report.extension(build_ext, ext):
+        yield
+
+
+@contextmanager
+def _report_event(name, category, **args):
+    if _report is None:
+        yield args
+        return
+    with _report.event(name, category, **args) as args:
+        yield args
+
+
+def _run_reported(name, category, command, **kwargs):
+    # runs a command like subprocess.run(check=True), recording it in the
+    # report with its cpu time and peak memory when those are available
+    with _report_event(name, category, command=list(command)) as args:
+        if _report is None or not hasattr(os, 'wait4'):
+            return subprocess.run(command, check=True, **kwargs)
+        process = subprocess.Popen(command, **kwargs)
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        args["cpu_seconds"] = usage.ru_utime + usage.ru_stime
+        # linux reports kilobytes, macos reports bytes, the peak carries over
+        # exec so it's at least what this process used when it was forked
+        args["peak_rss"] = usage.ru_maxrss * (
+            1 if sys.platform == 'darwin' else 1024
+        )
+        args["returncode"] = process.returncode
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        return subprocess.CompletedProcess(command, process.returncode)
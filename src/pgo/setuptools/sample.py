@@ -0,0 +1,123 @@
+
+__all__ = []
+
+# pgo
+from .compiler import is_clang
+from .error import ProfileError
+from .report import _run_reported
+# python
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+# setuptools
+from distutils.log import info, warn
+
+
+def _get_sample_profile(pgo_build_lib, extension):
+    return os.path.join(
+        pgo_build_lib,
+        f'.pgo-sample-profile-{extension.name}'
+    )
+
+
+def _get_perf_data_dir(pgo_build_temp):
+    return os.path.join(pgo_build_temp, '.pgo-perf')
+
+
+def _get_perf_record_command(perf_data, profile_command):
+    # "-b" samples the last branch records, which is what lets the profile
+    # converters recover branch counts
+    return (
+        'perf', 'record',
+        '-b',
+        '-e', 'cycles:u',
+        '-o', perf_data,
+        '--',
+        *profile_command
+    )
+
+
+def _check_sample_tools(compiler, record, merge):
+    # record is whether perf is run to collect the samples and merge is
+    # whether there's more than one perf data to merge into the profile
+    tools = []
+    if record:
+        tools.append('perf')
+    if is_clang(compiler):
+        tools += ['create_llvm_prof', 'llvm-profdata']
+    else:
+        tools.append('create_gcov')
+        if merge:
+            tools.append('profile_merger')
+    missing_tools = [tool for tool in tools if shutil.which(tool) is None]
+    if missing_tools:
+        raise ProfileError(
+            f'{", ".join(missing_tools)} not found, which is required for '
+            f'sample based pgo'
+        )
+
+
+def _create_sample_profile(compiler, ext_path, perf_datas, sample_profile):
+    # converts the perf data (and weight) for a single extension into the
+    # sample profile that the compiler reads
+    info('creating sample profile for %s', ext_path)
+    ext_name = os.path.basename(ext_path)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        profiles = []
+        for i, (perf_data, weight) in enumerate(perf_datas):
+            profile = os.path.join(temp_dir, f'{i}.afdo')
+            if is_clang(compiler):
+                _run_sample_tool(f'create_llvm_prof {ext_name}', [
+                    'create_llvm_prof',
+                    f'--binary={ext_path}',
+                    f'--profile={perf_data}',
+                    f'--out={profile}',
+                ])
+            else:
+                _run_sample_tool(f'create_gcov {ext_name}', [
+                    'create_gcov',
+                    f'--binary={ext_path}',
+                    f'--profile={perf_data}',
+                    f'--gcov={profile}',
+                ])
+            # the converters write nothing when none of the samples are in
+            # the extension
+            if os.path.exists(profile):
+                profiles.append((profile, weight))
+        if not profiles:
+            raise ProfileError(f'no samples were recorded for {ext_path}')
+        if is_clang(compiler):
+            _run_sample_tool(f'llvm-profdata {ext_name}', [
+                *(['xcrun'] if sys.platform == 'darwin' else []),
+                'llvm-profdata', 'merge',
+                '-sample',
+                f'-output={sample_profile}',
+                *(
+                    f'-weighted-input={weight},{profile}'
+                    for profile, weight in profiles
+                ),
+            ])
+        elif len(profiles) == 1:
+            shutil.copyfile(profiles[0][0], sample_profile)
+        else:
+            # gcc's auto profile format can only be merged by autofdo's
+            # profile_merger, which doesn't support weights
+            if any(weight != 1 for _, weight in profiles):
+                warn(
+                    'workload weights are not supported by gcc sample pgo, '
+                    'ignoring them'
+                )
+            _run_sample_tool(f'profile_merger {ext_name}', [
+                'profile_merger',
+                f'--output_file={sample_profile}',
+                *(profile for profile, _ in profiles),
+            ])
+
+
+def _run_sample_tool(name, command):
+    try:
+        _run_reported(name, 'sample', command)
+    except (OSError, subprocess.CalledProcessError) as ex:
+        raise ProfileError(ex)
@@ -154,6 +154,23 @@ def temp_dir():
         pass
 
 
+@pytest.fixture
+def make_temp_dir():
+    # for the other directories a test needs (such as a cache or profile data
+    # directory), each call makes a new one
+    dirs = []
+    def make_temp_dir():
+        dir = tempfile.TemporaryDirectory()
+        dirs.append(dir)
+        return dir.name
+    yield make_temp_dir
+    for dir in dirs:
+        try:
+            dir.cleanup()
+        except FileNotFoundError:
+            pass
+
+
 @pytest.fixture
 def install_dir():
     dir = tempfile.TemporaryDirectory()
@@ -0,0 +1,188 @@
+
+# pgo
+from pgo.setuptools import benchmark, report
+from pgo.setuptools.error import BenchmarkError
+# pytest
+import pytest
+# python
+import os
+import sys
+# setuptools
+import distutils.errors
+from setuptools import Distribution
+
+
+@pytest.fixture
+def distribution(extension):
+    return Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+            "benchmark_command": [sys.executable, '-c', 'import _pgo_test'],
+        }
+    })
+
+
+@pytest.fixture
+def benchmark_runs(monkeypatch):
+    # stands in for timing the benchmark command, the time depends on which
+    # build of the extension is in the build directory
+    times = {}
+    runs = []
+    def run_benchmark(build_lib, build_temp, benchmark_command):
+        ext_name = [
+            f for f in os.listdir(build_lib)
+            if f.startswith('_pgo_test')
+        ][0]
+        baseline_ext_path = os.path.join(
+            build_temp, '.pgo-benchmark', 'lib', ext_name
+        )
+        with open(os.path.join(build_lib, ext_name), 'rb') as f:
+            ext = f.read()
+        with open(baseline_ext_path, 'rb') as f:
+            variant = 'baseline' if ext == f.read() else 'pgo'
+        runs.append(variant)
+        return times[variant]
+    monkeypatch.setattr(benchmark, '_run_benchmark', run_benchmark)
+    return times, runs
+
+
+def test_default_options(argv, distribution):
+    argv.extend(['benchmark'])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.repeat == 7
+    assert cmd.margin == 0
+
+
+def test_set_options(argv, distribution):
+    argv.extend(['benchmark', '--repeat', '3', '--margin', '0.05'])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.repeat == 3
+    assert cmd.margin == 0.05
+
+
+def test_set_options_through_pgo(argv, distribution):
+    argv.extend(['benchmark'])
+    distribution.pgo["benchmark_repeat"] = 3
+    distribution.pgo["benchmark_margin"] = 0.05
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.repeat == 3
+    assert cmd.margin == 0.05
+
+
+@pytest.mark.parametrize('option, value', [
+    ('--repeat', '0'),
+    ('--repeat', 'x'),
+    ('--margin', '-0.1'),
+    ('--margin', '1'),
+    ('--margin', 'x'),
+])
+def test_set_options_invalid(argv, distribution, option, value):
+    argv.extend(['benchmark', option, value])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    with pytest.raises(distutils.errors.DistutilsOptionError):
+        cmd.ensure_finalized()
+
+
+def test_no_benchmark_command(argv, distribution):
+    argv.extend(['benchmark'])
+    del distribution.pgo["benchmark_command"]
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    with pytest.raises(distutils.errors.DistutilsSetupError):
+        cmd.ensure_finalized()
+
+
+@pytest.mark.parametrize('times, margin, accepted', [
+    ({"baseline": 2.0, "pgo": 1.0}, 0, True),
+    ({"baseline": 2.0, "pgo": 1.0}, 0.6, False),
+    ({"baseline": 1.0, "pgo": 2.0}, 0, False),
+    ({"baseline": 1.0, "pgo": 1.0}, 0, False),
+])
+def test_run(
+    argv, distribution, benchmark_runs, times, margin, accepted,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir
+):
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-verify',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    benchmark_times, runs = benchmark_runs
+    benchmark_times.update(times)
+    distribution.pgo["benchmark_repeat"] = 3
+    distribution.pgo["benchmark_margin"] = margin
+    distribution.parse_command_line()
+    distribution.run_commands()
+    cmd = distribution.get_command_obj('benchmark')
+    assert cmd.accepted == accepted
+    # the builds took turns
+    assert runs == [
+        'baseline', 'pgo',
+        'pgo', 'baseline',
+        'baseline', 'pgo',
+    ]
+    assert cmd.baseline_times == [times['baseline']] * 3
+    assert cmd.pgo_times == [times['pgo']] * 3
+    # the faster build was kept
+    ext_name = [f for f in os.listdir(lib_dir) if f.startswith('_pgo_test')][0]
+    with open(os.path.join(lib_dir, ext_name), 'rb') as f:
+        ext = f.read()
+    with open(os.path.join(cmd.baseline_lib, ext_name), 'rb') as f:
+        baseline_ext = f.read()
+    assert (ext != baseline_ext) == accepted
+
+
+def test_run_benchmark_command_fails(
+    argv, distribution,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir
+):
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-verify',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    distribution.pgo["benchmark_command"] = [
+        sys.executable, '-c', 'import sys; sys.exit(1)'
+    ]
+    distribution.parse_command_line()
+    with pytest.raises(BenchmarkError):
+        distribution.run_commands()
+
+
+def test_run_benchmark_reported(monkeypatch, pgo_lib_dir, pgo_temp_dir):
+    monkeypatch.setattr(report, '_report', report._Report())
+    benchmark_command = [sys.executable, '-c', 'pass']
+    benchmark._run_benchmark(pgo_lib_dir, pgo_temp_dir, benchmark_command)
+    # the benchmark runs aren't reported as profile runs
+    event, = report._report.events
+    assert event["category"] == 'benchmark'
+    assert event["command"] == benchmark_command
+
+
+@pytest.mark.parametrize('times, expected', [
+    ([3, 1, 2], (1, 3)),
+    ([5, 1, 4, 2, 3], (1, 5)),
+    ([6, 1, 5, 2, 4, 3], (1, 6)),
+    ([float(i) for i in range(10)], (1.0, 8.0)),
+    ([float(i) for i in range(20)], (5.0, 14.0)),
+])
+def test_median_confidence_interval(times, expected):
+    assert benchmark._get_median_confidence_interval(times) == expected
@@ -1,17 +1,19 @@
 
 # pgo
 import pgo
-from pgo.setuptools import compiler
+from pgo.setuptools import compiler, objectcache
 from pgo.setuptools.error import ProfileUseError
 # pytest
 import pytest
 # python
+import json
 import os
+import shutil
 import sys
 import textwrap
 # setuptools
 import distutils.errors
-from setuptools import Distribution
+from setuptools import Distribution, Extension
 
 
 @pytest.fixture
@@ -88,6 +90,34 @@ def test_set_disable(argv, distribution):
     assert cmd.pgo_disable
     
     
+def test_default_pgo_jobs(argv, distribution):
+    argv.extend(['build'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_jobs == (os.cpu_count() or 1)
+    
+    
+def test_set_pgo_jobs(argv, distribution):
+    argv.extend(['build', '--pgo-jobs', '3'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_jobs == 3
+    
+    
+@pytest.mark.parametrize('jobs', ['0', '-1', 'abc'])
+def test_set_pgo_jobs_invalid(argv, distribution, jobs):
+    argv.extend(['build', '--pgo-jobs', jobs])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    with pytest.raises(distutils.errors.DistutilsOptionError) as ex:
+        cmd.ensure_finalized()
+    
+    
 def test_set_require_and_disable(argv, distribution):
     argv.extend(['build', '--pgo-require', '--pgo-disable'])
     distribution.parse_command_line()
@@ -96,19 +126,409 @@ def test_set_require_and_disable(argv, distribution):
     with pytest.raises(distutils.errors.DistutilsOptionError) as ex:
         cmd.ensure_finalized()
     
-
-def test_set_pgo_build_dirs(argv, distribution):
+
+def test_set_pgo_build_dirs(argv, distribution):
+    argv.extend([
+        'build',
+        '--pgo-build-lib', 'build',
+        '--pgo-build-temp', 'temp',
+    ])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_build_lib == 'build'
+    assert cmd.pgo_build_temp == 'temp'
+    
+    
+def test_default_pgo_profile_cache(argv, distribution):
+    argv.extend(['build'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_profile_cache is None
+    
+    
+def test_set_pgo_profile_cache(argv, distribution):
+    argv.extend(['build', '--pgo-profile-cache', 'cache'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_profile_cache == 'cache'
+    
+    
+def test_set_pgo_profile_cache_through_pgo(argv, distribution):
+    argv.extend(['build'])
+    distribution.pgo["profile_cache"] = 'cache'
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_profile_cache == 'cache'
+    
+    
+def test_default_pgo_object_cache(argv, distribution):
+    argv.extend(['build'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_object_cache is None
+    
+    
+def test_set_pgo_object_cache(argv, distribution):
+    argv.extend(['build', '--pgo-object-cache', 'cache'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_object_cache == 'cache'
+    
+    
+def test_set_pgo_object_cache_through_pgo(argv, distribution):
+    argv.extend(['build'])
+    distribution.pgo["object_cache"] = 'cache'
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_object_cache == 'cache'
+    
+    
+def test_default_pgo_mode(argv, distribution):
+    argv.extend(['build'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_mode == 'instrument'
+    
+    
+def test_set_pgo_mode(argv, distribution):
+    argv.extend(['build', '--pgo-mode', 'cs'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_mode == 'cs'
+    
+    
+def test_set_pgo_mode_through_pgo(argv, distribution):
+    argv.extend(['build'])
+    distribution.pgo["mode"] = 'cs'
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_mode == 'cs'
+    
+    
+def test_set_pgo_mode_invalid(argv, distribution):
+    argv.extend(['build', '--pgo-mode', 'invalid'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    with pytest.raises(distutils.errors.DistutilsOptionError):
+        cmd.ensure_finalized()
+    
+    
+def test_default_pgo_lto(argv, distribution):
+    argv.extend(['build'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_lto == 'full'
+    assert cmd.pgo_lto_jobs is None
+    
+    
+def test_set_pgo_lto(argv, distribution):
+    argv.extend(['build', '--pgo-lto', 'thin', '--pgo-lto-jobs', '4'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_lto == 'thin'
+    assert cmd.pgo_lto_jobs == 4
+    
+    
+def test_set_pgo_lto_through_pgo(argv, distribution):
+    argv.extend(['build'])
+    distribution.pgo["lto"] = 'off-for-instrumented'
+    distribution.pgo["lto_jobs"] = 2
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_lto == 'off-for-instrumented'
+    assert cmd.pgo_lto_jobs == 2
+    
+    
+@pytest.mark.parametrize('options', [
+    ['--pgo-lto', 'invalid'],
+    ['--pgo-lto-jobs', '0'],
+    ['--pgo-lto-jobs', 'x'],
+])
+def test_set_pgo_lto_invalid(argv, distribution, options):
+    argv.extend(['build', *options])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    with pytest.raises(distutils.errors.DistutilsOptionError):
+        cmd.ensure_finalized()
+    
+    
+def test_default_pgo_counter_update(argv, distribution):
+    argv.extend(['build'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_counter_update is None
+    assert not cmd.pgo_no_profile_values
+    
+    
+def test_set_pgo_counter_update(argv, distribution):
+    argv.extend([
+        'build',
+        '--pgo-counter-update', 'atomic',
+        '--pgo-no-profile-values',
+    ])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_counter_update == 'atomic'
+    assert cmd.pgo_no_profile_values
+    
+    
+def test_set_pgo_counter_update_through_pgo(argv, distribution):
+    argv.extend(['build'])
+    distribution.pgo["counter_update"] = 'prefer-atomic'
+    distribution.pgo["profile_values"] = False
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_counter_update == 'prefer-atomic'
+    assert cmd.pgo_no_profile_values
+    
+    
+def test_set_pgo_counter_update_invalid(argv, distribution):
+    argv.extend(['build', '--pgo-counter-update', 'invalid'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    with pytest.raises(distutils.errors.DistutilsOptionError):
+        cmd.ensure_finalized()
+    
+    
+def test_default_pgo_perf_data(argv, distribution):
+    argv.extend(['build'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_perf_data == []
+    
+    
+def test_set_pgo_perf_data(argv, distribution):
+    argv.extend(['build', '--pgo-perf-data', os.pathsep.join(['a', 'b'])])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_perf_data == ['a', 'b']
+    
+    
+def test_set_pgo_perf_data_through_pgo(argv, distribution):
+    argv.extend(['build'])
+    distribution.pgo["perf_data"] = ['a', 'b']
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_perf_data == ['a', 'b']
+    
+    
+def test_default_pgo_profile_data_dir(argv, distribution):
+    argv.extend(['build'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_profile_data_dir == []
+    assert not cmd.pgo_profile_data_local
+    
+    
+def test_set_pgo_profile_data_dir(argv, distribution):
+    argv.extend([
+        'build',
+        '--pgo-profile-data-dir', os.pathsep.join(['a', 'b']),
+        '--pgo-profile-data-local',
+    ])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_profile_data_dir == ['a', 'b']
+    assert cmd.pgo_profile_data_local
+    
+    
+def test_set_pgo_profile_data_dir_through_pgo(argv, distribution):
+    argv.extend(['build'])
+    distribution.pgo["profile_data"] = 'a'
+    distribution.pgo["profile_data_local"] = True
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_profile_data_dir == ['a']
+    assert cmd.pgo_profile_data_local
+    
+    
+def test_set_pgo_profile_data_dir_not_instrument(argv, distribution):
+    argv.extend(['build', '--pgo-profile-data-dir', 'a', '--pgo-mode', 'cs'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    with pytest.raises(distutils.errors.DistutilsOptionError):
+        cmd.ensure_finalized()
+    
+    
+def test_default_pgo_profile_archive(argv, distribution):
+    argv.extend(['build'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_profile_archive is None
+    
+    
+def test_set_pgo_profile_archive(argv, distribution):
+    argv.extend(['build', '--pgo-profile-archive', 'profile.zip'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_profile_archive == 'profile.zip'
+    
+    
+def test_set_pgo_profile_archive_through_pgo(argv, distribution):
+    argv.extend(['build'])
+    distribution.pgo["profile_archive"] = 'profile.zip'
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_profile_archive == 'profile.zip'
+    
+    
+def test_set_pgo_profile_archive_not_instrument(argv, distribution):
+    argv.extend([
+        'build',
+        '--pgo-profile-archive', 'profile.zip',
+        '--pgo-mode', 'cs'
+    ])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    with pytest.raises(distutils.errors.DistutilsOptionError):
+        cmd.ensure_finalized()
+    
+    
+def test_default_pgo_bolt(argv, distribution):
+    argv.extend(['build'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert not cmd.pgo_bolt
+    
+    
+def test_set_pgo_bolt(argv, distribution):
+    argv.extend(['build', '--pgo-bolt'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_bolt
+    
+    
+def test_set_pgo_bolt_through_pgo(argv, distribution):
+    argv.extend(['build'])
+    distribution.pgo["bolt"] = True
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_bolt
+    
+    
+def test_default_pgo_verify(argv, distribution):
+    argv.extend(['build'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert not cmd.pgo_verify
+    
+    
+def test_set_pgo_verify(argv, distribution):
+    argv.extend(['build', '--pgo-verify'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_verify
+    
+    
+def test_set_pgo_verify_through_pgo(argv, distribution):
+    argv.extend(['build'])
+    distribution.pgo["verify"] = True
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_verify
+    
+    
+def test_default_pgo_report(argv, distribution):
+    argv.extend(['build'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_report is None
+    assert cmd.pgo_report_trace is None
+    
+    
+def test_set_pgo_report(argv, distribution):
     argv.extend([
         'build',
-        '--pgo-build-lib', 'build',
-        '--pgo-build-temp', 'temp',
+        '--pgo-report', 'report.json',
+        '--pgo-report-trace', 'trace.json',
     ])
     distribution.parse_command_line()
     assert len(distribution.commands) == 1
     cmd = distribution.get_command_obj(distribution.commands[0])
     cmd.ensure_finalized()
-    assert cmd.pgo_build_lib == 'build'
-    assert cmd.pgo_build_temp == 'temp'
+    assert cmd.pgo_report == 'report.json'
+    assert cmd.pgo_report_trace == 'trace.json'
+    
+    
+def test_set_pgo_report_through_pgo(argv, distribution):
+    argv.extend(['build'])
+    distribution.pgo["report"] = 'report.json'
+    distribution.pgo["report_trace"] = 'trace.json'
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.pgo_report == 'report.json'
+    assert cmd.pgo_report_trace == 'trace.json'
     
     
 def test_set_build_dirs(argv, distribution):
@@ -255,10 +675,11 @@ def test_run_no_profile_data_pgo_disabled(
     
     
 @pytest.mark.parametrize("required", [True, False])
+@pytest.mark.parametrize("jobs", ['1', '4'])
 def test_run(
     argv, distribution,
     extension, extension2, cython_extension, mypyc_extension,
-    required,
+    required, jobs,
     pgo_lib_dir, pgo_temp_dir,
     lib_dir, temp_dir,
     py_modules, packages
@@ -269,6 +690,7 @@ def test_run(
         '--pgo-build-temp', pgo_temp_dir,
         '--build-lib', lib_dir,
         '--build-temp', temp_dir,
+        '--pgo-jobs', jobs,
     ] + (['--pgo-require'] if required else []))
     distribution.parse_command_line()
     distribution.run_commands()
@@ -388,6 +810,642 @@ def test_run(
         assert package in lib_contents
         assert '__init__.py' in os.listdir(os.path.join(lib_dir, package))
 
+
+def test_run_report(
+    argv, extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir,
+    make_temp_dir
+):
+    profile_data_dir = make_temp_dir()
+    report_path = os.path.join(profile_data_dir, 'report.json')
+    trace_path = os.path.join(profile_data_dir, 'trace.json')
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-report', report_path,
+        '--pgo-report-trace', trace_path,
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+        }
+    })
+    distribution.parse_command_line()
+    distribution.run_commands()
+    with open(report_path) as f:
+        report = json.load(f)
+    events = report["events"]
+    def get_events(category, name=None):
+        return [
+            event for event in events
+            if event["category"] == category
+            if name is None or event["name"] == name
+        ]
+    # each sub-command
+    command_names = [event["name"] for event in get_events('command')]
+    for command_name in (
+        'build_profile_generate',
+        'build_ext_profile_generate',
+        'profile',
+        'build_profile_use',
+        'build_ext_profile_use',
+    ):
+        assert command_name in command_names
+    # each extension compile and link, for both builds
+    assert [
+        event["command"]
+        for event in get_events('extension', extension.name)
+    ] == ['build_ext_profile_generate', 'build_ext_profile_use']
+    assert len(get_events('compile', extension.name)) == 2
+    assert len(get_events('link', extension.name)) == 2
+    # the profile command
+    profile_event, = get_events('profile')
+    assert profile_event["command"] == [
+        sys.executable, '-c', 'import _pgo_test'
+    ]
+    if hasattr(os, 'wait4'):
+        assert profile_event["cpu_seconds"] >= 0
+        assert profile_event["peak_rss"] > 0
+    if compiler.is_clang(distribution.get_command_obj(
+        'build_ext_profile_use'
+    ).compiler):
+        assert get_events('merge', f'llvm-profdata {extension.name}')
+    # the trace has the same events
+    with open(trace_path) as f:
+        trace = json.load(f)
+    assert len(trace["traceEvents"]) == len(events)
+    assert all(event["ph"] == "X" for event in trace["traceEvents"])
+
+
+def test_run_profile_workloads(
+    argv, extension, cython_extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir
+):
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    distribution = Distribution({
+        "ext_modules": [extension, cython_extension],
+        "pgo": {
+            "profile_workloads": {
+                "test": {
+                    "profile_command": [
+                        sys.executable, '-c', 'import _pgo_test'
+                    ],
+                    "weight": 3,
+                },
+                "cython": {
+                    "profile_command": [
+                        sys.executable, '-c', 'import _pgo_test_cython'
+                    ],
+                },
+            }
+        }
+    })
+    distribution.parse_command_line()
+    distribution.run_commands()
+    lib_contents = os.listdir(lib_dir)
+    for ext in (extension, cython_extension):
+        assert [
+            f for f in lib_contents
+            if f.startswith(ext.name)
+            if f.endswith('.pyd') or f.endswith('.so')
+        ]
+
+
+@pytest.mark.skipif(sys.platform != 'linux', reason='not linux')
+def test_run_pgo_mode_cs_not_clang(
+    argv, extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir
+):
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-mode', 'cs',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+        }
+    })
+    distribution.parse_command_line()
+    distribution.run_commands()
+    # gcc has no context sensitive pgo, so the extension is built with the
+    # usual instrumented pgo
+    assert not distribution.have_run.get('build_ext_profile_cs_generate')
+    assert [
+        f for f in os.listdir(lib_dir)
+        if f.startswith(extension.name)
+        if f.endswith('.so')
+    ]
+
+
+@pytest.mark.skipif(sys.platform != 'linux', reason='not linux')
+def test_run_pgo_mode_sample_tools_missing(
+    argv, extension, monkeypatch,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir
+):
+    argv.extend([
+        'build',
+        '--pgo-mode', 'sample',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    monkeypatch.setattr(shutil, 'which', lambda tool: None)
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+        }
+    })
+    distribution.parse_command_line()
+    distribution.run_commands()
+    # without perf the extension is built without pgo
+    assert not distribution.have_run.get('build_profile_use')
+    assert [
+        f for f in os.listdir(lib_dir)
+        if f.startswith(extension.name)
+        if f.endswith('.so')
+    ]
+
+
+@pytest.mark.skipif(sys.platform != 'linux', reason='not linux')
+@pytest.mark.parametrize("local", [False, True])
+def test_run_profile_data_dir(
+    argv, extension, cython_extension, local,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir,
+    make_temp_dir
+):
+    profile_data_dir = make_temp_dir()
+    counter = os.path.join(temp_dir, 'counter')
+    def run(pgo_temp_dir, *args):
+        argv.extend([
+            'build',
+            '--pgo-require',
+            '--pgo-build-lib', pgo_lib_dir,
+            '--pgo-build-temp', pgo_temp_dir,
+            '--build-lib', lib_dir,
+            *args
+        ])
+        distribution = Distribution({
+            "ext_modules": [extension, cython_extension],
+            "pgo": {
+                "profile_command": [
+                    sys.executable, '-c', textwrap.dedent(f"""
+                        import _pgo_test
+                        import _pgo_test_cython
+                        with open({counter!r}, 'a') as f:
+                            f.write('x')
+                    """)
+                ]
+            }
+        })
+        distribution.parse_command_line()
+        distribution.run_commands()
+        del argv[1:]
+    # collect the profile data, as if it were from elsewhere, gcc's profile
+    # data depends on the path of the build directory so the same one is used
+    run(pgo_temp_dir)
+    for root, _, files in os.walk(pgo_temp_dir):
+        for file in files:
+            if file.endswith('.gcda'):
+                path = os.path.join(root, file)
+                target = os.path.join(
+                    profile_data_dir,
+                    os.path.relpath(path, pgo_temp_dir)
+                )
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(path, target)
+    # the imported profile data is used to optimize the extensions
+    run(
+        pgo_temp_dir,
+        '--pgo-profile-data-dir', profile_data_dir,
+        *(['--pgo-profile-data-local'] if local else [])
+    )
+    with open(counter) as f:
+        assert f.read() == ('xx' if local else 'x')
+    assert [
+        f for f in os.listdir(lib_dir)
+        if f.startswith(extension.name)
+        if f.endswith('.so')
+    ]
+
+
+def test_run_profile_data_dir_missing(
+    argv, extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir
+):
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+        '--pgo-profile-data-dir', os.path.join(temp_dir, 'missing'),
+    ])
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+        }
+    })
+    distribution.parse_command_line()
+    with pytest.raises(ProfileUseError):
+        distribution.run_commands()
+
+
+def test_run_profile_cache(
+    argv, extension, cython_extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir,
+    make_temp_dir
+):
+    profile_cache_dir = make_temp_dir()
+    counter = os.path.join(temp_dir, 'counter')
+    def run(*options):
+        argv.extend([
+            'build',
+            '--pgo-require',
+            '--pgo-build-lib', pgo_lib_dir,
+            '--pgo-build-temp', pgo_temp_dir,
+            '--build-lib', lib_dir,
+            '--pgo-profile-cache', profile_cache_dir,
+            *options,
+        ])
+        distribution = Distribution({
+            "ext_modules": [extension, cython_extension],
+            "pgo": {
+                "profile_command": [
+                    sys.executable, '-c', textwrap.dedent(f"""
+                        import _pgo_test
+                        import _pgo_test_cython
+                        with open({counter!r}, 'a') as f:
+                            f.write('x')
+                    """)
+                ]
+            }
+        })
+        distribution.parse_command_line()
+        distribution.run_commands()
+        del argv[1:]
+        # remove everything that was built, as if this were a fresh checkout
+        for dir in (pgo_lib_dir, pgo_temp_dir, lib_dir):
+            for root, _, files in os.walk(dir):
+                for file in files:
+                    os.remove(os.path.join(root, file))
+    run()
+    with open(counter) as f:
+        assert f.read() == 'x'
+    # the profile data for the first build was stored in the cache
+    assert os.listdir(profile_cache_dir)
+    # the second build is able to use the cached profile data, so it does not
+    # need to run the profile command
+    run()
+    with open(counter) as f:
+        assert f.read() == 'x'
+    # changing the sources invalidates the cache
+    extension.define_macros.append(('PGO_TEST_CACHE', '1'))
+    run()
+    with open(counter) as f:
+        assert f.read() == 'xx'
+    # so does changing how the extensions are instrumented on the command line
+    run('--pgo-lto', 'off-for-instrumented')
+    with open(counter) as f:
+        assert f.read() == 'xxx'
+
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='msvc /GL objects are not cached in the tests'
+)
+def test_run_object_cache(
+    argv, extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir,
+    make_temp_dir,
+    monkeypatch
+):
+    object_cache_dir = make_temp_dir()
+    stored = []
+    store_object = objectcache._store_object
+    def counted_store_object(object_cache, key, obj):
+        stored.append(obj)
+        return store_object(object_cache, key, obj)
+    monkeypatch.setattr(objectcache, '_store_object', counted_store_object)
+    def run():
+        argv.extend([
+            'build',
+            '--pgo-require',
+            '--pgo-build-lib', pgo_lib_dir,
+            '--pgo-build-temp', pgo_temp_dir,
+            '--build-lib', lib_dir,
+            '--build-temp', temp_dir,
+            '--pgo-object-cache', object_cache_dir,
+        ])
+        distribution = Distribution({
+            "ext_modules": [extension],
+            "pgo": {
+                "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+            }
+        })
+        distribution.parse_command_line()
+        distribution.run_commands()
+        del argv[1:]
+        # remove everything that was built, as if this were a fresh checkout
+        # (or "clean --all" was run)
+        for dir in (pgo_lib_dir, pgo_temp_dir, lib_dir, temp_dir):
+            for root, _, files in os.walk(dir):
+                for file in files:
+                    os.remove(os.path.join(root, file))
+    run()
+    # the instrumented object of the first build was stored in the cache
+    assert len(stored) == 1
+    assert os.listdir(object_cache_dir)
+    # the second build restores the instrumented object from the cache and
+    # is able to profile and optimize with it
+    run()
+    assert len(stored) == 1
+    # changing the flags invalidates the cached object
+    extension.extra_compile_args.append('-O1')
+    run()
+    assert len(stored) == 2
+    
+    
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='msvc /GL objects are not cached in the tests'
+)
+def test_run_object_cache_other_checkout(
+    argv, temp_dir, make_temp_dir,
+    monkeypatch
+):
+    object_cache_dir = make_temp_dir()
+    if not compiler._relocates_gcda(
+        compiler._new_compiler(None),
+        object_cache_dir,
+        os.path.join('build', 'pgo-temp')
+    ):
+        pytest.skip('only relocated gcc objects are shared between checkouts')
+    stored = []
+    store_object = objectcache._store_object
+    def counted_store_object(object_cache, key, obj):
+        stored.append(obj)
+        return store_object(object_cache, key, obj)
+    monkeypatch.setattr(objectcache, '_store_object', counted_store_object)
+    def run(checkout):
+        # each checkout is a directory of its own with the same relative
+        # sources and build directories
+        checkout_dir = os.path.join(temp_dir, checkout)
+        os.makedirs(os.path.join(checkout_dir, 'src'))
+        shutil.copyfile(
+            os.path.join(os.path.dirname(__file__), 'src', '_pgo_test.c'),
+            os.path.join(checkout_dir, 'src', '_pgo_test.c')
+        )
+        monkeypatch.chdir(checkout_dir)
+        argv.extend([
+            'build',
+            '--pgo-require',
+            '--pgo-build-lib', os.path.join('build', 'pgo-lib'),
+            '--pgo-build-temp', os.path.join('build', 'pgo-temp'),
+            '--build-lib', os.path.join('build', 'lib'),
+            '--build-temp', os.path.join('build', 'temp'),
+            '--pgo-object-cache', object_cache_dir,
+        ])
+        distribution = Distribution({
+            "ext_modules": [Extension(
+                '_pgo_test',
+                sources=[os.path.join('src', '_pgo_test.c')],
+                language='c'
+            )],
+            "pgo": {
+                "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+            }
+        })
+        distribution.parse_command_line()
+        try:
+            distribution.run_commands()
+        finally:
+            del argv[1:]
+    run('a')
+    assert len(stored) == 1
+    # the object restored into the other checkout writes its profile data
+    # there, which the optimized build matches to its functions
+    run('b')
+    assert len(stored) == 1
+    assert os.path.exists(os.path.join(
+        temp_dir, 'b', 'build', 'pgo-temp', 'src', '_pgo_test.gcda'
+    ))
+    assert not os.path.exists(compiler._RELOCATED_GCDA_ROOT)
+    
+    
+def test_object_cache_key_line_numbers(temp_dir):
+    # the paths of the headers aren't part of the key, their line numbers are
+    cc = compiler._new_compiler(None)
+    source = os.path.join(temp_dir, 'source.c')
+    with open(source, 'w') as f:
+        f.write('#include "header.h"\n')
+    def get_key(include_dir, code):
+        header = os.path.join(temp_dir, include_dir, 'header.h')
+        os.makedirs(os.path.dirname(header), exist_ok=True)
+        with open(header, 'w') as f:
+            f.write(code)
+        return objectcache._get_object_cache_key(
+            cc,
+            None,
+            source,
+            os.path.join(temp_dir, 'source.o'),
+            temp_dir,
+            None,
+            [os.path.join(temp_dir, include_dir)],
+            0,
+            None,
+            None
+        )
+    key = get_key('a', 'int f(void) { return 0; }\n')
+    assert key is not None
+    assert get_key('b', 'int f(void) { return 0; }\n') == key
+    assert get_key('a', '/* comment */\nint f(void) { return 0; }\n') != key
+    
+    
+@pytest.mark.parametrize('lto', ['full', 'thin', 'off-for-instrumented'])
+def test_run_lto(
+    argv, extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir,
+    lto
+):
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+        '--pgo-lto', lto,
+        '--pgo-lto-jobs', '2',
+    ])
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+        }
+    })
+    distribution.parse_command_line()
+    distribution.run_commands()
+    assert [
+        f for f in os.listdir(lib_dir)
+        if f.startswith(extension.name)
+    ]
+    
+    
+@pytest.mark.parametrize(
+    'counter_update',
+    ['single', 'atomic', 'prefer-atomic']
+)
+def test_run_counter_update(
+    argv, extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir,
+    counter_update
+):
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+        '--pgo-counter-update', counter_update,
+        '--pgo-no-profile-values',
+    ])
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "profile_command": [
+                sys.executable, '-c', textwrap.dedent("""
+                    import threading
+                    def run():
+                        import _pgo_test
+                    threads = [threading.Thread(target=run) for _ in range(4)]
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+                """)
+            ],
+        }
+    })
+    distribution.parse_command_line()
+    distribution.run_commands()
+    assert [
+        f for f in os.listdir(lib_dir)
+        if f.startswith(extension.name)
+    ]
+    
+    
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='the instrumented sources can not be chosen for msvc'
+)
+@pytest.mark.parametrize('globs, instrumented', [
+    ({"include": ['**/_pgo_test.c']}, True),
+    ({"include": ['src/*.c'], "exclude": ['_pgo_test.c']}, False),
+    ({"exclude": ['test/src/*.c']}, False),
+])
+def test_run_instrument_sources(
+    argv, extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir,
+    globs, instrumented
+):
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+            "instrument_sources": {extension.name: globs},
+        }
+    })
+    distribution.parse_command_line()
+    distribution.run_commands()
+    build_ext = distribution.get_command_obj('build_ext_profile_generate')
+    if not compiler.is_clang(compiler._new_compiler(build_ext.compiler)):
+        gcdas = [
+            f
+            for _, _, files in os.walk(pgo_temp_dir)
+            for f in files
+            if f.endswith('.gcda')
+        ]
+        assert bool(gcdas) == instrumented
+    # the sources that aren't instrumented are still optimized
+    assert [
+        f for f in os.listdir(lib_dir)
+        if f.startswith(extension.name)
+    ]
+
+
+@pytest.mark.parametrize('instrument_sources', [
+    ['_pgo_test.c'],
+    {"_pgo_test": ['_pgo_test.c']},
+    {"_pgo_test": {"only": ['_pgo_test.c']}},
+    {"_pgo_test": {"include": '_pgo_test.c'}},
+    {"_pgo_test": {"exclude": ['']}},
+])
+def test_run_instrument_sources_invalid(
+    argv, extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir,
+    instrument_sources
+):
+    argv.extend([
+        'build',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+            "instrument_sources": instrument_sources,
+        }
+    })
+    distribution.parse_command_line()
+    with pytest.raises(distutils.errors.DistutilsSetupError):
+        distribution.run_commands()
+    
     
 def test_run_pgo_disabled(
     argv, distribution,
@@ -0,0 +1,288 @@
+
+# pgo
+from pgo.setuptools import bolt, profileuse
+from pgo.setuptools.error import BoltError
+# pytest
+import pytest
+# python
+import os
+import shutil
+import sys
+from types import SimpleNamespace
+# setuptools
+from distutils.ccompiler import CCompiler
+import distutils.errors
+from setuptools import Distribution
+
+
+@pytest.fixture
+def distribution(extension):
+    return Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+        }
+    })
+
+
+@pytest.fixture
+def bolt_tools(monkeypatch):
+    # stands in for llvm-bolt and friends, which are rarely installed
+    commands = []
+    def run_bolt_tool(name, command, stdout=None):
+        commands.append(command)
+        if command[0] == 'llvm-bolt':
+            # llvm-bolt rewrites the extension
+            output = command[command.index('-o') + 1]
+            shutil.copyfile(command[1], output)
+            with open(output, 'ab') as f:
+                f.write(b'bolted')
+            for arg in command:
+                if arg.startswith('-instrumentation-file='):
+                    fdata = arg[len('-instrumentation-file='):]
+                    with open(f'{fdata}.1234.fdata', 'w') as f:
+                        f.write('instrumented')
+        elif command[0] == 'merge-fdata':
+            stdout.write(b'merged')
+        else:
+            raise BoltError(f'{command[0]} not found')
+    monkeypatch.setattr(bolt.shutil, 'which', lambda tool: tool)
+    monkeypatch.setattr(bolt, '_run_bolt_tool', run_bolt_tool)
+    return commands
+
+
+def test_default_profiler(argv, distribution):
+    argv.extend(['build_ext_bolt'])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.profiler == 'perf'
+
+
+def test_set_profiler(argv, distribution):
+    argv.extend(['build_ext_bolt', '--profiler', 'instrument'])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.profiler == 'instrument'
+
+
+def test_set_profiler_through_pgo(argv, distribution):
+    argv.extend(['build_ext_bolt'])
+    distribution.pgo["bolt_profiler"] = 'instrument'
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.profiler == 'instrument'
+
+
+def test_set_profiler_invalid(argv, distribution):
+    argv.extend(['build_ext_bolt', '--profiler', 'invalid'])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    with pytest.raises(distutils.errors.DistutilsOptionError):
+        cmd.ensure_finalized()
+
+
+def test_set_jobs_through_build(argv, distribution):
+    argv.extend(['build_ext_bolt', 'build', '--pgo-jobs', '3'])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.jobs == 3
+
+
+@pytest.mark.skipif(sys.platform != 'linux', reason='not linux')
+def test_run_tools_missing(
+    argv, distribution, monkeypatch,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir
+):
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-bolt',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    monkeypatch.setattr(bolt.shutil, 'which', lambda tool: None)
+    distribution.parse_command_line()
+    distribution.run_commands()
+    # the profile guided optimized extension is left as is
+    assert [
+        f for f in os.listdir(lib_dir)
+        if f.startswith('_pgo_test')
+        if f.endswith('.so')
+    ]
+    build_ext = distribution.get_command_obj('build_ext_profile_use')
+    assert build_ext.bolt_extensions == ['_pgo_test']
+
+
+@pytest.mark.skipif(sys.platform != 'linux', reason='not linux')
+def test_run_not_linux(
+    argv, distribution, monkeypatch,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir
+):
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-bolt',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    commands = []
+    spawn = CCompiler.spawn
+    def recorded_spawn(self, cmd, *args, **kwargs):
+        commands.append(cmd)
+        return spawn(self, cmd, *args, **kwargs)
+    monkeypatch.setattr(CCompiler, 'spawn', recorded_spawn)
+    # the extensions are built as if on another platform, whose linker (such
+    # as macos' ld64) would reject the flags llvm-bolt needs, distutils
+    # itself still builds for linux
+    monkeypatch.setattr(
+        profileuse,
+        'sys',
+        SimpleNamespace(**{**vars(sys), "platform": 'darwin'})
+    )
+    distribution.parse_command_line()
+    distribution.run_commands()
+    assert commands
+    assert not [
+        command for command in commands
+        if '-Wl,--emit-relocs' in command or
+        '-fno-reorder-blocks-and-partition' in command
+    ]
+    build_ext = distribution.get_command_obj('build_ext_profile_use')
+    assert build_ext.bolt_extensions == []
+    assert [
+        f for f in os.listdir(lib_dir)
+        if f.startswith('_pgo_test')
+        if f.endswith('.so')
+    ]
+
+
+@pytest.mark.skipif(sys.platform != 'linux', reason='not linux')
+def test_run_instrument(
+    argv, distribution, bolt_tools,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir
+):
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-bolt',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    distribution.pgo["bolt_profiler"] = 'instrument'
+    distribution.parse_command_line()
+    distribution.run_commands()
+    ext_path = distribution.get_command_obj(
+        'build_ext_profile_use'
+    ).get_ext_fullpath('_pgo_test')
+    # the extension was instrumented, profiled and then optimized
+    assert [command[0] for command in bolt_tools] == [
+        'llvm-bolt',
+        'merge-fdata',
+        'llvm-bolt',
+    ]
+    assert '-instrument' in bolt_tools[0]
+    assert bolt_tools[2][1] == ext_path
+    data = [arg for arg in bolt_tools[2] if arg.startswith('-data=')]
+    with open(data[0][len('-data='):]) as f:
+        assert f.read() == 'merged'
+    # nothing is left behind next to the extension
+    assert sorted(os.listdir(os.path.dirname(ext_path))) == [
+        os.path.basename(ext_path)
+    ]
+
+
+@pytest.mark.skipif(sys.platform != 'linux', reason='not linux')
+def test_run_up_to_date(
+    argv, extension, bolt_tools,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir
+):
+    def run():
+        argv.extend([
+            'build',
+            '--pgo-require',
+            '--pgo-bolt',
+            '--pgo-build-lib', pgo_lib_dir,
+            '--pgo-build-temp', pgo_temp_dir,
+            '--build-lib', lib_dir,
+            '--build-temp', temp_dir,
+        ])
+        distribution = Distribution({
+            "ext_modules": [extension],
+            "pgo": {
+                "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+                "bolt_profiler": 'instrument',
+            }
+        })
+        distribution.parse_command_line()
+        distribution.run_commands()
+        del argv[1:]
+        return distribution.get_command_obj('build_ext_profile_use')
+    build_ext = run()
+    assert build_ext.bolt_extensions == ['_pgo_test']
+    # the extension optimized by llvm-bolt is still up to date with the
+    # profile data, so it's neither rebuilt nor optimized again
+    commands = len(bolt_tools)
+    build_ext = run()
+    assert build_ext.bolt_extensions == []
+    assert len(bolt_tools) == commands
+
+
+@pytest.mark.skipif(sys.platform != 'linux', reason='not linux')
+def test_run_bolt_error_pgo_not_required(
+    argv, distribution, bolt_tools,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir
+):
+    argv.extend([
+        'build',
+        '--pgo-bolt',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    # perf isn't handled by the stand in tools
+    distribution.pgo["bolt_profiler"] = 'perf'
+    distribution.parse_command_line()
+    distribution.run_commands()
+    # the profile guided optimized extension is left as is
+    assert [
+        f for f in os.listdir(lib_dir)
+        if f.startswith('_pgo_test')
+        if f.endswith('.so')
+    ]
+
+
+@pytest.mark.skipif(sys.platform != 'linux', reason='not linux')
+def test_run_bolt_error_pgo_required(
+    argv, distribution, bolt_tools,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir
+):
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-bolt',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    distribution.pgo["bolt_profiler"] = 'perf'
+    distribution.parse_command_line()
+    with pytest.raises(BoltError):
+        distribution.run_commands()
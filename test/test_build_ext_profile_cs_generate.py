@@ -0,0 +1,113 @@
+
+# pgo
+from pgo.setuptools import compiler
+# pytest
+import pytest
+# python
+import os
+import sys
+# setuptools
+import distutils.errors
+from setuptools import Distribution
+
+
+@pytest.fixture
+def distribution(extension, extension2):
+    return Distribution({
+        "ext_modules": [extension, extension2],
+        "pgo": {
+            "ignore_extensions": [extension2.name],
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+        }
+    })
+
+
+@pytest.mark.parametrize('dist_kwargs', [
+    {},
+    {"pgo": {}},
+])
+def test_not_available_with_no_profile_command(argv, extension, dist_kwargs):
+    argv.extend(['build_ext_profile_cs_generate'])
+    distribution = Distribution({
+        "ext_modules": [extension],
+        **dist_kwargs,
+    })
+    with pytest.raises(distutils.errors.DistutilsArgError):
+        distribution.parse_command_line()
+
+
+def test_default_build_dirs(argv, distribution):
+    argv.extend(['build_ext_profile_cs_generate'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    # for msvc the build_temp directory has Release/Debug attached to it
+    if compiler.is_msvc(cmd.compiler):
+        build_temp = os.path.dirname(cmd.build_temp)
+    else:
+        build_temp = cmd.build_temp
+    assert os.path.basename(cmd.build_lib).startswith('.pgo-')
+    assert os.path.basename(build_temp).startswith('.pgo-')
+
+
+def test_set_pgo_build_dirs_through_build(argv, distribution):
+    argv.extend([
+        'build_ext_profile_cs_generate',
+        'build',
+        '--pgo-build-lib', 'build',
+        '--pgo-build-temp', 'temp',
+    ])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 2
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    # for msvc the build_temp directory has Release/Debug attached to it
+    if compiler.is_msvc(cmd.compiler):
+        build_temp = os.path.dirname(cmd.build_temp)
+    else:
+        build_temp = cmd.build_temp
+    assert cmd.build_lib == 'build'
+    assert build_temp == 'temp'
+
+
+def test_set_parallel_through_build(argv, distribution):
+    argv.extend([
+        'build_ext_profile_cs_generate',
+        'build',
+        '--pgo-jobs', '3',
+    ])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 2
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.parallel == 3
+
+
+@pytest.mark.skipif(sys.platform != 'darwin', reason='not macos')
+def test_run_clang(
+    argv, distribution,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir
+):
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-mode', 'cs',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    distribution.parse_command_line()
+    distribution.run_commands()
+    # the context sensitive round wrote its raw profile data apart from the
+    # first round's
+    profraw_files = os.listdir(
+        os.path.join(pgo_temp_dir, '.pgo-cs-profdatas', '_pgo_test')
+    )
+    assert [f for f in profraw_files if f.endswith('.profraw')]
+    # and the profile data of both rounds was merged for the optimized build
+    lib_contents = os.listdir(pgo_lib_dir)
+    assert '.pgo-profdata-_pgo_test' in lib_contents
+    assert '.pgo-cs-profdata-_pgo_test' in lib_contents
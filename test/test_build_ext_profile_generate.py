@@ -134,6 +134,29 @@ def test_set_build_dirs_through_build(argv, distribution):
         build_temp = cmd.build_temp
     assert cmd.build_lib == '.pgo-build'
     assert build_temp == '.pgo-temp'
+    
+    
+def test_default_parallel(argv, distribution):
+    argv.extend(['build_ext_profile_generate'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.parallel == (os.cpu_count() or 1)
+    
+    
+def test_set_parallel_through_build(argv, distribution):
+    argv.extend([
+        'build_ext_profile_generate',
+        'build',
+        '--pgo-jobs', '3',
+    ])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 2
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.parallel == 3
+
 
     
 @pytest.mark.skipif(sys.platform != 'win32', reason='not windows')
@@ -232,6 +255,13 @@ def test_run_not_windows(
         if f.startswith(mypyc_extension.name)
         if f.endswith('.so')
     ]
+    # the coverage notes are only written for profile_report
+    assert not [
+        f
+        for _, _, files in os.walk(pgo_temp_dir)
+        for f in files
+        if f.endswith('.gcno')
+    ]
 
 
 def test_dry_run(argv, distribution, pgo_lib_dir, pgo_temp_dir, extension):
@@ -1,7 +1,7 @@
 
 # pgo
 import pgo
-from pgo.setuptools import compiler
+from pgo.setuptools import compiler, profileuse
 from pgo.setuptools.error import ProfileUseError
 # pytest
 import pytest
@@ -10,6 +10,7 @@ import os
 import sys
 import textwrap
 # setuptools
+from distutils.ccompiler import CCompiler
 import distutils.errors
 from setuptools import Distribution
 
@@ -133,6 +134,29 @@ def test_set_build_dirs_through_build(argv, distribution):
     assert cmd.pgo_build_lib == '.pgo-build'
     assert build_temp == '.pgo-temp'
 
+    
+    
+def test_default_parallel(argv, distribution):
+    argv.extend(['build_ext_profile_use'])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 1
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.parallel == (os.cpu_count() or 1)
+    
+    
+def test_set_parallel_through_build(argv, distribution):
+    argv.extend([
+        'build_ext_profile_use',
+        'build',
+        '--pgo-jobs', '3',
+    ])
+    distribution.parse_command_line()
+    assert len(distribution.commands) == 2
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.parallel == 3
+
 
 def test_run_no_profile_data(
     argv, distribution,
@@ -274,6 +298,274 @@ def test_run_not_windows(
     ]
     
 
+@pytest.mark.skipif(sys.platform != 'linux', reason='not linux')
+def test_run_incremental(
+    argv, extension, cython_extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir
+):
+    def run():
+        argv.extend([
+            'build',
+            '--pgo-require',
+            '--pgo-build-lib', pgo_lib_dir,
+            '--pgo-build-temp', pgo_temp_dir,
+            '--build-lib', lib_dir,
+            '--build-temp', temp_dir,
+        ])
+        distribution = Distribution({
+            "ext_modules": [extension, cython_extension],
+            "pgo": {
+                "profile_workloads": {
+                    "test": {
+                        "profile_command": [
+                            sys.executable, '-c', textwrap.dedent("""
+                                import _pgo_test
+                                import _pgo_test_cython
+                            """)
+                        ],
+                    },
+                },
+            }
+        })
+        distribution.parse_command_line()
+        distribution.run_commands()
+        del argv[1:]
+        build_ext = distribution.get_command_obj('build_ext_profile_use')
+        return [
+            os.stat(build_ext.get_ext_fullpath(ext.name)).st_mtime_ns
+            for ext in (extension, cython_extension)
+        ]
+    ext_mtime, cython_ext_mtime = run()
+    # nothing changed, so nothing is rebuilt
+    assert run() == [ext_mtime, cython_ext_mtime]
+    # the changed extension is instrumented and profiled again, which doesn't
+    # change the profile data of the other extension
+    extension.define_macros.append(('PGO_TEST_CHANGED', '1'))
+    new_ext_mtime, new_cython_ext_mtime = run()
+    assert new_ext_mtime != ext_mtime
+    assert new_cython_ext_mtime == cython_ext_mtime
+    
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='the profile coverage is not checked for msvc'
+)
+@pytest.mark.parametrize('pgo_require', [False, True])
+@pytest.mark.parametrize('min_coverage', [
+    {"min_function_coverage": 1},
+    {"min_block_coverage": 1},
+    {"min_function_coverage": {"_pgo_test_cython": 1}},
+    {"min_block_coverage": {"_pgo_test_cython": 1, "_pgo_test": 0.5}},
+])
+def test_run_min_coverage(
+    argv, extension, cython_extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir,
+    pgo_require, min_coverage
+):
+    argv.extend([
+        'build',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    if pgo_require:
+        argv.append('--pgo-require')
+    distribution = Distribution({
+        "ext_modules": [extension, cython_extension],
+        "pgo": {
+            "profile_command": [
+                sys.executable, '-c', textwrap.dedent("""
+                    import _pgo_test
+                    import _pgo_test_cython
+                """)
+            ],
+            **min_coverage,
+        }
+    })
+    distribution.parse_command_line()
+    # the module init is all that's run in either extension, which is all of
+    # _pgo_test, but only a part of the cython extension
+    if pgo_require:
+        with pytest.raises(ProfileUseError):
+            distribution.run_commands()
+        return
+    distribution.run_commands()
+    cmd = distribution.get_command_obj('build_ext_profile_use')
+    assert cmd.undercovered_extensions == {cython_extension.name}
+    lib_contents = os.listdir(lib_dir)
+    assert [
+        f for f in lib_contents
+        if f.startswith(cython_extension.name)
+        if f.endswith('.pyd') or f.endswith('.so')
+    ]
+
+
+@pytest.mark.parametrize('min_coverage', [
+    -0.1,
+    1.1,
+    'x',
+    True,
+    {"_pgo_test": 2},
+])
+def test_run_min_coverage_invalid(
+    argv, extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir,
+    min_coverage
+):
+    argv.extend([
+        'build',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+            "min_function_coverage": min_coverage,
+        }
+    })
+    distribution.parse_command_line()
+    with pytest.raises(distutils.errors.DistutilsSetupError):
+        distribution.run_commands()
+    
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='partial training is not supported by msvc'
+)
+@pytest.mark.parametrize('partial_training, expected', [
+    (True, {"_pgo_test": True, "_pgo_test_cython": True}),
+    (["_pgo_test_cython"], {"_pgo_test": False, "_pgo_test_cython": True}),
+    (False, {"_pgo_test": False, "_pgo_test_cython": False}),
+])
+def test_run_partial_training(
+    argv, extension, cython_extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir,
+    monkeypatch,
+    partial_training, expected
+):
+    partially_trained = {}
+    get_partial_training = profileuse._get_partial_training
+    def recorded_get_partial_training(pgo, ext_name):
+        result = get_partial_training(pgo, ext_name)
+        partially_trained[ext_name] = result
+        return result
+    monkeypatch.setattr(
+        profileuse,
+        '_get_partial_training',
+        recorded_get_partial_training
+    )
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    distribution = Distribution({
+        "ext_modules": [extension, cython_extension],
+        "pgo": {
+            "profile_command": [
+                sys.executable, '-c', textwrap.dedent("""
+                    import _pgo_test
+                    import _pgo_test_cython
+                """)
+            ],
+            "partial_training": partial_training,
+        }
+    })
+    distribution.parse_command_line()
+    distribution.run_commands()
+    assert partially_trained == expected
+    lib_contents = os.listdir(lib_dir)
+    assert [
+        f for f in lib_contents
+        if f.startswith(cython_extension.name)
+        if f.endswith('.so')
+    ]
+
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='sample pgo is not supported by msvc'
+)
+def test_run_sample(
+    argv, extension, monkeypatch,
+    pgo_lib_dir,
+    lib_dir, temp_dir
+):
+    # the sample profile is matched to the code by its debug info, so the
+    # optimized build has the same debug info as the profiled build
+    sample_profile = os.path.join(pgo_lib_dir, '.pgo-sample-profile-_pgo_test')
+    open(sample_profile, 'w').close()
+    commands = []
+    def recorded_spawn(self, cmd, *args, **kwargs):
+        # the compiler isn't run, it would reject the empty sample profile
+        commands.append(cmd)
+        output = cmd[cmd.index('-o') + 1]
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        open(output, 'w').close()
+    monkeypatch.setattr(CCompiler, 'spawn', recorded_spawn)
+    argv.extend([
+        'build_ext_profile_use',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "mode": "sample",
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+        }
+    })
+    distribution.parse_command_line()
+    distribution.run_commands()
+    debug_flags = ['-g']
+    if compiler.is_clang(
+        distribution.get_command_obj('build_ext_profile_use').compiler
+    ):
+        debug_flags.append('-fdebug-info-for-profiling')
+    compile_commands = [command for command in commands if '-c' in command]
+    assert compile_commands
+    for command in compile_commands:
+        assert all(flag in command for flag in debug_flags)
+
+
+@pytest.mark.parametrize('partial_training', ['_pgo_test', [1], 1])
+def test_run_partial_training_invalid(
+    argv, extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir,
+    partial_training
+):
+    argv.extend([
+        'build',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+            "partial_training": partial_training,
+        }
+    })
+    distribution.parse_command_line()
+    with pytest.raises(distutils.errors.DistutilsSetupError):
+        distribution.run_commands()
+
+
 def test_dry_run(argv, distribution, pgo_lib_dir, pgo_temp_dir):
     argv.extend([
         '--dry-run',
@@ -0,0 +1,189 @@
+
+# pgo
+from pgo.setuptools import compiler
+# pytest
+import pytest
+# python
+import subprocess
+import sys
+# setuptools
+from distutils.ccompiler import new_compiler
+from distutils.sysconfig import customize_compiler
+
+
+@pytest.fixture
+def ccompiler():
+    ccompiler = new_compiler()
+    customize_compiler(ccompiler)
+    return ccompiler
+
+
+def test_identity_is_cached(ccompiler, monkeypatch):
+    compiler.get_compiler_identity(ccompiler)
+    def run(*args, **kwargs):
+        raise AssertionError('the compiler was probed again')
+    monkeypatch.setattr(subprocess, 'run', run)
+    compiler.get_compiler_identity(ccompiler)
+    compiler.is_clang(ccompiler)
+    compiler.is_msvc(ccompiler)
+
+
+def test_is_msvc_does_not_probe(monkeypatch):
+    def run(*args, **kwargs):
+        raise AssertionError('the compiler was probed')
+    monkeypatch.setattr(subprocess, 'run', run)
+    assert compiler.is_msvc('msvc')
+    assert not compiler.is_msvc('unix')
+    assert compiler.is_msvc(None) == (sys.platform == 'win32')
+
+
+@pytest.mark.skipif(sys.platform != 'linux', reason='not linux')
+def test_identity_gcc(ccompiler):
+    identity = compiler.get_compiler_identity(ccompiler)
+    assert identity.vendor == 'gcc'
+    assert identity.version
+    assert all(isinstance(part, int) for part in identity.version)
+    # gcc 7 added -fprofile-update
+    assert identity.supports_profile_update == (identity.version >= (7,))
+    # -mllvm only means something to clang
+    assert not identity.supports_pgso
+
+
+@pytest.mark.skipif(sys.platform != 'darwin', reason='not macos')
+def test_identity_clang(ccompiler):
+    identity = compiler.get_compiler_identity(ccompiler)
+    assert identity.vendor == 'clang'
+    assert identity.version
+    assert not identity.supports_profile_partial_training
+
+
+@pytest.mark.skipif(sys.platform != 'win32', reason='not windows')
+def test_identity_msvc(ccompiler):
+    identity = compiler.get_compiler_identity(ccompiler)
+    assert identity.vendor == 'msvc'
+    assert not identity.supports_profile_update
+    assert not identity.supports_profile_partial_training
+    assert not identity.supports_lto_auto
+    assert not identity.supports_pgso
+
+
+def test_identity_not_found():
+    identity = compiler._get_cc_identity('pgo-compiler-that-does-not-exist')
+    assert identity.vendor == 'unknown'
+    assert identity.version is None
+    assert not identity.supports_profile_update
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='not gcc or clang')
+@pytest.mark.parametrize('lto, lto_jobs, instrumented', [
+    ('full', None, False),
+    ('full', 4, True),
+    ('thin', 4, False),
+    ('off-for-instrumented', 4, False),
+    ('off-for-instrumented', 4, True),
+])
+def test_get_lto_flags(ccompiler, lto, lto_jobs, instrumented):
+    compile_flags, link_flags = compiler._get_lto_flags(
+        ccompiler,
+        lto,
+        lto_jobs,
+        instrumented
+    )
+    if lto == 'off-for-instrumented' and instrumented:
+        assert compile_flags == link_flags == []
+    elif compiler.is_clang(ccompiler):
+        if lto == 'thin':
+            assert compile_flags == ['-flto=thin']
+            assert link_flags == ['-flto=thin', '-flto-jobs=4']
+        else:
+            assert compile_flags == link_flags == ['-flto']
+    elif lto_jobs is None:
+        assert compile_flags == link_flags == ['-flto=auto']
+    else:
+        assert compile_flags == link_flags == ['-flto=4']
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='not gcc or clang')
+@pytest.mark.parametrize('counter_update', [None, 'atomic'])
+@pytest.mark.parametrize('profile_values', [True, False])
+def test_get_instrumentation_flags(ccompiler, counter_update, profile_values):
+    flags = compiler._get_instrumentation_flags(
+        ccompiler,
+        counter_update,
+        profile_values
+    )
+    expected = []
+    if (
+        counter_update is not None and
+        compiler.get_compiler_identity(ccompiler).supports_profile_update
+    ):
+        expected.append('-fprofile-update=atomic')
+    if not profile_values:
+        if compiler.is_clang(ccompiler):
+            expected.extend(['-mllvm', '-disable-vp=true'])
+        else:
+            expected.append('-fno-profile-values')
+    assert flags == expected
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='not gcc or clang')
+def test_get_partial_training_flags(ccompiler):
+    flags = compiler._get_partial_training_flags(ccompiler)
+    identity = compiler.get_compiler_identity(ccompiler)
+    if compiler.is_clang(ccompiler):
+        if identity.supports_pgso:
+            assert flags == ['-mllvm', '-pgso=false']
+        else:
+            assert flags == []
+    elif identity.supports_profile_partial_training:
+        assert flags == ['-fprofile-partial-training']
+    else:
+        assert flags == []
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='not gcc or clang')
+def test_get_partial_training_flags_pgso_not_supported(
+    ccompiler,
+    monkeypatch
+):
+    # -pgso is an internal llvm option that a clang may not have
+    monkeypatch.setattr(
+        compiler,
+        'get_compiler_identity',
+        lambda ccompiler: compiler.CompilerIdentity(
+            'clang',
+            (15,),
+            True,
+            False,
+            True,
+            False,
+            False
+        )
+    )
+    assert compiler._get_partial_training_flags(ccompiler) == []
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='not gcc or clang')
+def test_get_instrument_sources_flags(ccompiler, temp_dir):
+    flags = compiler._get_instrument_sources_flags(
+        ccompiler,
+        temp_dir,
+        ['src/*.c', '/abs/**'],
+        ['src/vendor?.c']
+    )
+    if compiler.is_clang(ccompiler):
+        flag, = flags
+        assert flag.startswith('-fprofile-list=')
+        with open(flag[len('-fprofile-list='):]) as f:
+            assert f.read().splitlines() == [
+                'src:src/*.c',
+                'src:*/src/*.c',
+                'src:/abs/*',
+                '!src:src/vendor?.c',
+                '!src:*/src/vendor?.c',
+            ]
+    else:
+        assert flags == [
+            '-fprofile-filter-files=^(.*/)?src/[^/]*\\.c$;^/abs/.*$',
+            '-fprofile-exclude-files=^(.*/)?src/vendor[^/]\\.c$',
+        ]
@@ -0,0 +1,232 @@
+
+# pgo
+from pgo.__main__ import main
+from pgo.setuptools import compiler
+# pytest
+import pytest
+# python
+import json
+import os
+import shutil
+import sys
+import time
+# setuptools
+from setuptools import Distribution
+
+
+@pytest.fixture
+def is_clang():
+    build_ext = Distribution().get_command_obj('build_ext')
+    build_ext.ensure_finalized()
+    return compiler.is_clang(compiler._new_compiler(build_ext.compiler))
+
+
+@pytest.fixture
+def profile_data(
+    argv, extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir,
+    make_temp_dir,
+    is_clang
+):
+    # the profile data of a build, laid out like --pgo-profile-data-dir
+    profile_data_dir = make_temp_dir()
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    ])
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+        }
+    })
+    distribution.parse_command_line()
+    distribution.run_commands()
+    if is_clang:
+        shutil.copytree(
+            compiler._get_profdata_dir(pgo_temp_dir),
+            profile_data_dir,
+            dirs_exist_ok=True
+        )
+    else:
+        for root, _, files in os.walk(pgo_temp_dir):
+            for file in files:
+                if file.endswith('.gcda'):
+                    path = os.path.join(root, file)
+                    target = os.path.join(
+                        profile_data_dir,
+                        os.path.relpath(path, pgo_temp_dir)
+                    )
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.copyfile(path, target)
+    return profile_data_dir
+
+
+def get_profiles(path):
+    return sorted(
+        os.path.relpath(os.path.join(root, file), path)
+        for root, _, files in os.walk(path)
+        for file in files
+        if file.endswith(('.gcda', '.profraw', '.profdata'))
+    )
+
+
+def show(path, capsys):
+    capsys.readouterr()
+    assert main(['show', '--json', path]) == 0
+    return json.loads(capsys.readouterr().out)["profiles"]
+
+
+def test_no_profile_data(temp_dir, capsys):
+    assert main(['show', temp_dir]) == 1
+    assert capsys.readouterr().err.startswith('error: no profile data')
+
+
+def test_prune_no_criteria(temp_dir, capsys):
+    assert main(['prune', temp_dir]) == 1
+    assert capsys.readouterr().err.startswith('error: one of --older-than')
+
+
+@pytest.mark.parametrize('weighted_input', ['x', '0,a', '2'])
+def test_merge_weighted_input_invalid(temp_dir, weighted_input, capsys):
+    assert main([
+        'merge',
+        '-o', temp_dir,
+        '--weighted-input', weighted_input,
+    ]) == 1
+    assert capsys.readouterr().err.startswith('error: --weighted-input')
+
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='msvc profile data is not supported'
+)
+def test_merge(profile_data, temp_dir, is_clang, capsys):
+    merged_dir = os.path.join(temp_dir, 'merged')
+    assert main([
+        'merge',
+        '-o', merged_dir,
+        '-j', '2',
+        profile_data,
+        '--weighted-input', f'2,{profile_data}',
+    ]) == 0
+    if is_clang:
+        assert get_profiles(merged_dir) == [
+            os.path.join('_pgo_test', '_pgo_test.profdata')
+        ]
+    else:
+        assert get_profiles(merged_dir) == get_profiles(profile_data)
+    # the counters of the merged profile are the sum of the weighted inputs
+    profile, = show(profile_data, capsys)
+    merged_profile, = show(merged_dir, capsys)
+    assert merged_profile["counter_volume"] == profile["counter_volume"] * 3
+
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='msvc profile data is not supported'
+)
+def test_merge_single_weighted_input(profile_data, temp_dir, capsys):
+    # the weight applies to the profile data that only one input has
+    merged_dir = os.path.join(temp_dir, 'merged')
+    assert main([
+        'merge',
+        '-o', merged_dir,
+        '--weighted-input', f'5,{profile_data}',
+    ]) == 0
+    profile, = show(profile_data, capsys)
+    merged_profile, = show(merged_dir, capsys)
+    assert merged_profile["counter_volume"] == profile["counter_volume"] * 5
+
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='msvc profile data is not supported'
+)
+def test_show(profile_data, is_clang, capsys):
+    profile, = show(profile_data, capsys)
+    if is_clang:
+        assert profile["name"] == '_pgo_test'
+        assert profile["hottest"] == [{"name": "PyInit__pgo_test", "count": 1}]
+    else:
+        # the notes are not stored with the profile data, so the functions
+        # are not named
+        assert profile["name"].endswith('.gcda')
+        assert profile["functions"] >= 1
+    assert profile["counter_volume"] > 0
+
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='msvc profile data is not supported'
+)
+def test_diff(profile_data, temp_dir, capsys):
+    other_profile_data = os.path.join(temp_dir, 'other')
+    shutil.copytree(profile_data, other_profile_data)
+    capsys.readouterr()
+    assert main([
+        'diff', '--json', '--threshold', '1',
+        profile_data, other_profile_data,
+    ]) == 0
+    diff = json.loads(capsys.readouterr().out)
+    profile, = diff["profiles"]
+    assert profile["overlap"] == pytest.approx(1.0)
+    assert profile["mismatched_functions"] == 0
+    assert diff["only_in_input"] == []
+    assert diff["only_in_other_input"] == []
+
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='msvc profile data is not supported'
+)
+@pytest.mark.parametrize('dry_run', [False, True])
+def test_prune(profile_data, dry_run):
+    profiles = get_profiles(profile_data)
+    old = time.time() - 3 * 24 * 60 * 60
+    os.utime(os.path.join(profile_data, profiles[0]), (old, old))
+    assert main([
+        'prune',
+        '--older-than', '2',
+        *(['--dry-run'] if dry_run else []),
+        profile_data,
+    ]) == 0
+    if dry_run:
+        assert get_profiles(profile_data) == profiles
+    else:
+        assert get_profiles(profile_data) == profiles[1:]
+
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='msvc profile data is not supported'
+)
+def test_relocate(profile_data, temp_dir, is_clang, capsys):
+    source_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'src'))
+    new_source_dir = os.path.join(temp_dir, 'moved')
+    args = [
+        'relocate',
+        '--from', source_dir,
+        '--to', new_source_dir,
+        profile_data,
+    ]
+    if is_clang:
+        assert main(args) == 1
+        assert capsys.readouterr().err.startswith('error: only gcc')
+        return
+    profiles = get_profiles(profile_data)
+    assert main(args) == 0
+    rel_source_dir = os.path.splitdrive(source_dir)[1].lstrip(os.sep)
+    rel_new_source_dir = os.path.splitdrive(new_source_dir)[1].lstrip(os.sep)
+    assert get_profiles(profile_data) == sorted(
+        os.path.join(
+            rel_new_source_dir,
+            os.path.relpath(profile, rel_source_dir)
+        )
+        for profile in profiles
+    )
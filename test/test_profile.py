@@ -1,6 +1,6 @@
 
 # pgo
-from pgo.setuptools import compiler
+from pgo.setuptools import compiler, profile, sample
 from pgo.setuptools.profile import ProfileError
 # pytest
 import pytest
@@ -47,6 +47,115 @@ def test_profile_command(argv, distribution, profile_command):
     assert cmd.profile_command == tuple(profile_command)
 
 
+def test_profile_command_entry_points(argv):
+    argv.extend(['profile'])
+    distribution = Distribution({
+        "pgo": { "profile_command": "bench:run bench.workloads:Parse.run" }
+    })
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.profile_command[0] == sys.executable
+    assert profile._get_entry_points(cmd.profile_command) == [
+        'bench:run',
+        'bench.workloads:Parse.run',
+    ]
+
+
+def test_profile_workloads(argv, profile_command):
+    argv.extend(['profile'])
+    distribution = Distribution({
+        "pgo": { "profile_workloads": {
+            "a": { "profile_command": list(profile_command), "weight": 3 },
+            "b": { "profile_command": list(profile_command) },
+        }}
+    })
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.profile_command is None
+    assert cmd.profile_workloads == [
+        ("a", 3, tuple(profile_command)),
+        ("b", 1, tuple(profile_command)),
+    ]
+
+
+@pytest.mark.parametrize('pgo', [
+    { "profile_command": [], "profile_workloads": {} },
+    { "profile_workloads": {} },
+    { "profile_workloads": { "a/b": { "profile_command": [] } } },
+    { "profile_workloads": { "a": {} } },
+    { "profile_workloads": { "a": { "profile_command": [], "weight": 0 } } },
+    { "profile_workloads": { "a": { "profile_command": [], "weight": 1.5 } } },
+    { "profile_command": "" },
+    { "profile_command": "bench" },
+    { "profile_command": "bench:run python bench.py" },
+    { "profile_workloads": { "a": { "profile_command": "bench:" } } },
+])
+def test_profile_workloads_invalid(argv, pgo):
+    argv.extend(['profile'])
+    distribution = Distribution({ "pgo": pgo })
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    with pytest.raises(distutils.errors.DistutilsSetupError):
+        cmd.ensure_finalized()
+
+
+def test_default_jobs(argv, distribution):
+    argv.extend(['profile'])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.jobs == (os.cpu_count() or 1)
+
+
+def test_set_jobs(argv, distribution):
+    argv.extend(['profile', '--jobs', '3'])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.jobs == 3
+
+
+def test_set_jobs_through_build(argv, distribution):
+    argv.extend(['profile', 'build', '--pgo-jobs', '3'])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.jobs == 3
+
+
+@pytest.mark.parametrize('jobs', ['0', '-1', 'abc'])
+def test_set_jobs_invalid(argv, distribution, jobs):
+    argv.extend(['profile', '--jobs', jobs])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    with pytest.raises(distutils.errors.DistutilsOptionError):
+        cmd.ensure_finalized()
+
+
+def test_perf_data_not_sample(argv, distribution):
+    argv.extend(['profile'])
+    distribution.pgo["perf_data"] = ['perf.data']
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    with pytest.raises(distutils.errors.DistutilsOptionError):
+        cmd.ensure_finalized()
+
+
+def test_perf_data_without_profile_command(argv):
+    argv.extend(['profile'])
+    distribution = Distribution({
+        "pgo": { "mode": "sample", "perf_data": ['perf.data'] }
+    })
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.profile_command is None
+    assert cmd.profile_workloads == []
+    assert cmd.perf_data == ['perf.data']
+
+
 def test_default_build_dirs(argv, distribution):
     argv.extend(['profile'])
     distribution.parse_command_line()
@@ -223,6 +332,68 @@ def test_run_pythonpath_env_outer_has_values(argv, pgo_lib_dir, pgo_temp_dir):
             os.environ["PYTHONPATH"] = original_pythonpath
             
             
+def test_run_entry_points(argv, pgo_lib_dir, temp_dir, monkeypatch):
+    file_name = os.path.join(temp_dir, 'calls')
+    with open(os.path.join(pgo_lib_dir, '_pgo_test_workload.py'), 'w') as f:
+        f.write(textwrap.dedent(f"""
+            import os
+            def record(name):
+                with open({file_name!r}, 'a') as f:
+                    f.write(f'{{name}} {{os.getpid()}}\\n')
+            def parse():
+                record('parse')
+            class Render:
+                @staticmethod
+                def run():
+                    record('render')
+        """))
+    # the module in the working directory would be imported before the one in
+    # the build directory if it were only on the PYTHONPATH
+    work_dir = os.path.join(temp_dir, 'work')
+    os.makedirs(work_dir)
+    with open(os.path.join(work_dir, '_pgo_test_workload.py'), 'w') as f:
+        f.write('raise RuntimeError("not the built module")\n')
+    monkeypatch.chdir(work_dir)
+    argv.extend(['profile', '--build-lib', pgo_lib_dir])
+    distribution = Distribution({ "pgo": {
+        "profile_command":
+            "_pgo_test_workload:parse _pgo_test_workload:Render.run"
+    }})
+    distribution.parse_command_line()
+    distribution.run_commands()
+    with open(file_name) as f:
+        calls = [line.split() for line in f.read().splitlines()]
+    # both entry points are called, in order, by the same process
+    assert [name for name, _ in calls] == ['parse', 'render']
+    assert len({pid for _, pid in calls}) == 1
+
+
+def test_run_entry_points_error(argv, pgo_lib_dir):
+    argv.extend(['profile', '--build-lib', pgo_lib_dir])
+    distribution = Distribution({ "pgo": {
+        "profile_command": "_pgo_test_missing_workload:run"
+    }})
+    distribution.parse_command_line()
+    with pytest.raises(ProfileError, match='_pgo_test_missing_workload:run'):
+        distribution.run_commands()
+
+
+def test_find_entry_point_file(temp_dir, monkeypatch):
+    os.makedirs(os.path.join(temp_dir, 'bench'))
+    for name in ('__init__.py', 'workloads.py'):
+        with open(os.path.join(temp_dir, 'bench', name), 'w') as f:
+            f.write('raise RuntimeError("imported")\n')
+    monkeypatch.chdir(temp_dir)
+    assert profile._find_entry_point_file('bench.workloads:run') == (
+        os.path.join(os.getcwd(), 'bench', 'workloads.py')
+    )
+    assert profile._find_entry_point_file('bench:run') == (
+        os.path.join(os.getcwd(), 'bench', '__init__.py')
+    )
+    assert profile._find_entry_point_file('bench.missing:run') is None
+    assert profile._find_entry_point_file('missing:run') is None
+
+
 def test_run_error(argv, pgo_lib_dir):
     argv.extend(['profile'])
     distribution = Distribution({ "pgo": { "profile_command": [
@@ -312,6 +483,224 @@ def test_run_gcc(argv, extension, pgo_lib_dir, pgo_temp_dir):
     assert '_pgo_test.gcda' in temp_files
     
     
+@pytest.mark.skipif(sys.platform != 'linux', reason='not linux')
+def test_run_gcc_workloads(argv, extension, pgo_lib_dir, pgo_temp_dir):
+    argv.extend([
+        'build_ext_profile_generate',
+        '--build-lib', pgo_lib_dir,
+        '--build-temp', pgo_temp_dir,
+        'profile',
+        '--build-lib', pgo_lib_dir,
+        '--build-temp', pgo_temp_dir,
+    ])
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": { "profile_workloads": {
+            "a": {
+                "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+                "weight": 3,
+            },
+            "b": {
+                "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+            },
+        }}
+    })
+    distribution.parse_command_line()
+    distribution.run_commands()
+    # each workload wrote its own profile data
+    for name in ('a', 'b'):
+        workload_files = [
+            file
+            for root, _, files in os.walk(
+                os.path.join(pgo_temp_dir, '.pgo-workloads', name)
+            )
+            for file in files
+        ]
+        assert workload_files == ['_pgo_test.gcda']
+    # which was merged next to the object file
+    temp_files = [
+        os.path.relpath(os.path.join(root, file), pgo_temp_dir)
+        for root, _, files in os.walk(pgo_temp_dir)
+        for file in files
+        if file == '_pgo_test.gcda'
+        if '.pgo-workloads' not in root
+    ]
+    assert len(temp_files) == 1
+    
+    
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='msvc runs workloads one at a time'
+)
+def test_run_workloads_concurrently(
+    argv, extension,
+    pgo_lib_dir, pgo_temp_dir
+):
+    argv.extend([
+        'build_ext_profile_generate',
+        '--build-lib', pgo_lib_dir,
+        '--build-temp', pgo_temp_dir,
+        'profile',
+        '--build-lib', pgo_lib_dir,
+        '--build-temp', pgo_temp_dir,
+        '--jobs', '2',
+    ])
+    # each workload waits for the other to start, which can only happen if
+    # they run at the same time
+    def workload(name, other):
+        return { "profile_command": [
+            sys.executable, '-c', textwrap.dedent(f"""
+                import os
+                import sys
+                import time
+                import _pgo_test
+                open(os.path.join({pgo_lib_dir!r}, {name!r}), 'w').close()
+                for _ in range(600):
+                    if os.path.exists(os.path.join({pgo_lib_dir!r}, {other!r})):
+                        break
+                    time.sleep(.1)
+                else:
+                    sys.exit(1)
+            """)
+        ]}
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": { "profile_workloads": {
+            "a": workload('a', 'b'),
+            "b": workload('b', 'a'),
+        }}
+    })
+    distribution.parse_command_line()
+    distribution.run_commands()
+    
+    
+@pytest.fixture
+def sample_tools(monkeypatch):
+    # stands in for perf and the autofdo tools, which are rarely installed
+    commands = []
+    def get_perf_record_command(perf_data, profile_command):
+        return (
+            sys.executable, '-c',
+            f'open({perf_data!r}, "w").close()',
+        )
+    def run_sample_tool(name, command):
+        commands.append(command)
+        for arg in command:
+            for prefix in ('--gcov=', '--out=', '-output='):
+                if arg.startswith(prefix):
+                    with open(arg[len(prefix):], 'w') as f:
+                        f.write('sample')
+    monkeypatch.setattr(sample.shutil, 'which', lambda tool: tool)
+    monkeypatch.setattr(sample, '_run_sample_tool', run_sample_tool)
+    monkeypatch.setattr(
+        profile,
+        '_get_perf_record_command',
+        get_perf_record_command
+    )
+    return commands
+
+
+@pytest.mark.skipif(sys.platform != 'linux', reason='not linux')
+@pytest.mark.parametrize('production', [False, True])
+def test_run_sample(
+    argv, extension, sample_tools, production,
+    pgo_lib_dir, pgo_temp_dir
+):
+    argv.extend([
+        'build_ext_profile_generate',
+        '--build-lib', pgo_lib_dir,
+        '--build-temp', pgo_temp_dir,
+        'profile',
+        '--build-lib', pgo_lib_dir,
+        '--build-temp', pgo_temp_dir,
+    ])
+    pgo = { "mode": "sample" }
+    perf_data = os.path.join(pgo_lib_dir, 'production.data')
+    if production:
+        open(perf_data, 'w').close()
+        pgo["perf_data"] = [perf_data]
+    else:
+        pgo["profile_command"] = [sys.executable, '-c', 'import _pgo_test']
+    distribution = Distribution({ "ext_modules": [extension], "pgo": pgo })
+    distribution.parse_command_line()
+    distribution.run_commands()
+    # the perf data was converted against the extension
+    ext_path = distribution.get_command_obj(
+        'build_ext_profile_generate'
+    ).get_ext_fullpath(extension.name)
+    assert len(sample_tools) == 1
+    assert sample_tools[0][0] == 'create_gcov'
+    assert f'--binary={ext_path}' in sample_tools[0]
+    if production:
+        assert f'--profile={perf_data}' in sample_tools[0]
+    # into the sample profile for the extension
+    with open(
+        os.path.join(pgo_lib_dir, '.pgo-sample-profile-_pgo_test')
+    ) as f:
+        assert f.read() == 'sample'
+        
+        
+@pytest.mark.skipif(sys.platform != 'linux', reason='not linux')
+def test_run_sample_tools_missing(
+    argv, extension, monkeypatch,
+    pgo_lib_dir, pgo_temp_dir
+):
+    argv.extend([
+        'build_ext_profile_generate',
+        '--build-lib', pgo_lib_dir,
+        '--build-temp', pgo_temp_dir,
+        'profile',
+        '--build-lib', pgo_lib_dir,
+        '--build-temp', pgo_temp_dir,
+    ])
+    monkeypatch.setattr(sample.shutil, 'which', lambda tool: None)
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "mode": "sample",
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+        }
+    })
+    distribution.parse_command_line()
+    with pytest.raises(ProfileError):
+        distribution.run_commands()
+    
+    
+@pytest.mark.skipif(sys.platform != 'linux', reason='not linux')
+def test_run_sample_merger_missing(
+    argv, extension, sample_tools, monkeypatch,
+    pgo_lib_dir, pgo_temp_dir
+):
+    # more than one perf data is merged by autofdo's profile_merger for gcc
+    argv.extend([
+        'build_ext_profile_generate',
+        '--build-lib', pgo_lib_dir,
+        '--build-temp', pgo_temp_dir,
+        'profile',
+        '--build-lib', pgo_lib_dir,
+        '--build-temp', pgo_temp_dir,
+    ])
+    monkeypatch.setattr(
+        sample.shutil,
+        'which',
+        lambda tool: None if tool == 'profile_merger' else tool
+    )
+    perf_data = os.path.join(pgo_lib_dir, 'production.data')
+    open(perf_data, 'w').close()
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "mode": "sample",
+            "perf_data": [perf_data],
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+        }
+    })
+    distribution.parse_command_line()
+    with pytest.raises(ProfileError, match='profile_merger'):
+        distribution.run_commands()
+    assert not sample_tools
+    
+    
 @pytest.mark.skipif(sys.platform != 'darwin', reason='not macos')
 def test_run_clang(argv, extension, pgo_lib_dir, pgo_temp_dir):
     argv.extend([
@@ -333,4 +722,40 @@ def test_run_clang(argv, extension, pgo_lib_dir, pgo_temp_dir):
     # there should be a .pgo-profdatas directory in the temp directory
     temp_files = os.listdir(pgo_temp_dir)
     assert '.pgo-profdatas' in temp_files
+    # the raw profile data for each extension is in its own directory
+    profraw_files = os.listdir(
+        os.path.join(pgo_temp_dir, '.pgo-profdatas', '_pgo_test')
+    )
+    assert [f for f in profraw_files if f.endswith('.profraw')]
+    
+    
+@pytest.mark.skipif(sys.platform != 'darwin', reason='not macos')
+def test_run_clang_workloads(argv, extension, pgo_lib_dir, pgo_temp_dir):
+    argv.extend([
+        'build_ext_profile_generate',
+        '--build-lib', pgo_lib_dir,
+        '--build-temp', pgo_temp_dir,
+        'profile',
+        '--build-lib', pgo_lib_dir,
+        '--build-temp', pgo_temp_dir,
+    ])
+    distribution = Distribution({
+        "ext_modules": [extension],
+        "pgo": { "profile_workloads": {
+            "a": {
+                "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+                "weight": 3,
+            },
+            "b": {
+                "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+            },
+        }}
+    })
+    distribution.parse_command_line()
+    distribution.run_commands()
+    # the raw profile data for each weight is in its own directory
+    profraw_dir = os.path.join(pgo_temp_dir, '.pgo-profdatas', '_pgo_test')
+    for name in ('weight-3', 'weight-1'):
+        profraw_files = os.listdir(os.path.join(profraw_dir, name))
+        assert [f for f in profraw_files if f.endswith('.profraw')]
 
@@ -0,0 +1,215 @@
+
+# pgo
+from pgo.setuptools import compiler
+from pgo.setuptools.error import ProfileCheckError
+# pytest
+import pytest
+# python
+import json
+import os
+import shutil
+import sys
+import textwrap
+# setuptools
+import distutils.errors
+from setuptools import Distribution
+
+
+@pytest.fixture
+def distribution(extension, make_temp_dir):
+    return Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+            "profile_data": [make_temp_dir()],
+        }
+    })
+
+
+def test_default_options(argv, distribution):
+    argv.extend(['profile_check'])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.profile_data_dir == distribution.pgo["profile_data"]
+    assert cmd.threshold == 0.9
+    assert cmd.output is None
+    assert cmd.profile_commands == [
+        (None, (sys.executable, '-c', 'import _pgo_test'))
+    ]
+
+
+def test_set_options(argv, distribution):
+    argv.extend([
+        'profile_check',
+        '--profile-data-dir', os.pathsep.join(['a', 'b']),
+        '--threshold', '0.5',
+        '--output', 'check.json',
+    ])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.profile_data_dir == ['a', 'b']
+    assert cmd.threshold == 0.5
+    assert cmd.output == 'check.json'
+
+
+def test_set_options_through_pgo(argv, distribution):
+    argv.extend(['profile_check'])
+    distribution.pgo["profile_check_threshold"] = 0.5
+    distribution.pgo["profile_check_output"] = 'check.json'
+    distribution.pgo["profile_check_command"] = [sys.executable, '-c', '']
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.threshold == 0.5
+    assert cmd.output == 'check.json'
+    assert cmd.profile_commands == [(None, (sys.executable, '-c', ''))]
+
+
+@pytest.mark.parametrize('threshold', ['-0.1', '1.1', 'x'])
+def test_set_threshold_invalid(argv, distribution, threshold):
+    argv.extend(['profile_check', '--threshold', threshold])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    with pytest.raises(distutils.errors.DistutilsOptionError):
+        cmd.ensure_finalized()
+
+
+def test_no_profile_data(argv, distribution):
+    argv.extend(['profile_check'])
+    del distribution.pgo["profile_data"]
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    with pytest.raises(distutils.errors.DistutilsOptionError):
+        cmd.ensure_finalized()
+
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='profile checks are not supported by msvc'
+)
+@pytest.mark.parametrize('calls, passed', [(0, True), (1000, False)])
+def test_run(
+    argv, cython_extension,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir,
+    make_temp_dir,
+    calls, passed
+):
+    profile_data_dir = make_temp_dir()
+    def run(*args, profile_check_calls=1):
+        argv.extend(args)
+        distribution = Distribution({
+            "ext_modules": [cython_extension],
+            "pgo": {
+                "profile_command": [
+                    sys.executable, '-c', 'import _pgo_test_cython'
+                ],
+                "profile_check_command": [
+                    sys.executable, '-c', textwrap.dedent(f"""
+                        import _pgo_test_cython
+                        for i in range({profile_check_calls}):
+                            _pgo_test_cython.say_hello_to(i)
+                    """)
+                ],
+            }
+        })
+        distribution.parse_command_line()
+        try:
+            distribution.run_commands()
+        finally:
+            del argv[1:]
+        return distribution
+    # store the profile data, gcc's profile data depends on the path of the
+    # build directory so the same one is used
+    run(
+        'build',
+        '--pgo-require',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+    )
+    build_ext = Distribution().get_command_obj('build_ext')
+    build_ext.ensure_finalized()
+    if compiler.is_clang(compiler._new_compiler(build_ext.compiler)):
+        shutil.copytree(
+            compiler._get_profdata_dir(pgo_temp_dir),
+            profile_data_dir,
+            dirs_exist_ok=True
+        )
+    else:
+        for root, _, files in os.walk(pgo_temp_dir):
+            for file in files:
+                if file.endswith('.gcda'):
+                    path = os.path.join(root, file)
+                    target = os.path.join(
+                        profile_data_dir,
+                        os.path.relpath(path, pgo_temp_dir)
+                    )
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    shutil.copyfile(path, target)
+    def get_build_profile_data():
+        # the profile data in the build directory, which the check must not
+        # replace
+        profile_data = {}
+        for root, dirs, files in os.walk(pgo_temp_dir):
+            dirs[:] = [d for d in dirs if d != '.pgo-check']
+            for file in files:
+                if file.endswith(('.gcda', '.profraw', '.profdata')):
+                    with open(os.path.join(root, file), 'rb') as f:
+                        profile_data[os.path.join(root, file)] = f.read()
+        return profile_data
+    build_profile_data = get_build_profile_data()
+    assert build_profile_data
+    output = os.path.join(temp_dir, 'check.json')
+    args = (
+        'build_profile_generate',
+        '--build-lib', pgo_lib_dir,
+        '--build-temp', pgo_temp_dir,
+        'profile_check',
+        '--profile-data-dir', profile_data_dir,
+        '--output', output,
+    )
+    # calling the function many times changes where the time is spent, so
+    # the stored profile no longer overlaps with the fresh one
+    if passed:
+        distribution = run(*args, profile_check_calls=calls)
+    else:
+        with pytest.raises(ProfileCheckError):
+            run(*args, profile_check_calls=calls)
+    with open(output) as f:
+        check = json.load(f)
+    assert get_build_profile_data() == build_profile_data
+    extension_check, = check["extensions"]
+    assert extension_check["name"] == cython_extension.name
+    assert extension_check["mismatched_functions"] == 0
+    assert (extension_check["overlap"] >= 0.9) == passed
+    if passed:
+        cmd = distribution.get_command_obj('profile_check')
+        assert check == {
+            "threshold": 0.9,
+            "extensions": cmd.extension_checks,
+        }
+
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='profile checks are not supported by msvc'
+)
+def test_run_profile_data_dir_missing(
+    argv, distribution,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir
+):
+    argv.extend([
+        'build_profile_generate',
+        '--build-lib', pgo_lib_dir,
+        '--build-temp', pgo_temp_dir,
+        'profile_check',
+        '--profile-data-dir', os.path.join(temp_dir, 'missing'),
+    ])
+    distribution.parse_command_line()
+    with pytest.raises(ProfileCheckError):
+        distribution.run_commands()
@@ -0,0 +1,240 @@
+
+# pgo
+from pgo.setuptools import compiler, profilearchive
+from pgo.setuptools.error import ProfileUseError
+# pytest
+import pytest
+# python
+import json
+import os
+import sys
+import textwrap
+import zipfile
+# setuptools
+import distutils.errors
+from setuptools import Distribution
+
+
+@pytest.fixture
+def distribution(extension):
+    return Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+        }
+    })
+
+
+def test_default_options(argv, distribution):
+    argv.extend(['profile_export'])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    with pytest.raises(distutils.errors.DistutilsOptionError):
+        cmd.ensure_finalized()
+
+
+def test_set_options(argv, distribution):
+    argv.extend(['profile_export', '--output', 'profile.zip'])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.output == 'profile.zip'
+
+
+def test_set_options_through_pgo(argv, distribution):
+    argv.extend(['profile_export'])
+    distribution.pgo["profile_export_output"] = 'profile.zip'
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.output == 'profile.zip'
+
+
+def test_set_options_not_instrument(argv, distribution):
+    argv.extend([
+        'build', '--pgo-mode', 'cs',
+        'profile_export', '--output', 'profile.zip',
+    ])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[1])
+    with pytest.raises(distutils.errors.DistutilsOptionError):
+        cmd.ensure_finalized()
+
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='exporting profile data is not supported by msvc'
+)
+@pytest.mark.parametrize(
+    'mismatch',
+    [None, 'compiler', 'pgo_build_temp', 'source_paths']
+)
+def test_run(
+    argv, extension, cython_extension,
+    temp_dir,
+    monkeypatch,
+    mismatch
+):
+    counter = os.path.join(temp_dir, 'counter')
+    archive = os.path.join(temp_dir, 'profile.zip')
+    def run(host, *args):
+        # each host is a directory of its own with the same relative build
+        # directories, as another checkout would be
+        host_dir = os.path.join(temp_dir, host)
+        os.makedirs(host_dir, exist_ok=True)
+        monkeypatch.chdir(host_dir)
+        argv.extend(args)
+        distribution = Distribution({
+            "ext_modules": [extension, cython_extension],
+            "pgo": {
+                "profile_command": [
+                    sys.executable, '-c', textwrap.dedent(f"""
+                        import _pgo_test
+                        import _pgo_test_cython
+                        with open({counter!r}, 'a') as f:
+                            f.write('x')
+                    """)
+                ]
+            }
+        })
+        distribution.parse_command_line()
+        try:
+            distribution.run_commands()
+        finally:
+            del argv[1:]
+    run(
+        'profiler',
+        'build_profile_generate',
+        '--build-lib', os.path.join('build', 'pgo-lib'),
+        '--build-temp', os.path.join('build', 'pgo-temp'),
+        'profile_export',
+        '--output', archive,
+    )
+    with zipfile.ZipFile(archive) as f:
+        metadata = json.loads(f.read('pgo-profile.json'))
+    assert metadata["format"] == 1
+    assert sorted(metadata["extensions"]) == sorted([
+        extension.name,
+        cython_extension.name,
+    ])
+    if mismatch == 'compiler':
+        metadata["compiler"]["vendor"] = 'other'
+    elif mismatch == 'pgo_build_temp':
+        # clang's profile data doesn't depend on the build directory
+        if metadata["compiler"]["vendor"] == 'clang':
+            pytest.skip('only gcc checksums the paths of the objects')
+        metadata["pgo_build_temp"] = 'other'
+    elif mismatch == 'source_paths':
+        for exported in metadata["extensions"].values():
+            exported["source_paths"] = ['other.c']
+    if mismatch is not None:
+        rewritten_archive = os.path.join(temp_dir, 'rewritten.zip')
+        with zipfile.ZipFile(archive) as f:
+            with zipfile.ZipFile(rewritten_archive, 'w') as rewritten_f:
+                for name in f.namelist():
+                    if name == 'pgo-profile.json':
+                        rewritten_f.writestr(name, json.dumps(metadata))
+                    else:
+                        rewritten_f.writestr(name, f.read(name))
+        archive = rewritten_archive
+    # the archive is imported by a build on another host, which optimizes
+    # the extensions without running the profile command
+    args = (
+        'builder',
+        'build',
+        '--pgo-require',
+        '--pgo-build-lib', os.path.join('build', 'pgo-lib'),
+        '--pgo-build-temp', os.path.join('build', 'pgo-temp'),
+        '--build-lib', os.path.join('build', 'lib'),
+        '--build-temp', os.path.join('build', 'temp'),
+        '--pgo-profile-archive', archive,
+    )
+    if mismatch is not None:
+        with pytest.raises(ProfileUseError):
+            run(*args)
+        return
+    run(*args)
+    with open(counter) as f:
+        assert f.read() == 'x'
+    lib_dir = os.path.join(temp_dir, 'builder', 'build', 'lib')
+    assert [
+        f for f in os.listdir(lib_dir)
+        if f.startswith(extension.name)
+        if f.endswith('.so')
+    ]
+
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='importing profile data is not supported by msvc'
+)
+def test_run_archive_invalid(argv, distribution, lib_dir, temp_dir):
+    archive = os.path.join(temp_dir, 'profile.zip')
+    with zipfile.ZipFile(archive, 'w') as f:
+        f.writestr('other.txt', '')
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+        '--pgo-profile-archive', archive,
+    ])
+    distribution.parse_command_line()
+    with pytest.raises(ProfileUseError):
+        distribution.run_commands()
+
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='importing profile data is not supported by msvc'
+)
+@pytest.mark.parametrize('member', [
+    '../../escaped.gcda',
+    '_pgo_test/../../../escaped.profdata',
+    '/escaped.gcda',
+    'C:/escaped.gcda',
+    '..\\..\\escaped.gcda',
+])
+def test_run_archive_member_outside(
+    argv, distribution,
+    lib_dir, temp_dir,
+    member
+):
+    # an archive from another host must not write outside of the directory
+    # it's extracted to
+    build_ext = Distribution().get_command_obj('build_ext')
+    build_ext.ensure_finalized()
+    identity = compiler.get_compiler_identity(
+        compiler._new_compiler(build_ext.compiler)
+    )
+    archive_dir = os.path.join(temp_dir, 'a', 'b')
+    os.makedirs(archive_dir)
+    archive = os.path.join(archive_dir, 'profile.zip')
+    with zipfile.ZipFile(archive, 'w') as f:
+        f.writestr(profilearchive.PROFILE_ARCHIVE_METADATA, json.dumps({
+            "format": profilearchive.PROFILE_ARCHIVE_FORMAT,
+            "compiler": {
+                "vendor": identity.vendor,
+                "version": identity.version,
+            },
+            "python_abi": profilearchive._get_python_abi(),
+            "pgo_build_temp": None,
+            "extensions": {"_pgo_test": {"sources": {}}},
+        }))
+        f.writestr(member, 'escaped')
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--build-lib', lib_dir,
+        '--build-temp', os.path.join(archive_dir, 'temp'),
+        '--pgo-profile-archive', archive,
+    ])
+    distribution.parse_command_line()
+    with pytest.raises(ProfileUseError, match='outside of the archive'):
+        distribution.run_commands()
+    assert not [
+        file
+        for _, _, files in os.walk(temp_dir)
+        for file in files
+        if file.startswith('escaped')
+    ]
@@ -0,0 +1,114 @@
+
+# pgo
+from pgo.setuptools.error import ProfileError
+# pytest
+import pytest
+# python
+import json
+import os
+import sys
+# setuptools
+import distutils.errors
+from setuptools import Distribution
+
+
+@pytest.fixture
+def distribution(extension):
+    return Distribution({
+        "ext_modules": [extension],
+        "pgo": {
+            "profile_command": [sys.executable, '-c', 'import _pgo_test'],
+        }
+    })
+
+
+def test_default_options(argv, distribution):
+    argv.extend(['profile_report'])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.top == 10
+    assert cmd.output is None
+
+
+def test_set_options(argv, distribution):
+    argv.extend(['profile_report', '--top', '3', '--output', 'report.json'])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.top == 3
+    assert cmd.output == 'report.json'
+
+
+def test_set_options_through_pgo(argv, distribution):
+    argv.extend(['profile_report'])
+    distribution.pgo["profile_report_top"] = 3
+    distribution.pgo["profile_report_output"] = 'report.json'
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    cmd.ensure_finalized()
+    assert cmd.top == 3
+    assert cmd.output == 'report.json'
+
+
+@pytest.mark.parametrize('top', ['-1', 'x'])
+def test_set_top_invalid(argv, distribution, top):
+    argv.extend(['profile_report', '--top', top])
+    distribution.parse_command_line()
+    cmd = distribution.get_command_obj(distribution.commands[0])
+    with pytest.raises(distutils.errors.DistutilsOptionError):
+        cmd.ensure_finalized()
+
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='profile reports are not supported by msvc'
+)
+def test_run(
+    argv, distribution,
+    pgo_lib_dir, pgo_temp_dir,
+    lib_dir, temp_dir
+):
+    report_path = os.path.join(temp_dir, 'report.json')
+    argv.extend([
+        'build',
+        '--pgo-require',
+        '--pgo-build-lib', pgo_lib_dir,
+        '--pgo-build-temp', pgo_temp_dir,
+        '--build-lib', lib_dir,
+        '--build-temp', temp_dir,
+        'profile_report',
+        '--top', '1',
+        '--output', report_path,
+    ])
+    distribution.parse_command_line()
+    distribution.run_commands()
+    cmd = distribution.get_command_obj('profile_report')
+    with open(report_path) as f:
+        report = json.load(f)
+    assert report == {"extensions": cmd.extension_profiles}
+    extension_profile, = report["extensions"]
+    assert extension_profile["name"] == '_pgo_test'
+    assert extension_profile["functions"] >= 1
+    assert 0 <= extension_profile["zero_function_fraction"] < 1
+    assert extension_profile["counter_volume"] > 0
+    # the module's init function is the only one that's run by the profile
+    # command
+    assert extension_profile["hottest"] == [
+        {"name": "PyInit__pgo_test", "count": 1}
+    ]
+
+
+@pytest.mark.skipif(
+    sys.platform == 'win32',
+    reason='profile reports are not supported by msvc'
+)
+def test_run_no_profile(argv, distribution, pgo_lib_dir, pgo_temp_dir):
+    argv.extend([
+        'profile_report',
+        '--build-lib', pgo_lib_dir,
+        '--build-temp', pgo_temp_dir,
+    ])
+    distribution.parse_command_line()
+    with pytest.raises(ProfileError):
+        distribution.run_commands()